@@ -0,0 +1,110 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+
+# Purpose: CPU benchmark of ParticleNet(-Lite) prediction with every jet padded to pad_len against length-bucketed
+# batches (load_datasets.bucketed_batches) and against the ragged model (get_particle_net_lite(..., ragged=True)),
+# on synthetic jets written in the format of the converted .awkd files.
+# Run from the repository root: python benchmarks/bucketing.py --jets 20000 --mean_parts 40 --buckets 4
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import tempfile
+import optparse
+import numpy as np
+import awkward
+from tensorflow import keras
+from load_datasets import Dataset, make_buckets, bucket_report, bucketed_batches
+from tf_keras_model import get_particle_net, get_particle_net_lite, copy_weights
+
+def write_jets(path, n_jets, mean_parts, seed=0):
+    rng = np.random.default_rng(seed)
+    counts = np.clip(rng.poisson(mean_parts, n_jets), 2, None)
+    def jagged(values):
+        return awkward.unflatten(values.astype('float32'), counts)
+    n = counts.sum()
+    columns = {
+        'part_pt_log': jagged(rng.uniform(0.1, 6., n)),
+        'part_e_log': jagged(rng.uniform(0.1, 7., n)),
+        'part_logptrel': jagged(rng.uniform(-8., 0., n)),
+        'part_logerel': jagged(rng.uniform(-8., 0., n)),
+        'part_etarel': jagged(rng.normal(0., 0.3, n)),
+        'part_phirel': jagged(rng.normal(0., 0.3, n)),
+        'part_charge': jagged(rng.integers(-1, 2, n)),
+        'part_deltaR': jagged(rng.uniform(0., 0.8, n)),
+        'label': np.eye(3, dtype='float32')[rng.integers(0, 3, n_jets)],
+        'event_weight': np.ones(n_jets, dtype='float32'),
+        }
+    awkward.to_parquet(awkward.zip(columns, depth_limit=1), path)
+
+def randomize_bn(model, seed=1):
+    # non-trivial BatchNorm statistics, as in a trained checkpoint
+    rng = np.random.default_rng(seed)
+    for layer in model.layers:
+        if isinstance(layer, keras.layers.BatchNormalization):
+            layer.set_weights([w + rng.uniform(0.5, 1.5, w.shape).astype('float32') if i in (0, 3) else w + 0.1 * rng.standard_normal(w.shape).astype('float32')
+                               for i, w in enumerate(layer.get_weights())])
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--model", help = "particle_net_lite or particle_net", default= "particle_net_lite")
+    parser.add_option("--jets", type="int", default= 20000)
+    parser.add_option("--mean_parts", type="float", help = "mean number of particles per jet", default= 40.)
+    parser.add_option("--buckets", type="int", help = "number of length buckets", default= 4)
+    parser.add_option("--batch_size", type="int", default= 1024)
+    (options,args) = parser.parse_args()
+
+    lite = 'lite' in options.model
+    get_model = get_particle_net_lite if lite else get_particle_net
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'synthetic.awkd')
+        write_jets(path, options.jets, options.mean_parts)
+        dataset = Dataset(path, data_format='channel_last')
+
+    input_shapes = {k:dataset[k].shape[1:] for k in dataset.X}
+    model = get_model(3, input_shapes)
+    randomize_bn(model)
+    bucket_model = get_model(3, {k:(None,) + shape[1:] for k, shape in input_shapes.items()}, num_points=dataset.pad_len)
+    copy_weights(model, bucket_model)
+    ragged_model = get_model(3, input_shapes, ragged=True)
+    copy_weights(model, ragged_model)
+
+    n_parts = dataset.n_parts()
+    buckets = make_buckets(n_parts, dataset.pad_len, options.buckets, min_len=16 if lite else 34)
+    report = bucket_report(n_parts, buckets)
+
+    def predict_padded():
+        return model.predict(dataset.X, batch_size=options.batch_size, verbose=0)
+
+    def predict_bucketed():
+        output = np.empty((len(dataset), 3), dtype='float32')
+        for indices, X, _ in bucketed_batches(dataset, options.batch_size, buckets):
+            output[indices] = bucket_model.predict_on_batch(X)
+        return output
+
+    def predict_ragged():
+        return ragged_model.predict(dataset.X, batch_size=options.batch_size, verbose=0)
+
+    # first calls trace the functions for every batch shape
+    padded, bucketed, ragged = predict_padded(), predict_bucketed(), predict_ragged()
+    t0 = time.perf_counter()
+    predict_padded()
+    t_padded = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    predict_bucketed()
+    t_bucketed = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    predict_ragged()
+    t_ragged = time.perf_counter() - t0
+
+    print("model={} jets={} mean n_parts={:.1f} pad_len={}".format(options.model, len(dataset), n_parts.mean(), dataset.pad_len))
+    print("buckets: " + ", ".join("{} jets <= {}".format(b['jets'], b['length']) for b in report['buckets']))
+    print("expected compute: {:.1f}% (linear), {:.1f}% (distance matrix)".format(100 * report['linear'], 100 * report['quadratic']))
+    print("padded   {:8.2f} s  {:10.0f} jets/s".format(t_padded, len(dataset) / t_padded))
+    print("bucketed {:8.2f} s  {:10.0f} jets/s  speedup {:.2f}x".format(t_bucketed, len(dataset) / t_bucketed, t_padded / t_bucketed))
+    print("ragged   {:8.2f} s  {:10.0f} jets/s  speedup {:.2f}x".format(t_ragged, len(dataset) / t_ragged, t_padded / t_ragged))
+    print("max |diff| of the outputs: {:.2e} (bucketed), {:.2e} (ragged)".format(np.max(np.abs(padded - bucketed)), np.max(np.abs(padded - ragged))))
+
+if __name__ == "__main__":
+    main()
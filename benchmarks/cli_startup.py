@@ -0,0 +1,50 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+
+# Purpose: start-up time of a command line script (default keras_predict_multi.py) for invocations that do not
+# predict anything (--help, a missing input file), and the top-level modules it imports with their cumulative
+# import time (python -X importtime).
+# Run from the repository root: python benchmarks/cli_startup.py [--script keras_predict_multi.py] [--repeat 3]
+
+import os
+import sys
+import time
+import optparse
+import subprocess
+import numpy as np
+
+def run(command, repeat):
+    """Median wall time in s of command, and the cumulative import time in s of each top-level module of the last run"""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime'] + command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        times.append(time.perf_counter() - t0)
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # nested imports are indented below the module that imports them
+        if not name[1:].startswith(' '):
+            imports[name.strip()] = int(cumulative) * 1e-6
+    return float(np.median(times)), imports
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--script", default= "keras_predict_multi.py")
+    parser.add_option("--repeat", type="int", default= 3)
+    parser.add_option("--top", type="int", help = "number of imports to list", default= 8)
+    (options,args) = parser.parse_args()
+
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    cases = [('--help', [options.script, '--help']),
+             ('missing file', [options.script, '--eval_file', 'missing.awkd'])]
+    for name, command in cases:
+        elapsed, imports = run(command, options.repeat)
+        print("{}: {:.2f} s".format(" ".join(command), elapsed))
+        for module, t in sorted(imports.items(), key=lambda x: -x[1])[:options.top]:
+            print("    {:>8.3f} s  {}".format(t, module))
+
+if __name__ == "__main__":
+    main()
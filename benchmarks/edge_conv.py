@@ -0,0 +1,125 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+
+# Purpose: CPU micro-benchmark of the ParticleNet(-Lite) forward pass with the previous EdgeConv neighbour path
+# (tiled (N, P, K, 2) gather_nd indices, tiled centre features, concat) against the current one in tf_keras_model,
+# with the same weights, and check that both give the same output.
+# Run from the repository root: python benchmarks/edge_conv.py --batch_sizes 1,64,256,1024
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import optparse
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+import tf_keras_model
+from tf_keras_model import get_particle_net, get_particle_net_lite, batch_distance_matrix_general, copy_weights
+
+def knn_reference(num_points, k, topk_indices, features):
+    queries_shape = tf.shape(features)
+    batch_size = queries_shape[0]
+    batch_indices = tf.tile(tf.reshape(tf.range(batch_size), (-1, 1, 1, 1)), (1, num_points, k, 1))
+    indices = tf.concat([batch_indices, tf.expand_dims(topk_indices, axis=3)], axis=3)  # (N, P, K, 2)
+    return tf.gather_nd(features, indices)
+
+def edge_conv_reference(points, features, num_points, K, channels, with_bn=True, activation='relu', pooling='average', name='edgeconv'):
+    # tf_keras_model.edge_conv before the neighbour path was optimized
+    D = batch_distance_matrix_general(points, points)  # (N, P, P)
+    _, indices = tf.nn.top_k(-D, k=K + 1)  # (N, P, K+1)
+    indices = indices[:, :, 1:]  # (N, P, K)
+
+    fts = features
+    knn_fts = knn_reference(num_points, K, indices, fts)  # (N, P, K, C)
+    knn_fts_center = tf.tile(tf.expand_dims(fts, axis=2), (1, 1, K, 1))  # (N, P, K, C)
+    knn_fts = tf.concat([knn_fts_center, tf.subtract(knn_fts, knn_fts_center)], axis=-1)  # (N, P, K, 2*C)
+
+    x = knn_fts
+    for idx, channel in enumerate(channels):
+        x = keras.layers.Conv2D(channel, kernel_size=(1, 1), strides=1, data_format='channels_last',
+                                use_bias=False if with_bn else True, kernel_initializer='glorot_normal', name='%s_conv%d' % (name, idx))(x)
+        if with_bn:
+            x = keras.layers.BatchNormalization(name='%s_bn%d' % (name, idx))(x)
+        if activation:
+            x = keras.layers.Activation(activation, name='%s_act%d' % (name, idx))(x)
+
+    if pooling == 'max':
+        fts = tf.reduce_max(x, axis=2)  # (N, P, C')
+    else:
+        fts = tf.reduce_mean(x, axis=2)  # (N, P, C')
+
+    sc = keras.layers.Conv2D(channels[-1], kernel_size=(1, 1), strides=1, data_format='channels_last',
+                             use_bias=False if with_bn else True, kernel_initializer='glorot_normal', name='%s_sc_conv' % name)(tf.expand_dims(features, axis=2))
+    if with_bn:
+        sc = keras.layers.BatchNormalization(name='%s_sc_bn' % name)(sc)
+    sc = tf.squeeze(sc, axis=2)
+
+    if activation:
+        return keras.layers.Activation(activation, name='%s_sc_act' % name)(sc + fts)  # (N, P, C')
+    else:
+        return sc + fts
+
+def build_reference(get_model, num_classes, input_shapes):
+    edge_conv = tf_keras_model.edge_conv
+    tf_keras_model.edge_conv = edge_conv_reference
+    try:
+        return get_model(num_classes, input_shapes)
+    finally:
+        tf_keras_model.edge_conv = edge_conv
+
+def make_inputs(batch_size, input_shapes, seed=0):
+    rng = np.random.default_rng(seed)
+    num_points = input_shapes['points'][0]
+    n_parts = np.minimum(rng.poisson(40, batch_size) + 1, num_points)
+    valid = (np.arange(num_points) < n_parts[:, None])[..., None].astype('float32')
+    X = {k: rng.standard_normal((batch_size,) + tuple(shape)).astype('float32') * valid for k, shape in input_shapes.items()}
+    X['mask'] = valid * np.abs(X['mask']) + valid * 1e-3
+    return X
+
+def randomize_bn(model, seed=1):
+    # non-trivial BatchNorm statistics, as in a trained checkpoint
+    rng = np.random.default_rng(seed)
+    for layer in model.layers:
+        if isinstance(layer, keras.layers.BatchNormalization):
+            layer.set_weights([w + rng.uniform(0.5, 1.5, w.shape).astype('float32') if i in (0, 3) else w + 0.1 * rng.standard_normal(w.shape).astype('float32')
+                               for i, w in enumerate(layer.get_weights())])
+
+def time_forward(model, X, repeats):
+    forward = tf.function(lambda x: model(x, training=False))
+    forward(X)  # trace
+    timings = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        forward(X).numpy()
+        timings.append(time.perf_counter() - t0)
+    return np.median(timings)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--model", help = "particle_net_lite or particle_net", default= "particle_net_lite")
+    parser.add_option("--batch_sizes", help = "comma separated batch sizes", default= "1,64,256,1024")
+    parser.add_option("--repeats", type="int", default= 10)
+    parser.add_option("--threads", type="int", help = "intra-op threads (0: TensorFlow default)", default= 0)
+    (options,args) = parser.parse_args()
+
+    if options.threads:
+        tf.config.threading.set_intra_op_parallelism_threads(options.threads)
+    get_model = get_particle_net_lite if 'lite' in options.model else get_particle_net
+    input_shapes = {'points': (100, 2), 'features': (100, 6), 'mask': (100, 1)}
+    reference = build_reference(get_model, 3, input_shapes)
+    randomize_bn(reference)
+    model = get_model(3, input_shapes)
+    copy_weights(reference, model)
+
+    print("model={} threads={}".format(options.model, options.threads or 'default'))
+    print("{:>10s} {:>14s} {:>14s} {:>8s} {:>12s}".format("batch", "previous [ms]", "current [ms]", "speedup", "max |diff|"))
+    for batch_size in [int(b) for b in options.batch_sizes.split(',')]:
+        X = make_inputs(batch_size, input_shapes)
+        diff = np.max(np.abs(reference(X, training=False).numpy() - model(X, training=False).numpy()))
+        t_ref = time_forward(reference, X, options.repeats)
+        t_new = time_forward(model, X, options.repeats)
+        print("{:>10d} {:>14.2f} {:>14.2f} {:>7.2f}x {:>12.2e}".format(batch_size, t_ref * 1e3, t_new * 1e3, t_ref / t_new, diff))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+
+# Purpose: throughput and latency of scoring_server.py under concurrent clients for several micro-batch sizes
+# (--max_batch 1 disables the batching), and parity of the served scores with model.predict.
+# Run from the repository root: python benchmarks/micro_batching.py --clients 16 --max_batches 1,32,256
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import optparse
+import threading
+import numpy as np
+from tf_keras_model import get_particle_net_lite
+from scoring_server import ScoringService, ScoringClient, make_server
+from edge_conv import make_inputs, randomize_bn
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--clients", type="int", help = "concurrent clients", default= 16)
+    parser.add_option("--requests", type="int", help = "requests per client", default= 40)
+    parser.add_option("--jets_per_request", type="int", default= 4)
+    parser.add_option("--max_batches", help = "comma separated --max_batch values", default= "1,32,256")
+    parser.add_option("--max_latency_ms", type="float", default= 5.)
+    parser.add_option("--socket", action="store_true", help = "use a Unix socket instead of TCP", default= False)
+    (options,args) = parser.parse_args()
+
+    input_shapes = {'points': (100, 2), 'features': (100, 6), 'mask': (100, 1)}
+    n = options.clients * options.requests * options.jets_per_request
+    X = make_inputs(n, input_shapes)
+    model = get_particle_net_lite(3, input_shapes)
+    randomize_bn(model)
+    reference = model.predict(X, batch_size=256, verbose=0)
+
+    print("clients={} requests/client={} jets/request={}".format(options.clients, options.requests, options.jets_per_request))
+    print("{:>10s} {:>10s} {:>10s} {:>10s} {:>10s} {:>12s} {:>12s}".format("max_batch", "req/s", "jets/s", "p50 ms", "p99 ms", "jets/batch", "max |diff|"))
+    for max_batch in [int(b) for b in options.max_batches.split(',')]:
+        service = ScoringService({'UL18': model}, max_batch=max_batch, max_latency=options.max_latency_ms * 1e-3)
+        address = '/tmp/scoring_benchmark_%d.sock' % os.getpid() if options.socket else None
+        server = make_server(service, port=0, unix_socket=address)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        client = ScoringClient('unix:' + address if options.socket else 'http://127.0.0.1:%d' % server.server_address[1])
+        scores = np.empty_like(reference)
+
+        def _client(c):
+            for r in range(options.requests):
+                start = (c * options.requests + r) * options.jets_per_request
+                part = slice(start, start + options.jets_per_request)
+                scores[part] = client.score({k:v[part] for k, v in X.items()}, year='UL18')
+
+        client.score({k:v[:1] for k, v in X.items()})  # warm up
+        threads = [threading.Thread(target=_client, args=(c,)) for c in range(options.clients)]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+        metrics = client.metrics()['years']['UL18']
+        server.shutdown()
+        server.server_close()
+        requests = options.clients * options.requests
+        print("{:>10d} {:>10.0f} {:>10.0f} {:>10.1f} {:>10.1f} {:>12.1f} {:>12.2e}".format(max_batch, requests / elapsed, n / elapsed,
+              metrics['latency_ms']['p50'], metrics['latency_ms']['p99'], metrics['mean_batch_jets'], np.max(np.abs(scores - reference))))
+
+if __name__ == "__main__":
+    main()
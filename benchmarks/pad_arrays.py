@@ -0,0 +1,50 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+
+# Purpose: compare the per-jet pad_array loop + np.stack used by Dataset._load before, with the vectorized pad_arrays
+# on synthetic jets. Run from the repository root: python benchmarks/pad_arrays.py --njets 1000000
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import optparse
+import numpy as np
+import awkward
+from load_datasets import pad_array, pad_arrays
+
+def make_jets(njets, ncols, mean_parts=40, seed=42):
+    rng = np.random.default_rng(seed)
+    counts = np.clip(rng.poisson(mean_parts, njets), 1, None)
+    flat = rng.standard_normal((ncols, counts.sum())).astype('float32')
+    return counts, flat
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--njets", type="int", help = "number of synthetic jets", default= 200000)
+    parser.add_option("--ncols", type="int", help = "number of padded columns", default= 6)
+    parser.add_option("--pad_len", type="int", default= 100)
+    parser.add_option("--mean_parts", type="int", help = "mean number of particles per jet", default= 40)
+    (options,args) = parser.parse_args()
+
+    counts, flat = make_jets(options.njets, options.ncols, options.mean_parts)
+    splits = np.cumsum(counts)[:-1]
+    # the old loop iterates over per-jet numpy arrays
+    jagged_np = [np.split(flat[c], splits) for c in range(options.ncols)]
+    jagged_ak = [awkward.unflatten(flat[c], counts) for c in range(options.ncols)]
+
+    t0 = time.perf_counter()
+    old = np.stack([pad_array(a, options.pad_len) for a in jagged_np], axis=-1)
+    t_old = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    new = pad_arrays(jagged_ak, options.pad_len, data_format='channel_last')
+    t_new = time.perf_counter() - t0
+
+    assert np.array_equal(old, new)
+    print("njets={} ncols={} pad_len={} mean_parts={}".format(options.njets, options.ncols, options.pad_len, options.mean_parts))
+    print("pad_array + np.stack: {:8.3f} s".format(t_old))
+    print("pad_arrays:           {:8.3f} s  ({:.1f}x)".format(t_new, t_old / t_new))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+
+# Purpose: end-to-end timing of the pipeline stages on synthetic PF-candidate jets, offline on a CPU:
+#   flatten           data_utils._jet_arrays_to_df, the wide PF_*_0..114 table of prepare_input_dataset
+#   transform         prepare_tagger_inputs._transform of that table
+#   transform_arrays  prepare_tagger_inputs._transform_arrays of the jagged arrays (the convert_root path)
+#   convert           prepare_tagger_inputs.convert, .h5 table to .awkd file
+#   load              load_datasets.Dataset of the .awkd file (parquet read and pad_arrays)
+#   pad_arrays        load_datasets.pad_arrays of the feature groups of the Dataset alone
+#   predict_lite      model.predict of ParticleNet-Lite
+#   predict           model.predict of ParticleNet
+#   root_branches     rootIO.add_branches of the five output branches of keras_predict_multi.py (needs PyROOT)
+# The jets replace the coffea NanoEvents part (_jet_arrays) with a generator of the same arrays. Results are written
+# as JSON; --compare old.json prints the ratio to an earlier run, e.g. of another version of the repository.
+# Run from the repository root: python benchmarks/pipeline.py --jets 10000 --mean_parts 40 --output pipeline.json
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import optparse
+import subprocess
+import numpy as np
+import awkward
+
+STAGES = ['flatten', 'transform', 'transform_arrays', 'convert', 'load', 'pad_arrays', 'predict_lite', 'predict', 'root_branches']
+
+def make_jets(n_jets, mean_parts, seed=0, max_particles=115):
+    """The arrays of data_utils._jet_arrays for n_jets synthetic jets: PF candidates of a jet with pt 200-800 GeV
+    spread around its axis (massless, pt ordered), padded with None to max_particles, truth label -1, 0 or 1"""
+    rng = np.random.default_rng(seed)
+    counts = np.clip(rng.poisson(mean_parts, n_jets), 2, max_particles)
+    # one full jet, as in a large sample, so that every PF_*_i column of the flat table is numeric
+    counts[0] = max_particles
+    n = counts.sum()
+    jet = np.repeat(np.arange(n_jets), counts)
+    jet_pt, jet_eta, jet_phi = rng.uniform(200., 800., n_jets), rng.uniform(-2., 2., n_jets), rng.uniform(-np.pi, np.pi, n_jets)
+    # pt fractions of the candidates, sorted in decreasing order within each jet
+    fraction = rng.exponential(1., n)
+    fraction /= np.bincount(jet, fraction)[jet]
+    order = np.lexsort((-fraction, jet))
+    pt = (fraction * jet_pt[jet])[order]
+    eta = jet_eta[jet] + rng.normal(0., 0.2, n)
+    phi = jet_phi[jet] + rng.normal(0., 0.2, n)
+    px, py, pz = pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta)
+    columns = {'PF_Px': px, 'PF_Py': py, 'PF_Pz': pz, 'PF_E': np.sqrt(px**2 + py**2 + pz**2), 'PF_q': rng.integers(-1, 2, n).astype('float64')}
+    arrays = {k: awkward.pad_none(awkward.unflatten(v, counts), max_particles, clip=True) for k, v in columns.items()}
+    arrays['event_weight'] = rng.normal(1., 0.1, n_jets)
+    arrays['truth_label'] = rng.integers(-1, 2, n_jets)
+    return arrays
+
+def timed(func, repeat, setup=None):
+    """Median and minimum wall time of func() over repeat calls (after setup() if given), and the last result"""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times)), float(np.min(times)), result
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def run(options, stages, tmp):
+    results = {}
+    def record(stage, func, setup=None):
+        try:
+            median, best, result = timed(func, options.repeat, setup)
+        except Exception as e:
+            results[stage] = {'error': '%s: %s' % (type(e).__name__, e)}
+            print("{:<18s} failed: {}".format(stage, results[stage]['error']))
+            return None
+        results[stage] = {'seconds': median, 'min_seconds': best, 'jets_per_s': options.jets / median}
+        print("{:<18s} {:>10.3f} s {:>12.0f} jets/s".format(stage, median, options.jets / median))
+        return result
+
+    arrays = make_jets(options.jets, options.mean_parts, options.seed)
+    needed = set(stages)
+    if needed & {'flatten', 'transform', 'convert', 'load', 'pad_arrays', 'predict_lite', 'predict'}:
+        from data_utils import _jet_arrays_to_df
+        df = (record if 'flatten' in needed else lambda stage, func: func())('flatten', lambda: _jet_arrays_to_df(arrays))
+        if df is None:
+            df = _jet_arrays_to_df(arrays)
+    import prepare_tagger_inputs
+    if 'transform' in needed:
+        record('transform', lambda: prepare_tagger_inputs._transform(df, 'ternary'))
+    if 'transform_arrays' in needed:
+        record('transform_arrays', lambda: prepare_tagger_inputs._transform_arrays(arrays, 'ternary'))
+
+    awkd = os.path.join(tmp, 'converted', 'jets_0.awkd')
+    if needed & {'convert', 'load', 'pad_arrays', 'predict_lite', 'predict'}:
+        h5 = os.path.join(tmp, 'jets.h5')
+        df.to_hdf(h5, key='table', mode='w')
+        def clean():
+            shutil.rmtree(os.path.join(tmp, 'converted'), ignore_errors=True)
+        if 'convert' not in needed or record('convert', lambda: prepare_tagger_inputs.convert(h5, os.path.join(tmp, 'converted'), 'jets', 'ternary'), setup=clean) is None:
+            clean()
+            prepare_tagger_inputs.convert(h5, os.path.join(tmp, 'converted'), 'jets', 'ternary')
+
+    if needed & {'load', 'pad_arrays', 'predict_lite', 'predict'}:
+        from load_datasets import Dataset, pad_arrays
+        dataset = record('load', lambda: Dataset(awkd, data_format='channel_last')) if 'load' in needed else None
+        if dataset is None:
+            dataset = Dataset(awkd, data_format='channel_last')
+        if 'pad_arrays' in needed:
+            a = awkward.from_parquet(awkd)
+            groups = [v if isinstance(v, (list, tuple)) else [v] for k, v in dataset.feature_dict.items() if k != 'add_features']
+            record('pad_arrays', lambda: [pad_arrays([a[c] for c in cols], dataset.pad_len, data_format='channel_last') for cols in groups])
+
+        for stage, model_type in [('predict_lite', 'particle_net_lite'), ('predict', 'particle_net')]:
+            if stage not in needed:
+                continue
+            from tensorflow import keras
+            from tf_keras_model import get_particle_net, get_particle_net_lite
+            from bucketing import randomize_bn
+            keras.utils.set_random_seed(0)
+            get_model = get_particle_net_lite if model_type == 'particle_net_lite' else get_particle_net
+            model = get_model(dataset.y.shape[1], {k: dataset[k].shape[1:] for k in dataset.X}, num_points=dataset.pad_len)
+            randomize_bn(model)
+            X = dataset.X
+            # the first call traces the prediction function
+            model.predict(X, batch_size=options.batch_size, verbose=0)
+            record(stage, lambda: model.predict(X, batch_size=options.batch_size, verbose=0))
+
+    if 'root_branches' in needed:
+        def add_branches():
+            import rootIO
+            scores = np.random.default_rng(0).random((options.jets, 3))
+            branches = {'score_%d' % i: scores[:, i] for i in range(3)}
+            branches.update({'label': np.argmax(scores, axis=1), 'score_max': scores.max(axis=1)})
+            return rootIO.add_branches(tree, 'Events', branches, ofilename=os.path.join(tmp, 'events_scored.root'))
+        try:
+            import uproot
+            tree = os.path.join(tmp, 'events.root')
+            with uproot.recreate(tree) as f:
+                f.mktree('Events', {'FatJet_pt': 'float64'}).extend({'FatJet_pt': np.random.default_rng(0).uniform(200., 800., options.jets)})
+            # the first call compiles the fill function of rootIO
+            add_branches()
+            record('root_branches', add_branches)
+        except Exception as e:
+            results['root_branches'] = {'error': '%s: %s' % (type(e).__name__, e)}
+            print("{:<18s} failed: {}".format('root_branches', results['root_branches']['error']))
+    return results
+
+def compare(results, options, reference, threshold):
+    """Print the slowdown of each stage relative to the reference report, in time per jet"""
+    for k in ['jets', 'mean_parts', 'batch_size']:
+        if reference['meta']['options'].get(k) != getattr(options, k):
+            print("Warning: {} was {} in the earlier run, {} now".format(k, reference['meta']['options'].get(k), getattr(options, k)))
+    print("{:<18s} {:>12s} {:>12s} {:>8s}".format("stage", "before jets/s", "now jets/s", "slowdown"))
+    for stage, r in results.items():
+        old = reference.get('stages', {}).get(stage, {})
+        if 'jets_per_s' not in r or 'jets_per_s' not in old:
+            continue
+        ratio = old['jets_per_s'] / r['jets_per_s']
+        print("{:<18s} {:>12.0f} {:>12.0f} {:>7.2f}x {}".format(stage, old['jets_per_s'], r['jets_per_s'], ratio, 'slower' if ratio > threshold else ''))
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--jets", type="int", default= 10000)
+    parser.add_option("--mean_parts", type="float", help = "mean number of PF candidates per jet", default= 40.)
+    parser.add_option("--seed", type="int", default= 0)
+    parser.add_option("--repeat", type="int", help = "timed runs of each stage, the median is reported", default= 3)
+    parser.add_option("--batch_size", type="int", help = "batch size of model.predict, as in keras_predict_multi.py", default= 32)
+    parser.add_option("--stages", help = "comma separated subset of " + ",".join(STAGES), default= ",".join(STAGES))
+    parser.add_option("--output", help = "JSON result file", default= None)
+    parser.add_option("--compare", help = "JSON result file of an earlier run", default= None)
+    parser.add_option("--threshold", type="float", help = "slowdown relative to the earlier run reported as slower", default= 1.1)
+    (options,args) = parser.parse_args()
+
+    stages = options.stages.split(',')
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error('unknown stages %s' % ','.join(sorted(unknown)))
+    print("jets={} mean_parts={} repeat={} cores={}".format(options.jets, options.mean_parts, options.repeat, len(os.sched_getaffinity(0))))
+    tmp = tempfile.mkdtemp()
+    try:
+        results = run(options, stages, tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    import tensorflow as tf
+    report = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'commit': _git_commit(),
+                       'host': platform.node(),
+                       'platform': platform.platform(),
+                       'processor': platform.processor(),
+                       'cores': len(os.sched_getaffinity(0)),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'awkward': awkward.__version__,
+                       'tensorflow': tf.__version__,
+                       'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+                       'options': vars(options)},
+              'stages': results}
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print("Results in {}".format(options.output))
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, options, json.load(f), options.threshold)
+
+if __name__ == "__main__":
+    main()
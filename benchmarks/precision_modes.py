@@ -0,0 +1,69 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+
+# Purpose: CPU benchmark of the training and prediction steps of ParticleNet(-Lite) with and without XLA and with
+# mixed precision policies (the --xla and --mixed_precision switches of keras_train_multi/keras_predict_multi),
+# and numeric parity of the predictions with the float32 model.
+# Run from the repository root: python benchmarks/precision_modes.py --modes float32,float32+xla,mixed_bfloat16,mixed_bfloat16+xla
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import optparse
+import numpy as np
+from tensorflow import keras
+from tf_keras_model import get_particle_net, get_particle_net_lite, copy_weights
+from edge_conv import make_inputs, randomize_bn
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--model", help = "particle_net_lite or particle_net", default= "particle_net_lite")
+    parser.add_option("--modes", help = "comma separated policy[+xla]", default= "float32,float32+xla,mixed_bfloat16,mixed_bfloat16+xla")
+    parser.add_option("--jets", type="int", default= 4096)
+    parser.add_option("--batch_size", type="int", default= 256)
+    parser.add_option("--train_steps", type="int", default= 10)
+    parser.add_option("--tolerance", type="float", help = "maximum absolute difference of the scores to float32", default= 0.05)
+    (options,args) = parser.parse_args()
+
+    get_model = get_particle_net_lite if 'lite' in options.model else get_particle_net
+    input_shapes = {'points': (100, 2), 'features': (100, 6), 'mask': (100, 1)}
+    X = make_inputs(options.jets, input_shapes)
+    y = np.eye(3, dtype='float32')[np.random.default_rng(0).integers(0, 3, options.jets)]
+    reference = get_model(3, input_shapes)
+    randomize_bn(reference)
+    reference_scores = reference.predict(X, batch_size=options.batch_size, verbose=0)
+
+    print("model={} jets={} batch_size={}".format(options.model, options.jets, options.batch_size))
+    print("{:>20s} {:>14s} {:>14s} {:>16s} {:>12s} {:>10s}".format("mode", "train steps/s", "train jets/s", "predict jets/s", "max |diff|", "agreement"))
+    failed = False
+    for mode in options.modes.split(','):
+        policy, _, xla = mode.partition('+')
+        keras.mixed_precision.set_global_policy(policy)
+        model = get_model(3, input_shapes)
+        copy_weights(reference, model)
+        model.compile(loss='categorical_crossentropy', optimizer=keras.optimizers.Adam(learning_rate=1e-4), jit_compile=bool(xla))
+
+        model.predict(X, batch_size=options.batch_size, verbose=0)  # trace/compile
+        t0 = time.perf_counter()
+        scores = model.predict(X, batch_size=options.batch_size, verbose=0)
+        predict_rate = options.jets / (time.perf_counter() - t0)
+        diff = np.max(np.abs(scores - reference_scores))
+        agreement = np.mean(np.argmax(scores, axis=1) == np.argmax(reference_scores, axis=1))
+        failed |= diff > options.tolerance
+
+        n_train = options.train_steps * options.batch_size
+        Xt = {k:np.resize(v, (n_train,) + v.shape[1:]) for k, v in X.items()}
+        yt = np.resize(y, (n_train, 3))
+        model.fit({k:v[:options.batch_size] for k, v in Xt.items()}, yt[:options.batch_size], batch_size=options.batch_size, verbose=0)  # trace/compile
+        t0 = time.perf_counter()
+        model.fit(Xt, yt, batch_size=options.batch_size, shuffle=False, verbose=0)
+        train_time = time.perf_counter() - t0
+        print("{:>20s} {:>14.2f} {:>14.0f} {:>16.0f} {:>12.2e} {:>9.2%}".format(mode, options.train_steps / train_time, n_train / train_time, predict_rate, diff, agreement))
+    keras.mixed_precision.set_global_policy('float32')
+    if failed:
+        print("max |diff| above {} for some modes".format(options.tolerance))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+
+# Purpose: compare the throughput of rootIO.add_branches (full copy and friend-tree mode) with the per-entry
+# GetEntry/Fill loop that add_branch/add_fourbranches/add_fivebranches used before, on a synthetic tree.
+# Run from the repository root: python benchmarks/rootIO_branches.py --entries 1000000
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import tempfile
+import optparse
+from array import array
+import numpy as np
+import ROOT
+from ROOT import TFile
+import rootIO
+
+def make_tree(filename, treename, n_entries, n_branches):
+    df = ROOT.RDataFrame(n_entries)
+    for i in range(n_branches):
+        df = df.Define('var%d' % i, 'gRandom->Gaus()')
+    df.Snapshot(treename, filename)
+
+def add_branches_per_entry(filename, treename, branches, ofilename):
+    # reference: the loop of the previous add_*branches implementations
+    ifile = TFile(filename,'READ')
+    itree = ifile.Get(treename)
+    ofile = TFile(ofilename,'RECREATE')
+    otree = itree.CloneTree()
+    otree.Write()
+    helpers = []
+    for branchname, data in branches.items():
+        y_helper = array('d',[0])
+        helpers.append((y_helper, otree.Branch(branchname, y_helper, branchname + '/D'), data))
+    for i in range(otree.GetEntries()):
+        otree.GetEntry(i)
+        for y_helper, branch, data in helpers:
+            y_helper[0] = data[i]
+            branch.Fill()
+    ofile.Write("",TFile.kOverwrite)
+    ifile.Close()
+    ofile.Close()
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--entries", type="int", help = "number of tree entries", default= 200000)
+    parser.add_option("--input_branches", type="int", help = "number of branches of the input tree", default= 50)
+    parser.add_option("--new_branches", help = "comma separated numbers of branches to add", default= "1,3,5")
+    (options,args) = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'bench.root')
+    make_tree(filename, 'Events', options.entries, options.input_branches)
+    print("entries={} input branches={} input size={:.1f} MB".format(options.entries, options.input_branches, os.path.getsize(filename) / 1e6))
+    print("{:>12s} {:>14s} {:>14s} {:>8s} {:>11s} {:>12s}".format("new branches", "per-entry [s]", "bulk [s]", "speedup", "friend [s]", "friend [MB]"))
+
+    rng = np.random.default_rng(42)
+    for n in [int(x) for x in options.new_branches.split(',')]:
+        branches = {'jetchargetagger_score%d' % i: rng.random(options.entries) for i in range(n)}
+
+        t0 = time.perf_counter()
+        add_branches_per_entry(filename, 'Events', branches, os.path.join(tmpdir, 'old.root'))
+        t_old = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        rootIO.add_branches(filename, 'Events', branches, ofilename=os.path.join(tmpdir, 'new.root'))
+        t_new = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        ofriend = rootIO.add_branches(filename, 'Events', branches, ofilename=os.path.join(tmpdir, 'friend.root'), friend=True)
+        t_friend = time.perf_counter() - t0
+
+        print("{:>12d} {:>14.2f} {:>14.2f} {:>7.1f}x {:>11.2f} {:>12.1f}".format(n, t_old, t_new, t_old / t_new, t_friend, os.path.getsize(ofriend) / 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+
+# Purpose: scaling of the data-parallel CPU training of keras_train_multi.py --workers N (distributed_training.py):
+# training steps/s and jets/s of ParticleNet-Lite on synthetic jets for 1, 2, 4 and 8 local workers at the same
+# global batch size, and the loss after the same steps, which should not depend on the number of workers.
+# Run from the repository root: python benchmarks/worker_scaling.py --workers_list 1,2,4,8
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import json
+import time
+import tempfile
+import optparse
+import numpy as np
+
+def worker(options):
+    from distributed_training import configure_worker, sampler_dataset
+    strategy = configure_worker(options.workers, options.worker_index)
+    from tensorflow import keras
+    from load_datasets import Dataset, BatchSampler
+    from tf_keras_model import get_particle_net_lite
+
+    dataset = Dataset(options.data, data_format='channel_last')
+    batches = BatchSampler(dataset, options.batch_size, seed=0, shard=(options.worker_index, options.workers))
+    keras.utils.set_random_seed(0)
+    with strategy.scope():
+        model = get_particle_net_lite(dataset.y.shape[1], {k:dataset[k].shape[1:] for k in dataset.X}, num_points=dataset.pad_len)
+        model.compile(loss='categorical_crossentropy', optimizer=keras.optimizers.Adam(learning_rate=1e-3))
+
+    class Timer(keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self.t0 = time.perf_counter()
+        def on_epoch_end(self, epoch, logs=None):
+            self.elapsed = time.perf_counter() - self.t0
+
+    timer = Timer()
+    # the first epoch traces the step function and fills the all-reduce buffers
+    history = model.fit(strategy.distribute_datasets_from_function(lambda context: sampler_dataset(batches)),
+                        steps_per_epoch=options.steps, epochs=2, callbacks=[timer], verbose=0)
+    if options.worker_index == 0:
+        with open(options.result, 'w') as f:
+            json.dump({'time': timer.elapsed, 'loss': history.history['loss'][-1]}, f)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--workers_list", help = "comma separated numbers of workers", default= "1,2,4,8")
+    parser.add_option("--jets", type="int", default= 8192)
+    parser.add_option("--mean_parts", type="float", help = "mean number of particles per jet", default= 40)
+    parser.add_option("--batch_size", type="int", help = "global batch size", default= 1024)
+    parser.add_option("--steps", type="int", help = "timed training steps", default= 8)
+    # set for the workers
+    parser.add_option("--workers", type="int", default= 1)
+    parser.add_option("--worker_index", type="int", default= None)
+    parser.add_option("--data", default= None)
+    parser.add_option("--result", default= None)
+    (options,args) = parser.parse_args()
+    if options.worker_index is not None:
+        worker(options)
+        return
+
+    from distributed_training import launch_workers
+    from bucketing import write_jets
+    tmpdir = tempfile.mkdtemp()
+    data = os.path.join(tmpdir, 'jets.awkd')
+    write_jets(data, options.jets, options.mean_parts)
+    result = os.path.join(tmpdir, 'result.json')
+    print("jets={} global batch={} steps={} cores={}".format(options.jets, options.batch_size, options.steps, len(os.sched_getaffinity(0))))
+    print("{:>8s} {:>14s} {:>10s} {:>10s} {:>9s} {:>11s} {:>10s}".format("workers", "jets/worker", "steps/s", "jets/s", "speedup", "efficiency", "loss"))
+    base = None
+    for n in [int(w) for w in options.workers_list.split(',')]:
+        command = [os.path.abspath(__file__), '--workers', str(n), '--data', data, '--result', result,
+                   '--batch_size', str(options.batch_size), '--steps', str(options.steps)]
+        if launch_workers(command, n, log_dir=tmpdir) != 0:
+            print("{:>8d} failed, see {}".format(n, tmpdir))
+            continue
+        with open(result) as f:
+            r = json.load(f)
+        rate = options.steps / r['time']
+        base = base or rate
+        print("{:>8d} {:>14d} {:>10.2f} {:>10.0f} {:>8.2f}x {:>10.0%} {:>10.4f}".format(n, options.batch_size // n, rate, rate * options.batch_size,
+              rate / base, rate / base / n, r['loss']))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+#
+# Data-parallel CPU training with several local worker processes and tf.distribute.MultiWorkerMirroredStrategy.
+# launch_workers starts the workers (the same script with --worker_index) with a TF_CONFIG for a cluster on localhost,
+# configure_worker pins every worker to its share of the cores and creates the strategy. The gradients are averaged
+# over the workers in every step by ring all-reduce.
+#
+# The workers read their part of every global batch from a sharded load_datasets.BatchSampler (shard=(index, count)),
+# so that a step of all workers together trains on the same jets as a step of the single-process training with the
+# same batch size. The number of steps per epoch and the learning rate schedule are therefore unchanged.
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import subprocess
+import logging
+
+def free_ports(n):
+    """n free TCP ports on localhost"""
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+def launch_workers(command, num_workers, log_dir=None, poll=1., grace=10.):
+    """Run num_workers copies of command (a list, e.g. sys.argv with the script first) with --worker_index 0..num_workers-1
+    appended and the TF_CONFIG of a localhost cluster. Worker 0 (the chief) writes to the terminal, the others to
+    log_dir/worker_<i>.log (or nowhere). If a worker fails the others are stopped (killed after grace s), all of
+    them if the launcher gets SIGTERM. Returns the exit code."""
+    ports = free_ports(num_workers)
+    cluster = {'worker': ['localhost:%d' % port for port in ports]}
+    if log_dir is not None:
+        os.makedirs(log_dir, exist_ok=True)
+    processes = []
+    for index in range(num_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': index}}))
+        if index == 0:
+            stdout = None
+        elif log_dir is not None:
+            stdout = open(os.path.join(log_dir, 'worker_%d.log' % index), 'w')
+        else:
+            stdout = subprocess.DEVNULL
+        processes.append(subprocess.Popen([sys.executable] + list(command) + ['--worker_index', str(index)], env=env,
+                                          stdout=stdout, stderr=subprocess.STDOUT if stdout is not None else None))
+    logging.info('Started %d workers on %s' % (num_workers, ', '.join(cluster['worker'])))
+    def _on_sigterm(signum, frame):
+        raise SystemExit(128 + signum)
+    # a preempted launcher stops its workers
+    previous_handler = signal.signal(signal.SIGTERM, _on_sigterm)
+    try:
+        while True:
+            codes = [p.poll() for p in processes]
+            failed = [(i, code) for i, code in enumerate(codes) if code not in (None, 0)]
+            if failed:
+                logging.error('Worker %d exited with %d, stopping the others' % failed[0])
+                return failed[0][1]
+            if all(code == 0 for code in codes):
+                return 0
+            time.sleep(poll)
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for p in processes:
+            if p.poll() is None:
+                p.terminate()
+        for p in processes:
+            try:
+                p.wait(timeout=grace)
+            except subprocess.TimeoutExpired:
+                # the workers of a MultiWorkerMirroredStrategy catch SIGTERM (TensorFlow's preemption notifier)
+                p.kill()
+                p.wait()
+        signal.signal(signal.SIGTERM, previous_handler)
+
+def worker_cores(num_workers, index):
+    """The cores of worker index: an equal share of the cores this process may run on"""
+    cores = sorted(os.sched_getaffinity(0))
+    return cores[index * len(cores) // num_workers:(index + 1) * len(cores) // num_workers] or [cores[index % len(cores)]]
+
+def configure_worker(num_workers, index):
+    """Pin this worker to its cores, limit the TensorFlow thread pools to them and create the strategy. Must be called
+    before TensorFlow runs anything, TF_CONFIG is set by launch_workers."""
+    import tensorflow as tf
+    cores = worker_cores(num_workers, index)
+    os.sched_setaffinity(0, cores)
+    tf.config.threading.set_intra_op_parallelism_threads(len(cores))
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+    tf.config.set_visible_devices([], 'GPU')
+    communication = tf.distribute.experimental.CommunicationOptions(implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    strategy = tf.distribute.MultiWorkerMirroredStrategy(communication_options=communication)
+    if strategy.num_replicas_in_sync != num_workers:
+        raise RuntimeError('%d replicas in sync, expected %d workers' % (strategy.num_replicas_in_sync, num_workers))
+    logging.info('Worker %d of %d on cores %s' % (index, num_workers, cores))
+    return strategy
+
+def sampler_dataset(sampler, start=0):
+    """tf.data.Dataset of the batches of a (sharded) BatchSampler, from batch start of its first epoch, to be distributed
+    with strategy.distribute_datasets_from_function: every worker keeps its own batches, nothing is re-sharded."""
+    import tensorflow as tf
+    dataset = sampler.dataset
+    X, y = dataset.X, dataset.y
+    # channel_last arrays, with a variable number of particles for bucketed batches
+    x_spec = {k:tf.TensorSpec((None,) + ((None,) + v.shape[2:] if sampler.buckets is not None and k != 'add_features' else v.shape[1:]), tf.as_dtype(v.dtype)) for k, v in X.items()}
+    y_spec = tf.TensorSpec((None,) + y.shape[1:], tf.as_dtype(y.dtype))
+    batches = tf.data.Dataset.from_generator(lambda: sampler.batches(start), output_signature=(x_spec, y_spec))
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    return batches.with_options(options).prefetch(2)
@@ -0,0 +1,127 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+#
+# Export the trained taggers to inference-only artifacts: the BatchNormalization after each 1x1 convolution is folded
+# into the convolution, dropout is removed and the weights are frozen into the graph as constants.
+# The artifacts accept any number of particles up to the pad length of the training and are run with exported_model.ExportedModel.
+#
+# python export_model.py --year UL18 [--onnx] [--parity_file preprocessing/ternary_training/UL18/Eval/converted/Eval_TTCR_TT_UL18_0.awkd]
+
+import os
+import sys
+import json
+import time
+import hashlib
+import optparse
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+from tf_keras_model import get_particle_net, get_particle_net_lite, fold_batchnorm
+from exported_model import ExportedModel
+from model_registry import get_registry
+
+def inference_model(model, lite=True):
+    """Inference version of a trained ParticleNet(-Lite), for any number of particles, with its BatchNorms folded"""
+    input_shapes = {i.name.split(':')[0]:(None,) + tuple(i.shape[2:]) for i in model.inputs}
+    num_points = model.inputs[0].shape[1]
+    get_model = get_particle_net_lite if lite else get_particle_net
+    inference = get_model(model.output_shape[-1], input_shapes, num_points=num_points, inference=True)
+    fold_batchnorm(model, inference)
+    return inference, num_points
+
+def export(checkpoint, outdir, onnx=False, opset=13):
+    """Write the frozen SavedModel (and model.onnx) of checkpoint to outdir, returns the Keras model of the checkpoint"""
+    model = keras.models.load_model(checkpoint)
+    inference, num_points = inference_model(model, lite='lite' in os.path.basename(checkpoint))
+    names = [i.name.split(':')[0] for i in model.inputs]
+    signature = [tf.TensorSpec((None, None) + tuple(i.shape[2:]), tf.float32, name=name) for name, i in zip(names, model.inputs)]
+
+    @tf.function(input_signature=signature)
+    def serve(*inputs):
+        return {'scores': inference(dict(zip(names, inputs)), training=False)}
+
+    frozen = convert_variables_to_constants_v2(serve.get_concrete_function())
+    saved_model = os.path.join(outdir, 'saved_model')
+    tf.saved_model.save(tf.Module(), saved_model, signatures=frozen)
+
+    with open(checkpoint, 'rb') as f:
+        checkpoint_hash = hashlib.sha1(f.read()).hexdigest()
+    info = {'checkpoint': os.path.abspath(checkpoint), 'checkpoint_sha1': checkpoint_hash, 'inputs': names,
+            'num_points': num_points, 'num_classes': model.output_shape[-1]}
+    with open(os.path.join(saved_model, 'export_info.json'), 'w') as f:
+        json.dump(info, f, indent=2)
+
+    if onnx:
+        import tf2onnx
+        # from the frozen graph, so that no captured tensor of the Keras graph is left as an extra input
+        tf2onnx.convert.from_graph_def(frozen.graph.as_graph_def(), input_names=[t.name for t in frozen.inputs], output_names=[t.name for t in frozen.outputs],
+                                       opset=opset, output_path=os.path.join(outdir, 'model.onnx'))
+        with open(os.path.join(outdir, 'export_info.json'), 'w') as f:
+            json.dump(info, f, indent=2)
+    return model
+
+def parity_inputs(model, parity_file=None, n_jets=2000, seed=0):
+    """Inputs for the parity check: the first n_jets of parity_file, or random jets with 1 to pad length particles"""
+    if parity_file is not None:
+        from load_datasets import Dataset
+        dataset = Dataset(parity_file, data_format='channel_last', load_evalset=True)
+        return {k:v[:n_jets] for k, v in dataset.X.items()}
+    rng = np.random.default_rng(seed)
+    num_points = model.inputs[0].shape[1]
+    valid = (np.arange(num_points) < rng.integers(1, num_points + 1, n_jets)[:, None])[..., None].astype('float32')
+    X = {i.name.split(':')[0]:rng.standard_normal((n_jets,) + tuple(i.shape[1:])).astype('float32') * valid for i in model.inputs}
+    X['mask'] = valid * (np.abs(X['mask']) + 1e-3)
+    return X
+
+def parity_check(model, exported, X, tolerance, batch_size=1024):
+    """Compare the scores of the Keras model and the exported model: maximum absolute difference, fraction of jets
+    with a difference above tolerance and jets/s of both"""
+    exported.predict_on_batch({k:v[:1] for k, v in X.items()})  # warm up
+    t0 = time.perf_counter()
+    reference = model.predict(X, batch_size=batch_size, verbose=0)
+    t_keras = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    output = exported.predict(X, batch_size=batch_size)
+    t_exported = time.perf_counter() - t0
+    n = len(output)
+    diff = np.max(np.abs(reference - output), axis=1)
+    return float(np.max(diff)), float(np.mean(diff > tolerance)), n / t_keras, n / t_exported
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--year", help = "Comma separated years: UL16preVFP, UL16postVFP, UL17, UL18 (default: all years in the model registry)", default= None)
+    parser.add_option("--epoch", help = "Checkpoint epoch, or best", default= "best")
+    parser.add_option("--checkpoint", help = "Export this .h5 checkpoint instead of the one of --year (single year only)", default= None)
+    parser.add_option("--outdir", help = "Output directory, {year} is replaced by the year", default= "./modelfiles/{year}/exported")
+    parser.add_option("--onnx", action="store_true", help = "Also write model.onnx (needs tf2onnx, run it with onnxruntime)", default= False)
+    parser.add_option("--opset", type="int", help = "ONNX opset", default= 13)
+    parser.add_option("--parity_file", help = "Converted .awkd file for the parity check (default: random jets)", default= None)
+    parser.add_option("--tolerance", type="float", help = "Maximum absolute difference of the scores in the parity check", default= 1e-4)
+    # the folded convolutions round differently, which can swap two nearly equidistant neighbours of a particle
+    parser.add_option("--max_outliers", type="float", help = "Maximum fraction of jets above --tolerance in the parity check", default= 1e-3)
+    (options,args) = parser.parse_args()
+
+    registry = get_registry()
+    years = options.year.split(',') if options.year else registry.years()
+    if options.checkpoint and len(years) > 1:
+        parser.error('--checkpoint needs a single --year')
+    failed = False
+    for year in years:
+        checkpoint = options.checkpoint or registry.path(year, options.epoch)
+        outdir = options.outdir.format(year=year)
+        print ("********************* Exporting {} to {} *****************************".format(checkpoint, outdir))
+        model = export(checkpoint, outdir, onnx=options.onnx, opset=options.opset)
+        X = parity_inputs(model, options.parity_file)
+        artifacts = [os.path.join(outdir, 'saved_model')] + ([os.path.join(outdir, 'model.onnx')] if options.onnx else [])
+        for artifact in artifacts:
+            diff, outliers, keras_rate, exported_rate = parity_check(model, ExportedModel(artifact), X, options.tolerance)
+            status = 'OK' if outliers <= options.max_outliers else 'FAILED'
+            failed |= outliers > options.max_outliers
+            print ("{}: max |diff| {:.2e}, {:.2%} of the jets above {:g}: {}. Keras {:.0f} jets/s, exported {:.0f} jets/s".format(
+                artifact, diff, outliers, options.tolerance, status, keras_rate, exported_rate))
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+#
+# CPU runner for the inference-only models written by export_model.py: a frozen SavedModel directory or an .onnx file.
+# Neither Keras nor the training graph is needed, TensorFlow (or onnxruntime for .onnx) is imported only when a model is loaded.
+
+import os
+import json
+import numpy as np
+
+class ExportedModel(object):
+    """Tagger exported by export_model.py.
+
+    path: the SavedModel directory or the .onnx file. The inputs are the padded 'points', 'features' and 'mask'
+        arrays in channel_last format, with any number of particles up to the pad length of the training.
+    """
+
+    def __init__(self, path, threads=None):
+        self.path = path
+        info_file = os.path.join(os.path.dirname(os.path.abspath(path)) if path.endswith('.onnx') else path, 'export_info.json')
+        self.info = {}
+        if os.path.exists(info_file):
+            with open(info_file) as f:
+                self.info = json.load(f)
+        if path.endswith('.onnx'):
+            import onnxruntime
+            opts = onnxruntime.SessionOptions()
+            if threads:
+                opts.intra_op_num_threads = threads
+            self._session = onnxruntime.InferenceSession(path, opts, providers=['CPUExecutionProvider'])
+            # tensor names of the frozen graph, e.g. 'points:0'
+            self._onnx_names = [i.name for i in self._session.get_inputs()]
+            self.input_names = [name.split(':')[0] for name in self._onnx_names]
+            self.num_classes = self._session.get_outputs()[0].shape[-1]
+        else:
+            import tensorflow as tf
+            if threads:
+                tf.config.threading.set_intra_op_parallelism_threads(threads)
+            self._tf = tf
+            self._module = tf.saved_model.load(path)
+            self._signature = self._module.signatures['serving_default']
+            self.input_names = sorted(self._signature.structured_input_signature[1])
+            self.num_classes = list(self._signature.structured_outputs.values())[0].shape[-1]
+
+    def predict_on_batch(self, X):
+        inputs = {k:np.asarray(X[k], dtype='float32') for k in self.input_names}
+        if hasattr(self, '_session'):
+            return self._session.run(None, {onnx_name:inputs[k] for onnx_name, k in zip(self._onnx_names, self.input_names)})[0]
+        outputs = self._signature(**{k:self._tf.constant(v) for k, v in inputs.items()})
+        return list(outputs.values())[0].numpy()
+
+    def predict(self, X, batch_size=1024):
+        """Scores of all jets of X, a dict of arrays as Dataset.X, in batches of batch_size"""
+        n = len(X[self.input_names[0]])
+        output = np.empty((n, self.num_classes), dtype='float32')
+        for start in range(0, n, batch_size):
+            output[start:start + batch_size] = self.predict_on_batch({k:X[k][start:start + batch_size] for k in self.input_names})
+        return output
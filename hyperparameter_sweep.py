@@ -0,0 +1,239 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+#
+# Hyperparameter sweep over the ParticleNet settings of tf_keras_model.py: short trainings of many configurations in a
+# process pool, and a table of the validation accuracy against the inference cost of each.
+#
+# A configuration sets the EdgeConv blocks (K neighbours, width of the first block, number of blocks; every block is
+# twice as wide as the one before, ParticleNet-Lite is k=7 width=32 blocks=2), the fully connected layer, the pooling
+# of the EdgeConvs, the batch size and the pad length (the jets are truncated to their first pad_len particles).
+#
+# The padded train/val tensors are written once to --cache_dir (load_datasets.Dataset), every worker memory-maps the
+# same read-only files, so the page cache holds one copy of the data for all workers. Every worker runs on its share of
+# the cores with a bounded number of TensorFlow threads. The inference cost is measured afterwards, one configuration
+# at a time on all cores, with untrained weights of the inference model (the cost does not depend on the weights).
+#
+# python hyperparameter_sweep.py --year UL18 --samples 24 --workers 4 --epochs 3 --min_accuracy 0.6
+
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import optparse
+import multiprocessing
+import logging
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
+
+# values of each setting, the first one is that of ParticleNet-Lite (pad_len None: that of the converted files)
+SPACE = {
+    'k': [7, 5, 10, 16],
+    'width': [32, 16, 64],
+    'blocks': [2, 1, 3],
+    'fc': [128, 64, 256],
+    'pooling': ['average', 'max'],
+    'batch_size': [1024, 512],
+    'pad_len': [None, 50, 70],
+}
+
+def config_name(config):
+    return 'k{k}-w{width}-b{blocks}-fc{fc}-{pooling}-bs{batch_size}-p{pad_len}'.format(**config)
+
+def conv_params(config):
+    return [(config['k'], (config['width'] * 2**i,) * 3) for i in range(config['blocks'])]
+
+def make_configs(space, samples=None, seed=0, pad_len=100):
+    """All combinations of the values in space, or samples of them drawn at random. The first configuration is always
+    the one of the first values (ParticleNet-Lite)."""
+    space = {k: [pad_len if v is None and k == 'pad_len' else v for v in values] for k, values in space.items()}
+    keys = sorted(space)
+    grid = [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+    reference = {k: space[k][0] for k in keys}
+    others = [c for c in grid if c != reference]
+    if samples is not None and samples - 1 < len(others):
+        others = random.Random(seed).sample(others, max(samples - 1, 0))
+    return [reference] + others
+
+def inference_macs(config, coord_dim, feature_dim, num_classes):
+    """Approximate multiply-accumulates per jet of the inference model: distance matrices, 1x1 convolutions of the
+    EdgeConvs (the first one per particle, see tf_keras_model.edge_conv), shortcuts and the fully connected layers"""
+    n = config['pad_len']
+    macs = 0
+    dim, c_in = coord_dim, feature_dim
+    for K, channels in conv_params(config):
+        macs += n * n * dim
+        macs += n * 2 * 2 * c_in * channels[0]
+        macs += n * K * sum(a * b for a, b in zip(channels[:-1], channels[1:]))
+        macs += n * c_in * channels[-1]
+        dim = c_in = channels[-1]
+    return macs + c_in * config['fc'] + config['fc'] * num_classes
+
+def _build(config, input_shapes, num_classes, inference=False):
+    from tf_keras_model import get_particle_net_lite
+    shapes = {k: (config['pad_len'],) + tuple(v[1:]) if k != 'add_features' else v for k, v in input_shapes.items()}
+    return get_particle_net_lite(num_classes, shapes, num_points=config['pad_len'], inference=inference,
+                                 conv_params=conv_params(config), conv_pooling=config['pooling'], fc_params=[(config['fc'], 0.1)])
+
+# the datasets of a worker process, memory-mapped from the cache
+_data = {}
+
+def _init_worker(cores_queue, threads, train_file, val_file, cache_dir):
+    """Pin the worker to its cores and bound its threads before TensorFlow starts, open the cached datasets"""
+    cores = cores_queue.get()
+    os.sched_setaffinity(0, cores)
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads or len(cores))
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    tf.config.set_visible_devices([], 'GPU')
+    from load_datasets import Dataset
+    _data['train'] = Dataset(train_file, data_format='channel_last', cache_dir=cache_dir)
+    _data['val'] = Dataset(val_file, data_format='channel_last', cache_dir=cache_dir) if val_file else None
+
+def _train(config, epochs, steps_per_epoch, learning_rate, seed):
+    """Short training of one configuration, returns its result (with 'error' if it failed)"""
+    from tensorflow import keras
+    from load_datasets import BatchSampler
+    result = {'name': config_name(config), 'config': config}
+    try:
+        keras.backend.clear_session()
+        keras.utils.set_random_seed(seed)
+        train, val = _data['train'], _data['val']
+        input_shapes = {k: train[k].shape[1:] for k in train.X}
+        model = _build(config, input_shapes, train.y.shape[1])
+        model.compile(loss='categorical_crossentropy', optimizer=keras.optimizers.Adam(learning_rate=learning_rate), metrics=['accuracy'])
+        # a single bucket of the pad length truncates every jet to it
+        buckets = [config['pad_len']]
+        train_batches = BatchSampler(train, config['batch_size'], seed=seed, buckets=buckets)
+        steps = min(steps_per_epoch or len(train_batches), len(train_batches))
+        t0 = time.perf_counter()
+        history = model.fit(iter(train_batches), steps_per_epoch=steps, epochs=epochs, verbose=0)
+        train_time = time.perf_counter() - t0
+        val_batches = BatchSampler(val if val is not None else train, config['batch_size'], seed=seed, buckets=buckets)
+        val_loss, val_accuracy = model.evaluate(iter(val_batches), steps=len(val_batches), verbose=0)
+        result.update({'params': int(model.count_params()),
+                       'loss': float(history.history['loss'][-1]),
+                       'val_loss': float(val_loss),
+                       'val_accuracy': float(val_accuracy),
+                       'train_time': train_time,
+                       'train_jets_per_s': epochs * steps * config['batch_size'] / train_time})
+    except Exception as e:
+        logging.exception('Configuration %s failed' % result['name'])
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    return result
+
+def _time_inference(config, batch_size, repeats):
+    """Median time per jet in us of the inference model on batch_size jets of the validation set"""
+    import numpy as np
+    import tensorflow as tf
+    from tensorflow import keras
+    keras.backend.clear_session()
+    data = _data['val'] if _data['val'] is not None else _data['train']
+    X, _, _ = data.take(np.arange(min(batch_size, len(data))), config['pad_len'])
+    model = _build(config, {k: data[k].shape[1:] for k in data.X}, data.y.shape[1] if data.y is not None else 3, inference=True)
+    predict = tf.function(lambda x: model(x, training=False))
+    inputs = {t.name: tf.constant(X[t.name]) for t in model.inputs}
+    predict(inputs)
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        predict(inputs).numpy()
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times)) / len(X['points']) * 1e6
+
+def pareto_front(results):
+    """Names of the configurations that no other one beats in both validation accuracy and inference time"""
+    ok = [r for r in results if 'error' not in r]
+    return {r['name'] for r in ok
+            if not any(o['val_accuracy'] >= r['val_accuracy'] and o['us_per_jet'] < r['us_per_jet'] for o in ok)}
+
+def print_table(results, min_accuracy=None):
+    front = pareto_front(results)
+    print("{:<40s} {:>8s} {:>9s} {:>9s} {:>10s} {:>9s} {:>11s}".format("configuration", "val_acc", "val_loss", "params", "MMAC/jet", "us/jet", "train jets/s"))
+    for r in sorted(results, key=lambda r: r.get('us_per_jet', float('inf'))):
+        if 'error' in r:
+            print("{:<40s} failed: {}".format(r['name'], r['error']))
+            continue
+        print("{:<40s} {:>8.4f} {:>9.4f} {:>9d} {:>10.2f} {:>9.1f} {:>11.0f} {}".format(r['name'], r['val_accuracy'], r['val_loss'], r['params'],
+              r['macs'] * 1e-6, r['us_per_jet'], r['train_jets_per_s'], '*' if r['name'] in front else ''))
+    print("* no configuration is both faster and at least as accurate")
+    if min_accuracy is not None:
+        passing = [r for r in results if 'error' not in r and r['val_accuracy'] >= min_accuracy]
+        if passing:
+            best = min(passing, key=lambda r: r['us_per_jet'])
+            print("Fastest with val_accuracy >= {}: {} ({:.1f} us/jet, val_accuracy {:.4f})".format(min_accuracy, best['name'], best['us_per_jet'], best['val_accuracy']))
+        else:
+            print("No configuration reaches val_accuracy >= {}".format(min_accuracy))
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--year", "--y", dest="year", help = "UL16preVFP, UL16postVFP, UL17, UL18", default= "UL18")
+    parser.add_option("--train_file", help = "Training .awkd file (default: that of --year)", default= None)
+    parser.add_option("--val_file", help = "Validation .awkd file (default: that of --year)", default= None)
+    parser.add_option("--cache_dir", help = "Directory of the shared memory-mapped tensors (default: ternary_training/<year>/sweep/cache)", default= None)
+    parser.add_option("--output", help = "Result file (default: ternary_training/<year>/sweep/results.json)", default= None)
+    parser.add_option("--space", help = "JSON dict (or file) of setting: list of values, replacing those of SPACE", default= None)
+    parser.add_option("--samples", type = "int", help = "Number of configurations drawn from the grid (default: all)", default= None)
+    parser.add_option("--seed", type = "int", default= 0)
+    parser.add_option("--workers", type = "int", help = "Trainings in parallel", default= 2)
+    parser.add_option("--threads", type = "int", help = "TensorFlow threads per worker (default: its share of the cores)", default= None)
+    parser.add_option("--epochs", type = "int", default= 3)
+    parser.add_option("--steps_per_epoch", type = "int", help = "Limit of the training steps per epoch", default= None)
+    parser.add_option("--learning_rate", type = "float", default= 1e-3)
+    parser.add_option("--inference_batch", type = "int", help = "Jets per batch for the inference time", default= 1024)
+    parser.add_option("--repeats", type = "int", help = "Timed batches per configuration", default= 10)
+    parser.add_option("--min_accuracy", type = "float", help = "Report the fastest configuration with at least this validation accuracy", default= None)
+    (options,args) = parser.parse_args()
+
+    year = options.year
+    train_file = options.train_file or 'preprocessing/ternary_training/{y}/converted/WpWnZ_train_{y}_0.awkd'.format(y=year)
+    val_file = options.val_file or 'preprocessing/ternary_training/{y}/converted/WpWnZ_val_{y}_0.awkd'.format(y=year)
+    cache_dir = options.cache_dir or 'ternary_training/{y}/sweep/cache'.format(y=year)
+    output = options.output or 'ternary_training/{y}/sweep/results.json'.format(y=year)
+    space = dict(SPACE)
+    if options.space:
+        space.update(json.load(open(options.space)) if os.path.exists(options.space) else json.loads(options.space))
+
+    # pad once into the cache, the workers only memory-map it
+    from load_datasets import Dataset
+    from distributed_training import worker_cores
+    train = Dataset(train_file, data_format='channel_last', cache_dir=cache_dir)
+    if val_file:
+        Dataset(val_file, data_format='channel_last', cache_dir=cache_dir)
+    configs = make_configs(space, options.samples, options.seed, pad_len=train.pad_len)
+    coord_dim, feature_dim, num_classes = train['points'].shape[-1], train['features'].shape[-1], train.y.shape[1]
+    too_long = [config_name(c) for c in configs if c['pad_len'] > train.pad_len]
+    if too_long:
+        raise ValueError('pad_len larger than the %d of the converted files: %s' % (train.pad_len, ', '.join(too_long)))
+    del train
+    logging.info('%d configurations, %d workers' % (len(configs), options.workers))
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    context = multiprocessing.get_context('spawn')
+    cores = context.Queue()
+    for i in range(options.workers):
+        cores.put(worker_cores(options.workers, i))
+    results = []
+    with context.Pool(options.workers, initializer=_init_worker, initargs=(cores, options.threads, train_file, val_file, cache_dir)) as pool:
+        jobs = [pool.apply_async(_train, (c, options.epochs, options.steps_per_epoch, options.learning_rate, options.seed)) for c in configs]
+        for job in jobs:
+            r = job.get()
+            logging.info('%s: %s' % (r['name'], r.get('error') or 'val_accuracy %.4f' % r['val_accuracy']))
+            results.append(r)
+            with open(output, 'w') as f:
+                json.dump(results, f, indent=1)
+
+    # inference cost, one configuration at a time on all cores
+    cores.put(worker_cores(1, 0))
+    with context.Pool(1, initializer=_init_worker, initargs=(cores, None, train_file, val_file, cache_dir)) as pool:
+        for r in results:
+            if 'error' not in r:
+                r['macs'] = inference_macs(r['config'], coord_dim, feature_dim, num_classes)
+                r['us_per_jet'] = pool.apply(_time_inference, (r['config'], options.inference_batch, options.repeats))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print_table(results, options.min_accuracy)
+    logging.info('Results in %s' % output)
+
+if __name__ == "__main__":
+    main()
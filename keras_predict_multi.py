@@ -9,37 +9,149 @@ import sys
 sys.path.append("preprocessing/")
 import numpy as np
 import optparse
-import tensorflow as tf
-from tensorflow import keras
-from load_datasets import Dataset
-from array import array
-from ROOT import *
-import rootIO
+import model_registry
+# TensorFlow, load_datasets (awkward) and ROOT are imported by the steps that need them, so that --help, a missing
+# input file or a --server prediction do not pay for them (python benchmarks/cli_startup.py)
 
-parser = optparse.OptionParser()
-parser.add_option("--year", dest="year", default= "UL18")
-(options,args) = parser.parse_args()
-year = options.year
+def make_parser():
+    parser = optparse.OptionParser()
+    parser.add_option("--year", dest="year", default= "UL18")
+    parser.add_option("--eval_file", help = "Converted .awkd file to evaluate, {year} is replaced by --year", default= "preprocessing/ternary_training/{year}/Eval/converted/Eval_TTCR_TT_{year}_0.awkd")
+    parser.add_option("--epoch", help = "Checkpoint epoch of the models, or best", default= "best")
+    parser.add_option("--cache_dir", dest="cache_dir", help = "Directory to cache the padded input tensors in", default= None)
+    parser.add_option("--cache_max_gb", dest="cache_max_gb", type="float", help = "Size limit of the cache directory in GB", default= None)
+    parser.add_option("--batch_size", type="int", help = "Number of jets per prediction batch", default= 32)
+    parser.add_option("--exported", help = "Run the inference-only model written by export_model.py (SavedModel directory or .onnx file) instead of the .h5 checkpoint", default= None)
+    parser.add_option("--server", help = "Score with a running scoring_server.py (http://host:port or unix:/path/to/socket) instead of loading the models", default= None)
+    parser.add_option("--buckets", type="int", help = "Number of length buckets to batch the jets by particle multiplicity (0: pad every jet to pad_len)", default= 0)
+    parser.add_option("--ragged", action="store_true", help = "Run the EdgeConvs on the real particles only, skipping the padding", default = False)
+    parser.add_option("--xla", action="store_true", help = "Compile the prediction with XLA", default = False)
+    parser.add_option("--mixed_precision", type = "choice", choices = ["mixed_bfloat16", "mixed_float16"], help = "Keras mixed precision policy (the neighbour search and the softmax stay in float32)", default= None)
+    parser.add_option("--years", help = "Comma separated years whose models all score the dataset of --year in one pass", default= None)
+    parser.add_option("--ensemble", action="store_true", help = "With --years, also write the average of the scores of all years", default = False)
+    parser.add_option("--output", help = "Write the scores to this .awkd (parquet) file", default= None)
+    return parser
 
-def load_model():
+def load_model(year, epoch='best'):
 
-    modelnumber = {"UL16preVFP": 30, "UL16postVFP": 30, "UL17": 30, "UL18": 29}
-    modelpath = "./modelfiles/{}/model_checkpoints/particle_net_lite_model.0{}.h5".format(year, modelnumber[year])
-    model = keras.models.load_model(modelpath)
+    model = model_registry.load_model(year, epoch)
 
     return model
 
-def predict_testset():
+def rebuild_model(model, input_shapes, num_points, ragged=False):
+    """ParticleNet-Lite for input_shapes with the weights of model, built under the current Keras mixed precision policy"""
+    from tf_keras_model import get_particle_net_lite, copy_weights
+    rebuilt = get_particle_net_lite(model.output_shape[-1], input_shapes, num_points=num_points, ragged=ragged)
+    copy_weights(model, rebuilt)
+    return rebuilt
+
+def ensemble_model(models, average=False):
+    """One model with the inputs of the year models (dict year -> model) and a dict of their scores as output,
+    plus their average as 'ensemble' with average. All years are then scored in one pass over the data."""
+    from tensorflow import keras
+    first = next(iter(models.values()))
+    names = [i.name.split(':')[0] for i in first.inputs]
+    for year_, model in models.items():
+        if [tuple(i.shape) for i in model.inputs] != [tuple(i.shape) for i in first.inputs]:
+            raise ValueError('the model of {} has other input shapes than the one of {}'.format(year_, next(iter(models))))
+    inputs = [keras.Input(name=name, shape=i.shape[1:]) for name, i in zip(names, first.inputs)]
+    outputs = {}
+    for year_, model in models.items():
+        # the models are layers of the ensemble and their names must differ; wrap them instead of renaming the
+        # (possibly shared, see model_registry) year models
+        wrapped = keras.Model(model.inputs, model.outputs, name='ParticleNet_{}'.format(year_))
+        outputs[year_] = wrapped(inputs)
+    if average:
+        outputs['ensemble'] = keras.layers.Average(name='ensemble')(list(outputs.values()))
+    return keras.Model(inputs=inputs, outputs=outputs, name='ParticleNetEnsemble')
+
+def predict_bucketed(model, dataset, num_buckets, batch_size=32):
+    """model.predict with length-bucketed batches: the jets are grouped by their number of particles and every
+    batch is padded only to the length of its bucket. model must accept a variable number of particles (see
+    rebuild_model, an ExportedModel accepts them already), the outputs are returned in the order of the dataset.
+    """
+    from load_datasets import make_buckets, bucket_report, bucketed_batches
+    n_parts = dataset.n_parts()
+    # shortest bucket 2*(K+1) of ParticleNet-Lite
+    buckets = make_buckets(n_parts, dataset.pad_len, num_buckets, min_len=16)
+    report = bucket_report(n_parts, buckets)
+    print ("Length buckets {}: {}".format(buckets, ", ".join("{} jets <= {} particles".format(b['jets'], b['length']) for b in report['buckets'])))
+    print ("Compute relative to padding to {}: {:.1f}% (linear), {:.1f}% (distance matrix)".format(dataset.pad_len, 100 * report['linear'], 100 * report['quadratic']))
+
+    output = {}
+    for indices, X, _ in bucketed_batches(dataset, batch_size, buckets):
+        scores = model.predict_on_batch(X)
+        for k, v in (scores.items() if isinstance(scores, dict) else [(None, scores)]):
+            if k not in output:
+                output[k] = np.empty((len(dataset),) + v.shape[1:], dtype='float32')
+            output[k][indices] = v
+    return output[None] if None in output else output
+
+def write_scores(tagger_output, ofilename):
+    """Store the scores (an array, or a dict of arrays per year) as jetchargetagger_prob_node{Wp,Wn,Z}[_<year>] columns"""
+    import awkward
+    columns = {}
+    for key, scores in (tagger_output.items() if isinstance(tagger_output, dict) else [(None, tagger_output)]):
+        for node, name in enumerate(['Wp', 'Wn', 'Z']):
+            columns['jetchargetagger_prob_node{}{}'.format(name, '' if key is None else '_' + key)] = np.ascontiguousarray(scores[:, node])
+    awkward.to_parquet(awkward.zip(columns), ofilename)
+    print ("Scores written to {}".format(ofilename))
+
+def predict_server(address, X, years, average=False, chunk_size=4096):
+    """Scores of X from a scoring_server.py, as model.predict of the single year model or of ensemble_model"""
+    from scoring_server import ScoringClient
+    client = ScoringClient(address)
+    n = len(next(iter(X.values())))
+    output = {}
+    for year_ in years:
+        output[year_] = np.concatenate([client.score({k:v[start:start + chunk_size] for k, v in X.items()}, year=year_) for start in range(0, n, chunk_size)])
+    if average:
+        output['ensemble'] = np.mean([output[y] for y in years], axis=0)
+    return output
+
+def predict_testset(options):
     
+    year = options.year
+    years = options.years.split(',') if options.years else [year]
     #Load model
-    model = load_model()
+    if options.exported and (options.xla or options.mixed_precision or options.ragged or options.years):
+        raise ValueError('--xla, --mixed_precision, --ragged and --years apply to the Keras models, not to --exported')
+    if options.server and (options.exported or options.buckets or options.xla or options.mixed_precision or options.ragged):
+        raise ValueError('--server runs the models of the server, it cannot be combined with --exported, --buckets, --xla, --mixed_precision or --ragged')
+    if options.ensemble and len(years) < 2:
+        raise ValueError('--ensemble needs several --years')
+    if not options.exported and not options.server:
+        from tensorflow import keras
+        models = {y:load_model(y, options.epoch) for y in years}
+        if options.mixed_precision:
+            keras.mixed_precision.set_global_policy(options.mixed_precision)
  
+    from load_datasets import Dataset
     #eval_path = "preprocessing/ternary_training/{y}/converted/<NameOfYourEvalFile>_0.awkd".format(y=year)
-    eval_path = "preprocessing/ternary_training/{y}/Eval/converted/Eval_TTCR_TT_{y}_0.awkd".format(y=year)
-    print ("********************* Evaluating {} *****************************".format(eval_path))
-    eval_dataset = Dataset(eval_path, data_format='channel_last')
-    tagger_output= model.predict(eval_dataset.X)
+    eval_path = options.eval_file.format(year=year)
+    print ("********************* Evaluating {} with the models of {} *****************************".format(eval_path, ", ".join(years)))
+    eval_dataset = Dataset(eval_path, data_format='channel_last', cache_dir=options.cache_dir, cache_max_bytes=options.cache_max_gb and options.cache_max_gb * 1e9)
+    if options.server:
+        tagger_output = predict_server(options.server, eval_dataset.X, years, average=options.ensemble)
+        if not options.years:
+            tagger_output = tagger_output[year]
+    else:
+        if options.exported:
+            from exported_model import ExportedModel
+            model = ExportedModel(options.exported)
+        else:
+            if options.buckets or options.mixed_precision or options.ragged:
+                input_shapes = {k:((None,) if options.buckets else eval_dataset[k].shape[1:2]) + eval_dataset[k].shape[2:] for k in eval_dataset.X}
+                models = {y:rebuild_model(m, input_shapes, eval_dataset.pad_len, ragged=options.ragged) for y, m in models.items()}
+            model = models[year] if not options.years else ensemble_model(models, average=options.ensemble)
+            model.compile(jit_compile=options.xla)
+        if options.buckets:
+            tagger_output = predict_bucketed(model, eval_dataset, options.buckets, options.batch_size)
+        else:
+            tagger_output= model.predict(eval_dataset.X, batch_size=options.batch_size)
     print (tagger_output)
+    if options.output:
+        write_scores(tagger_output, options.output)
     
 
 
@@ -52,6 +164,8 @@ def predict_testset():
     #for row in range (nrows):
     #    predicted_probabilites.append(tagger_output[row][predicted_class[row]])
     
+    #from array import array
+    #from ROOT import TFile, TTree
     #ofile = TFile.Open('ternary_training/{}/<NameOfYourEvalFile>_test.root'.format(year), "RECREATE")
     #tree = TTree("AnalysisTree", "AnalysisTree") #Replace the correct tree name
     #Wp = array('d', [0])
@@ -79,8 +193,12 @@ def predict_testset():
 
 def main():
 
-    global year
-    predict_testset()
+    parser = make_parser()
+    (options,args) = parser.parse_args()
+    eval_path = options.eval_file.format(year=options.year)
+    if not os.path.exists(eval_path):
+        parser.error('{} not found'.format(eval_path))
+    predict_testset(options)
 
 if __name__ == '__main__':
     main()
@@ -3,6 +3,11 @@
 
 import os
 import sys
+import glob
+import json
+import shutil
+import tempfile
+import contextlib
 import datetime
 import optparse
 import numpy as np
@@ -19,11 +24,42 @@ parser = optparse.OptionParser()
 parser.add_option("--use_gpu" , "--use_gpu", action="store_true", dest = "gpu_train", help = "gpu training", default = True)
 parser.add_option("--gpu_device", type = "int", help = "choose from 0,1,2,3", default= 1)
 parser.add_option("--year", "--y", dest="year", help = "UL16preVFP, UL16postVFP, UL17, UL18", default= "UL18")
+parser.add_option("--cache_dir", dest="cache_dir", help = "Directory to cache the padded input tensors in", default= None)
+parser.add_option("--cache_max_gb", dest="cache_max_gb", type="float", help = "Size limit of the cache directory in GB", default= None)
+parser.add_option("--stream", action="store_true", help = "Stream the training and validation shards with tf.data instead of loading them in memory", default = False)
+parser.add_option("--train_files", help = "Comma separated globs of training .awkd shards for --stream (default: all shards of --year)", default= None)
+parser.add_option("--val_files", help = "Comma separated globs of validation .awkd shards for --stream (default: all shards of --year)", default= None)
+parser.add_option("--sampler", type = "choice", choices = ["shuffle", "stratified", "weighted"], help = "Gather the training batches by index (shuffle, stratified or weighted) instead of shuffling the whole arrays in memory", default= None)
+parser.add_option("--shuffle_buffer", type = "int", help = "Number of jets in the shuffle buffer for --stream", default= 100000)
+parser.add_option("--buckets", type = "int", help = "Number of length buckets to batch the jets by particle multiplicity (needs the in-memory datasets, implies --sampler shuffle)", default= 0)
+parser.add_option("--ragged", action="store_true", help = "Run the EdgeConvs on the real particles only, skipping the padding", default = False)
+parser.add_option("--xla", action="store_true", help = "Compile the training and prediction steps with XLA", default = False)
+parser.add_option("--mixed_precision", type = "choice", choices = ["mixed_bfloat16", "mixed_float16"], help = "Keras mixed precision policy (the neighbour search and the softmax stay in float32)", default= None)
+parser.add_option("--workers", type = "int", help = "Number of local data-parallel CPU worker processes (tf.distribute.MultiWorkerMirroredStrategy), each on its share of the cores", default= 1)
+parser.add_option("--worker_index", type = "int", help = "Set by the --workers launcher", default= None)
+parser.add_option("--seed", type = "int", help = "Seed of the batch order (the --workers launcher picks one if not given)", default= None)
+parser.add_option("--checkpoint_steps", type = "int", help = "Save the full training state (model, optimizer, batch order, callbacks) every N steps and at the end of every epoch, and on SIGTERM", default= 0)
+parser.add_option("--resume", action="store_true", help = "Continue from the saved training state of --year (implies the state saving of --checkpoint_steps)", default = False)
+parser.add_option("--telemetry", action="store_true", help = "Record the time, jets/s and input wait of every step, peak RSS and validation time in steps.csv and telemetry.json of the TensorBoard log directory", default = False)
+parser.add_option("--profile_steps", help = "first,last training step to trace with the TensorFlow profiler (implies --telemetry)", default= None)
+parser.add_option("--histogram_freq", type = "int", help = "Epochs between the weight histograms of TensorBoard, 0 for none (default: 1, 0 with --telemetry or --profile_steps)", default= None)
 (options,args) = parser.parse_args()
 gpu_training = options.gpu_train
 gpu_device = options.gpu_device
 year = options.year
 
+strategy = None
+if options.workers > 1:
+    gpu_training = False
+if options.worker_index is not None:
+    # before anything else runs in TensorFlow
+    from distributed_training import configure_worker
+    strategy = configure_worker(options.workers, options.worker_index)
+is_chief = options.worker_index in (None, 0)
+
+def _scope():
+    return strategy.scope() if strategy is not None else contextlib.nullcontext()
+
 if gpu_training:
     #tf.debugging.set_log_device_placement(True)
     gpus = tf.config.list_physical_devices('GPU')
@@ -39,20 +75,50 @@ if gpu_training:
 
 def train_multi():
 
-    #Load training and validation dataset
-    train_dataset = Dataset('preprocessing/ternary_training/{y}/converted/WpWnZ_train_{y}_0.awkd'.format(y=year), data_format='channel_last')
-    val_dataset = Dataset('preprocessing/ternary_training/{y}/converted/WpWnZ_val_{y}_0.awkd'.format(y=year), data_format='channel_last')
-    
     model_type = 'particle_net_lite' # choose between 'particle_net' and 'particle_net_lite'
-    num_classes = train_dataset.y.shape[1]
-    input_shapes = {k:train_dataset[k].shape[1:] for k in train_dataset.X}
-    
-    if 'lite' in model_type:
-        model = get_particle_net_lite(num_classes, input_shapes)
+
+    if strategy is not None and options.stream:
+        raise ValueError('--workers needs the in-memory datasets, it cannot be combined with --stream')
+
+    #Load training and validation dataset
+    if options.stream:
+        from stream_datasets import StreamingDataset
+        def _files(patterns, default):
+            return sorted(f for pattern in (patterns or default).split(',') for f in glob.glob(pattern))
+        train_dataset = StreamingDataset(_files(options.train_files, 'preprocessing/ternary_training/{y}/converted/WpWnZ_train_{y}_*.awkd'.format(y=year)))
+        val_dataset = StreamingDataset(_files(options.val_files, 'preprocessing/ternary_training/{y}/converted/WpWnZ_val_{y}_*.awkd'.format(y=year)))
+        num_classes = train_dataset.num_classes
+        input_shapes = train_dataset.input_shapes
     else:
-        model = get_particle_net(num_classes, input_shapes)
+        train_dataset = Dataset('preprocessing/ternary_training/{y}/converted/WpWnZ_train_{y}_0.awkd'.format(y=year), data_format='channel_last', cache_dir=options.cache_dir, cache_max_bytes=options.cache_max_gb and options.cache_max_gb * 1e9)
+        val_dataset = Dataset('preprocessing/ternary_training/{y}/converted/WpWnZ_val_{y}_0.awkd'.format(y=year), data_format='channel_last', cache_dir=options.cache_dir, cache_max_bytes=options.cache_max_gb and options.cache_max_gb * 1e9)
+        num_classes = train_dataset.y.shape[1]
+        input_shapes = {k:train_dataset[k].shape[1:] for k in train_dataset.X}
+
+    buckets = None
+    if options.buckets:
+        if options.stream:
+            raise ValueError('--buckets needs the in-memory datasets, it cannot be combined with --stream')
+        n_parts = train_dataset.n_parts()
+        # shortest bucket 2*(K+1): jets with fewer particles than neighbours see the same padding as with pad_len
+        buckets = make_buckets(n_parts, train_dataset.pad_len, options.buckets, min_len=16 if 'lite' in model_type else 34)
+        report = bucket_report(n_parts, buckets)
+        logging.info('Length buckets %s: %s' % (buckets, ', '.join('%d jets <= %d particles' % (b['jets'], b['length']) for b in report['buckets'])))
+        logging.info('Compute relative to padding to %d: %.1f%% (linear), %.1f%% (distance matrix)' % (train_dataset.pad_len, 100 * report['linear'], 100 * report['quadratic']))
+        # variable number of particles
+        input_shapes = {k:(None,) + tuple(shape[1:]) if k != 'add_features' else shape for k, shape in input_shapes.items()}
+
+    if options.mixed_precision:
+        keras.mixed_precision.set_global_policy(options.mixed_precision)
+    with _scope():
+        if 'lite' in model_type:
+            model = get_particle_net_lite(num_classes, input_shapes, num_points=train_dataset.pad_len, ragged=options.ragged)
+        else:
+            model = get_particle_net(num_classes, input_shapes, num_points=train_dataset.pad_len, ragged=options.ragged)
     
     #Training parameters
+    # global batch size: with --workers every worker trains on batch_size / workers jets per step and the gradients are
+    # averaged over the workers, so that the steps per epoch and the learning rate schedule stay those of one process
     batch_size = 1024 if 'lite' in model_type else 128
     epochs = 30
     
@@ -66,20 +132,30 @@ def train_multi():
         return lr
     
     #opt = keras.optimizers.Adam(learning_rate= 1e-5)
-    opt = keras.optimizers.Adam(learning_rate= lr_schedule(0))
     
-    model.compile(loss='categorical_crossentropy', 
-                  optimizer=opt,
-                  metrics=['accuracy'])
+    with _scope():
+        opt = keras.optimizers.Adam(learning_rate= lr_schedule(0))
+        model.compile(loss='categorical_crossentropy', 
+                      optimizer=opt,
+                      metrics=['accuracy'],
+                      jit_compile=options.xla)
     
     #model.summary()
     #keras.utils.plot_model(model, "multi_input_and_output_model.png", show_shapes=True)
     
     # Prepare model model saving directory.
     save_dir = 'ternary_training/{y}/model_checkpoints'.format(y=year)
+    log_dir = "ternary_training/{y}/logs/fit/".format(y=year) + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    if not is_chief:
+        # the other workers run the same callbacks, but write to a scratch directory
+        scratch_dir = tempfile.mkdtemp(prefix='worker_%d_' % options.worker_index)
+        save_dir, log_dir = os.path.join(scratch_dir, 'model_checkpoints'), os.path.join(scratch_dir, 'logs')
     model_name = '%s_model.{epoch:03d}.h5' % model_type
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
+    # inputs of the checkpoints, for model_registry.py
+    with open(os.path.join(save_dir, 'training_info.json'), 'w') as f:
+        json.dump({'model_type': model_type, 'feature_dict': train_dataset.feature_dict, 'pad_len': train_dataset.pad_len}, f, indent=2)
     filepath = os.path.join(save_dir, model_name)
     
     # Prepare callbacks for model saving and for learning rate adjustment.
@@ -91,21 +167,122 @@ def train_multi():
     lr_scheduler = keras.callbacks.LearningRateScheduler(lr_schedule)
     progress_bar = keras.callbacks.ProgbarLogger()
     earlystopping = keras.callbacks.EarlyStopping(verbose=True, patience=10, monitor='val_loss')
-    log_dir = "ternary_training/{y}/logs/fit/".format(y=year) + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-    tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1)
+    # the weight histograms are costly and would show up in the step times of --telemetry
+    histogram_freq = options.histogram_freq if options.histogram_freq is not None else 0 if options.telemetry or options.profile_steps else 1
+    tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=histogram_freq)
     
     callbacks = [checkpoint, lr_scheduler, progress_bar, earlystopping, tensorboard_callback]
+
+    telemetry = None
+    if options.telemetry or options.profile_steps:
+        from training_telemetry import TrainingTelemetry
+        profile_steps = tuple(int(step) for step in options.profile_steps.split(',')) if options.profile_steps else None
+        telemetry = TrainingTelemetry(log_dir, batch_size=batch_size, profile_steps=profile_steps)
+        callbacks.append(telemetry)
+
+    def _train_input(sampler, start=0):
+        # the batches of a BatchSampler, through tf.data for the input wait of --telemetry
+        if telemetry is None:
+            return sampler.batches(start)
+        from distributed_training import sampler_dataset
+        return telemetry.wrap(sampler_dataset(sampler, start))
     
-    train_dataset.shuffle()
-    val_dataset.shuffle()
+    if options.checkpoint_steps or options.resume:
+        if options.stream:
+            raise ValueError('--checkpoint_steps and --resume need the in-memory datasets, they cannot be combined with --stream')
+        from resumable_training import TrainingState, Preempted
+        state_dir = 'ternary_training/{y}/training_state'.format(y=year)
+        shard = (options.worker_index, options.workers) if strategy is not None else None
+        # the batch order is restored from the sampler RNG, also for the default shuffling of the whole arrays
+        train_batches = BatchSampler(train_dataset, batch_size, mode=options.sampler or 'shuffle', seed=options.seed, buckets=buckets, shard=shard)
+        # the order of the validation batches does not change the validation metrics
+        val_batches = None
+        if buckets is not None or strategy is not None:
+            val_batches = BatchSampler(val_dataset, batch_size, seed=options.seed, buckets=buckets, shard=shard)
+            validation = {'validation_steps': len(val_batches)}
+        else:
+            validation = {'validation_batch_size': batch_size}
+        def data(start):
+            if strategy is not None:
+                from distributed_training import sampler_dataset
+                return (strategy.distribute_datasets_from_function(lambda context: sampler_dataset(train_batches, start)),
+                        strategy.distribute_datasets_from_function(lambda context: sampler_dataset(val_batches)))
+            return _train_input(train_batches, start), iter(val_batches) if val_batches is not None else (val_dataset.X, val_dataset.y)
+        # all workers save at the same steps (the checkpoint of a multi-worker model is written collectively), a
+        # SIGTERM of the launcher stops them and they continue from the last periodic save
+        state = TrainingState(state_dir if is_chief else os.path.join(scratch_dir, 'training_state'), {'train': train_batches}, callbacks,
+                              save_steps=options.checkpoint_steps, handle_sigterm=strategy is None)
+        with _scope():
+            if options.resume and state.restore(model, state_dir) is None:
+                logging.warning('No training state in %s, starting from epoch 1' % state_dir)
+        try:
+            state.fit(model, data, len(train_batches), epochs, callbacks=callbacks + [state], verbose=1 if strategy is None else 2 if is_chief else 0, **validation)
+        except Preempted as e:
+            logging.warning('Preempted, %s, continue with --resume' % e)
+            sys.exit(143)
+        # the history of all epochs, also those before a resume
+        history = state
+    elif strategy is not None:
+        from distributed_training import sampler_dataset
+        shard = (options.worker_index, options.workers)
+        train_batches = BatchSampler(train_dataset, batch_size, mode=options.sampler or 'shuffle', seed=options.seed, buckets=buckets, shard=shard)
+        val_batches = BatchSampler(val_dataset, batch_size, seed=options.seed, buckets=buckets, shard=shard)
+        history = model.fit(strategy.distribute_datasets_from_function(lambda context: sampler_dataset(train_batches)),
+                  steps_per_epoch=len(train_batches),
+                  epochs=epochs,
+                  validation_data=strategy.distribute_datasets_from_function(lambda context: sampler_dataset(val_batches)),
+                  validation_steps=len(val_batches),
+                  callbacks=callbacks,
+                  verbose=2 if is_chief else 0)
+    elif options.stream:
+        train_input = train_dataset.tf_dataset(batch_size, shuffle_buffer=options.shuffle_buffer)
+        history = model.fit(telemetry.wrap(train_input) if telemetry is not None else train_input,
+                  epochs=epochs,
+                  validation_data=val_dataset.tf_dataset(batch_size, shuffle=False),
+                  callbacks=callbacks)
+    elif buckets is not None:
+        train_batches = BatchSampler(train_dataset, batch_size, mode=options.sampler or 'shuffle', buckets=buckets)
+        val_batches = BatchSampler(val_dataset, batch_size, buckets=buckets)
+        history = model.fit(_train_input(train_batches),
+                  steps_per_epoch=len(train_batches),
+                  epochs=epochs,
+                  validation_data=iter(val_batches),
+                  validation_steps=len(val_batches),
+                  callbacks=callbacks)
+    elif options.sampler:
+        train_batches = BatchSampler(train_dataset, batch_size, mode=options.sampler)
+        history = model.fit(_train_input(train_batches),
+                  steps_per_epoch=len(train_batches),
+                  epochs=epochs,
+                  validation_data=(val_dataset.X, val_dataset.y),
+                  validation_batch_size=batch_size,
+                  callbacks=callbacks)
+    elif telemetry is not None:
+        # the arrays reshuffled every epoch as by model.fit(shuffle=True), but batched through tf.data, so that the
+        # input wait is measured
+        logging.info('--telemetry: training on the shuffled batches of a BatchSampler instead of the arrays')
+        train_batches = BatchSampler(train_dataset, batch_size, mode='shuffle', seed=options.seed)
+        history = model.fit(_train_input(train_batches),
+                  steps_per_epoch=len(train_batches),
+                  epochs=epochs,
+                  validation_data=(val_dataset.X, val_dataset.y),
+                  validation_batch_size=batch_size,
+                  callbacks=callbacks)
+    else:
+        train_dataset.shuffle()
+        val_dataset.shuffle()
     
-    history = model.fit(train_dataset.X, train_dataset.y,
-              batch_size=batch_size,
-              epochs=epochs,
-              validation_data=(val_dataset.X, val_dataset.y),
-              shuffle=True,
-              callbacks=callbacks)
+        history = model.fit(train_dataset.X, train_dataset.y,
+                  batch_size=batch_size,
+                  epochs=epochs,
+                  validation_data=(val_dataset.X, val_dataset.y),
+                  shuffle=True,
+                  callbacks=callbacks)
     
+    if not is_chief:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        return
+
     # summarize history for accuracy
     plt.plot(history.history['accuracy'])
     plt.plot(history.history['val_accuracy'])
@@ -128,6 +305,10 @@ def train_multi():
 
 def main():
     global year
+    if options.workers > 1 and options.worker_index is None:
+        from distributed_training import launch_workers
+        seed = options.seed if options.seed is not None else int.from_bytes(os.urandom(4), 'little')
+        sys.exit(launch_workers(sys.argv + ['--seed', str(seed)], options.workers, log_dir='ternary_training/{y}/logs'.format(y=year)))
     train_multi()
 
 if __name__ == "__main__":
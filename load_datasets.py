@@ -1,7 +1,12 @@
 # Copyright (c) 2025 Komal Tauqeer
 # Licensed under the MIT License. See LICENSE file for details.
 
-
+import os
+import copy
+import json
+import time
+import shutil
+import hashlib
 import numpy as np
 import awkward
 import logging
@@ -20,57 +25,225 @@ def pad_array(a, maxlen, value=0., dtype='float32'):
         x[idx, :len(trunc)] = trunc
     return x
 
+def _counts(a):
+    return awkward.to_numpy(awkward.num(a, axis=1))
+
+def pad_arrays(arrays, maxlen, value=0., dtype='float32', data_format='channel_first'):
+    """Vectorized pad_array for several jagged arrays with identical counts.
+
+    Every array is truncated/padded to maxlen and written directly into one preallocated
+    buffer of shape (N, C, maxlen) for 'channel_first' or (N, maxlen, C) for 'channel_last',
+    the same result as stacking pad_array outputs along the channel axis.
+    """
+    assert data_format in ('channel_first', 'channel_last')
+    counts = _counts(arrays[0])
+    # filled slots of the (N, maxlen) block, and the flat elements that land in them (in the same row-major order)
+    filled = np.arange(maxlen) < np.minimum(counts, maxlen)[:, None]
+    keep = None
+    if counts.max(initial=0) > maxlen:
+        starts = np.cumsum(counts) - counts
+        keep = (np.arange(counts.sum()) - np.repeat(starts, counts)) < maxlen
+    if data_format == 'channel_first':
+        x = np.full((len(counts), len(arrays), maxlen), value, dtype=dtype)
+    else:
+        x = np.full((len(counts), maxlen, len(arrays)), value, dtype=dtype)
+    for c, a in enumerate(arrays):
+        assert np.array_equal(counts, _counts(a))
+        flat = awkward.to_numpy(awkward.flatten(a, axis=1))
+        if keep is not None:
+            flat = flat[keep]
+        if data_format == 'channel_first':
+            x[:, c, :][filled] = flat
+        else:
+            x[:, :, c][filled] = flat
+    return x
+
+def set_default_features(feature_dict):
+    feature_dict['points'] = ['part_etarel', 'part_phirel']
+    #feature_dict['features'] = ['part_pt_log', 'part_e_log', 'part_etarel', 'part_phirel', 'part_charge', 'part_deltaR']
+    feature_dict['features'] = ['part_pt_log', 'part_e_log', 'part_logerel', 'part_logptrel', 'part_charge', 'part_deltaR']
+    feature_dict['mask'] = ['part_pt_log']
+    return feature_dict
+
+# Bump when the padded tensors produced by Dataset._load change, so that old cache entries are not reused
+_CACHE_VERSION = 1
+
+def _file_hash(filepath, cache_dir):
+    # content hash of filepath, remembered per (path, size, mtime) so that the file is read only once
+    st = os.stat(filepath)
+    stamp = '%s|%d|%d' % (os.path.abspath(filepath), st.st_size, st.st_mtime_ns)
+    hash_dir = os.path.join(cache_dir, 'hashes')
+    stamp_file = os.path.join(hash_dir, hashlib.sha1(stamp.encode()).hexdigest())
+    if os.path.exists(stamp_file):
+        with open(stamp_file) as f:
+            return f.read().strip()
+    h = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            h.update(block)
+    os.makedirs(hash_dir, exist_ok=True)
+    tmp = '%s.%d' % (stamp_file, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(h.hexdigest())
+    os.replace(tmp, stamp_file)
+    return h.hexdigest()
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+def evict_cache(cache_dir, max_bytes):
+    """Remove the least recently used entries of a Dataset cache until it is smaller than max_bytes"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        meta = os.path.join(path, 'meta.json')
+        if os.path.exists(meta):
+            entries.append((os.path.getmtime(meta), _dir_size(path), path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        logging.info('Evicting cache entry %s (%.1f MB)' % (path, size / 1e6))
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+def make_buckets(n_parts, pad_len, num_buckets=4, min_len=16, multiple=8):
+    """Lengths of the buckets for length-bucketed batches: num_buckets quantiles of the number of particles per
+    jet (the last one is the longest jet), rounded up to a multiple of `multiple`. pad_len is always added as
+    the last bucket, for longer jets of other datasets.
+
+    min_len: length of the shortest bucket. Use at least 2*(K+1) of the model, then jets with fewer than K+1
+        particles find the same padded neighbours as with fixed padding.
+    """
+    n_parts = np.minimum(n_parts, pad_len)
+    quantiles = np.quantile(n_parts, np.arange(1, num_buckets + 1) / num_buckets) if len(n_parts) else []
+    lengths = np.clip(np.ceil(np.asarray(quantiles) / multiple) * multiple, min_len, pad_len).astype(int)
+    return sorted(set(lengths.tolist()) | {pad_len})
+
+def bucket_ids(n_parts, buckets):
+    """Index of the shortest bucket that holds all particles of each jet"""
+    return np.searchsorted(buckets, np.minimum(n_parts, buckets[-1]), side='left')
+
+def bucket_report(n_parts, buckets):
+    """Compute of length-bucketed batches relative to padding every jet to the last bucket length.
+
+    'linear' is the relative number of particles (1x1 convolutions, BatchNorm), 'quadratic' the relative
+    number of particle pairs (distance matrix, top_k of EdgeConv).
+    """
+    pad_len = buckets[-1]
+    lengths = np.asarray(buckets)[bucket_ids(n_parts, buckets)].astype('float64')
+    return {
+        'buckets': [{'length': int(length), 'jets': int(np.sum(lengths == length))} for length in buckets],
+        'linear': float(np.mean(lengths) / pad_len),
+        'quadratic': float(np.mean(lengths ** 2) / pad_len ** 2),
+        }
+
 class Dataset(object):
 
-    def __init__(self, filepath, feature_dict = {}, label='label', weight='event_weight', pad_len=100, data_format='channel_first', load_evalset=False):
+    def __init__(self, filepath, feature_dict = {}, label='label', weight='event_weight', pad_len=100, data_format='channel_first', load_evalset=False, cache_dir=None, cache_max_bytes=None):
+        """
+        cache_dir: if set, the padded tensors are stored there as .npy files, keyed on the content of
+            filepath and on feature_dict, label, weight, pad_len and data_format. Later Datasets with the
+            same key memory-map them (read-only) instead of parsing and padding the file again.
+        cache_max_bytes: size limit of cache_dir, least recently used entries are evicted beyond it.
+        """
         self.load_evalset = load_evalset
         self.filepath = filepath
         self.feature_dict = feature_dict
         if len(feature_dict)==0:
-            feature_dict['points'] = ['part_etarel', 'part_phirel']
-            #feature_dict['features'] = ['part_pt_log', 'part_e_log', 'part_etarel', 'part_phirel', 'part_charge', 'part_deltaR']
-            feature_dict['features'] = ['part_pt_log', 'part_e_log', 'part_logerel', 'part_logptrel', 'part_charge', 'part_deltaR']
-            feature_dict['mask'] = ['part_pt_log']
+            set_default_features(feature_dict)
         self.label = label
         self.weight = weight
         self.pad_len = pad_len
         assert data_format in ('channel_first', 'channel_last')
+        self.data_format = data_format
         self.stack_axis = 1 if data_format=='channel_first' else -1
         self._values = {}
         self._label = None
         self._weight = None
-        self._load()
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        if cache_dir is None:
+            self._load()
+        elif not self._load_cache():
+            self._load()
+            self._store_cache()
 
     def _load(self):
         logging.info('Start loading file %s' % self.filepath)
         counts = None
-        #with awkward0.load(self.filepath) as a:
-        with awkward.load(self.filepath) as a:
-            if (not self.load_evalset): self._label = a[self.label]
-            self._weight = a[self.weight]
-            for k in self.feature_dict:
-                arrs = []
-                if not k == 'add_features':
-                    cols = self.feature_dict[k]
-                    if not isinstance(cols, (list, tuple)):
-                        cols = [cols]
-                    for col in cols:
-                        if counts is None:
-                            counts = a[col].counts
-                        else:
-                            assert np.array_equal(counts, a[col].counts)
-                        arrs.append(pad_array(a[col], self.pad_len))
+        # .awkd files are written with awkward.to_parquet by preprocessing/prepare_tagger_inputs.py
+        a = awkward.from_parquet(self.filepath)
+        if (not self.load_evalset): self._label = awkward.to_numpy(a[self.label])
+        self._weight = awkward.to_numpy(a[self.weight])
+        for k in self.feature_dict:
+            cols = self.feature_dict[k]
+            if not isinstance(cols, (list, tuple)):
+                cols = [cols]
+            if not k == 'add_features':
+                if counts is None:
+                    counts = _counts(a[cols[0]])
                 else:
-                    column = self.feature_dict[k]
-                    for col in column:
-                        arrs.append(a[col])
-                self._values[k] = np.stack(arrs, axis=self.stack_axis)
+                    assert np.array_equal(counts, _counts(a[cols[0]]))
+                self._values[k] = pad_arrays([a[col] for col in cols], self.pad_len, data_format=self.data_format)
+            else:
+                self._values[k] = np.stack([awkward.to_numpy(a[col]) for col in cols], axis=self.stack_axis)
             #print(self._values['features'])
                     
         logging.info('Finished loading file %s' % self.filepath)
 
+    def _cache_path(self):
+        key = json.dumps({
+            'version': _CACHE_VERSION,
+            'file': _file_hash(self.filepath, self.cache_dir),
+            'feature_dict': self.feature_dict,
+            'label': None if self.load_evalset else self.label,
+            'weight': self.weight,
+            'pad_len': self.pad_len,
+            'data_format': self.data_format,
+            }, sort_keys=True)
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest())
+
+    def _load_cache(self):
+        path = self._cache_path()
+        meta_file = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_file):
+            return False
+        with open(meta_file) as f:
+            meta = json.load(f)
+        for k in meta['values']:
+            self._values[k] = np.load(os.path.join(path, '%s.npy' % k), mmap_mode='r')
+        if meta['label']:
+            self._label = np.load(os.path.join(path, '_label.npy'), mmap_mode='r')
+        self._weight = np.load(os.path.join(path, '_weight.npy'), mmap_mode='r')
+        # mark as recently used for the eviction
+        os.utime(meta_file)
+        logging.info('Loaded %s from cache %s' % (self.filepath, path))
+        return True
+
+    def _store_cache(self):
+        path = self._cache_path()
+        # write to a private directory and rename it, so concurrent readers never see a partial entry
+        tmp = '%s.tmp%d' % (path, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for k, v in self._values.items():
+            np.save(os.path.join(tmp, '%s.npy' % k), v)
+        if self._label is not None:
+            np.save(os.path.join(tmp, '_label.npy'), self._label)
+        np.save(os.path.join(tmp, '_weight.npy'), self._weight)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'filepath': os.path.abspath(self.filepath), 'values': list(self._values), 'label': self._label is not None, 'created': time.time()}, f)
+        try:
+            os.rename(tmp, path)
+            logging.info('Stored %s in cache %s' % (self.filepath, path))
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+        if self.cache_max_bytes is not None:
+            evict_cache(self.cache_dir, self.cache_max_bytes)
+
     def __len__(self):
-        return len(self._label)
+        return len(self._weight)
 
     def __getitem__(self, key):
         if key==self.label:
@@ -97,4 +270,139 @@ class Dataset(object):
         np.random.shuffle(shuffle_indices)
         for k in self._values:
             self._values[k] = self._values[k][shuffle_indices]
-        self._label = self._label[shuffle_indices]
+        if self._label is not None:
+            self._label = self._label[shuffle_indices]
+        self._weight = self._weight[shuffle_indices]
+
+    def n_parts(self):
+        """Number of particles of each jet, the non-zero entries of the mask as counted by the model"""
+        mask = self._values['mask']
+        return np.count_nonzero(mask, axis=tuple(range(1, mask.ndim)))
+
+    def take(self, indices, length=None):
+        """Gather the rows `indices` of every array: (X, y, weights), y is None for an eval set.
+        With length, the particle arrays are truncated to the first `length` particles."""
+        X = {k:self._values[k][indices] for k in self._values}
+        if length is not None:
+            for k in X:
+                if k != 'add_features':
+                    X[k] = np.ascontiguousarray(X[k][:, :length] if self.data_format == 'channel_last' else X[k][:, :, :length])
+        y = self._label[indices] if self._label is not None else None
+        return X, y, self._weight[indices]
+
+class BatchSampler(object):
+    """Index-based alternative to Dataset.shuffle: batches are gathered from the unshuffled arrays of a
+    Dataset, so the data is never copied as a whole (and memory-mapped cached arrays stay on disk).
+
+    mode: 'shuffle'    - a new permutation of all jets every epoch
+          'stratified' - as 'shuffle', but every batch has the class fractions of the whole sample
+          'weighted'   - jets drawn with replacement with probability proportional to their weight
+    Iterating gives an endless stream of (X, y) (or (X, y, weights) with with_weights) batches,
+    len() batches per epoch, e.g. model.fit(iter(sampler), steps_per_epoch=len(sampler)).
+
+    buckets: lengths from make_buckets. Each batch then holds jets of one bucket only and is truncated to the
+        bucket length, the batches of all buckets are visited in random order. The model has to accept a
+        variable number of particles (input shapes with None, see tf_keras_model.get_particle_net_lite).
+
+    shard: (index, count) for data-parallel training. Every one of the count workers iterates a sampler with
+        the same seed, batch_size is the global batch and worker index gets every count-th jet of it, so that
+        one training step of all workers together sees the batch of the single-process training. Batches
+        with fewer than count jets are skipped, so that no worker gets an empty batch.
+    """
+
+    def __init__(self, dataset, batch_size, mode='shuffle', seed=None, with_weights=False, buckets=None, shard=None):
+        assert mode in ('shuffle', 'stratified', 'weighted')
+        if mode == 'stratified' and dataset.y is None:
+            raise ValueError('stratified sampling needs the labels of the dataset')
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.mode = mode
+        self.with_weights = with_weights
+        self.rng = np.random.default_rng(seed)
+        self.buckets = buckets
+        self._bucket_ids = bucket_ids(dataset.n_parts(), buckets) if buckets is not None else None
+        self.shard = shard
+        if shard is not None and seed is None:
+            raise ValueError('the workers of a sharded sampler need a common seed')
+        # number of epochs started, and the RNG state at the start of the last ones (see state_at)
+        self.epoch = 0
+        self._epoch_states = {}
+
+    def __len__(self):
+        # batches of the jets in each bucket, exact for 'shuffle' and 'stratified', on average for 'weighted'
+        counts = np.bincount(self._bucket_ids, minlength=len(self.buckets)) if self.buckets is not None else np.array([len(self.dataset)])
+        if self.shard is not None:
+            return int(np.sum(counts // self.batch_size + (counts % self.batch_size >= self.shard[1])))
+        return int(np.sum((counts + self.batch_size - 1) // self.batch_size))
+
+    def epoch_indices(self):
+        n = len(self.dataset)
+        if self.mode == 'shuffle':
+            return self.rng.permutation(n)
+        if self.mode == 'stratified':
+            # spread the jets of each class evenly over the epoch: sort by (rank within class + jitter) / class size
+            classes = np.argmax(self.dataset.y, axis=1)
+            order = self.rng.permutation(n)
+            counts = np.bincount(classes[order])
+            rank = np.empty(n)
+            for c in np.unique(classes):
+                members = order[classes[order] == c]
+                rank[members] = (np.arange(len(members)) + self.rng.random(len(members))) / counts[c]
+            return np.argsort(rank, kind='stable')
+        p = np.clip(np.asarray(self.dataset.Weights, dtype='float64'), 0, None)
+        return self.rng.choice(n, size=n, replace=True, p=p / p.sum())
+
+    def _batches(self, indices):
+        if self.buckets is None:
+            batches = [(indices[start:start + self.batch_size], None) for start in range(0, len(indices), self.batch_size)]
+        else:
+            batches = []
+            for b, length in enumerate(self.buckets):
+                members = indices[self._bucket_ids[indices] == b]  # in the order of the epoch
+                batches += [(members[start:start + self.batch_size], length) for start in range(0, len(members), self.batch_size)]
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        if self.shard is not None:
+            index, count = self.shard
+            batches = [(batch[index::count], length) for batch, length in batches if len(batch) >= count]
+        return batches
+
+    def state_at(self, epoch):
+        """RNG state at the start of epoch, from which restore() gives the same batches again"""
+        if epoch in self._epoch_states:
+            return self._epoch_states[epoch]
+        if epoch != self.epoch:
+            raise ValueError('the RNG state of epoch %d is not known, the sampler is at epoch %d' % (epoch, self.epoch))
+        # nothing is drawn between the start of two epochs
+        return copy.deepcopy(self.rng.bit_generator.state)
+
+    def restore(self, state, epoch):
+        """Continue from the RNG state of epoch given by state_at()"""
+        self.rng.bit_generator.state = state
+        self.epoch = epoch
+        self._epoch_states = {}
+
+    def batches(self, start=0):
+        """The endless stream of batches of __iter__, skipping the first start batches of the first epoch"""
+        while True:
+            self._epoch_states[self.epoch] = copy.deepcopy(self.rng.bit_generator.state)
+            self._epoch_states.pop(self.epoch - 4, None)
+            self.epoch += 1
+            for batch, length in self._batches(self.epoch_indices())[start:]:
+                # sorted indices give sequential reads of memory-mapped arrays, the order inside a batch does not matter
+                X, y, w = self.dataset.take(np.sort(batch), length)
+                yield (X, y, w) if self.with_weights else (X, y)
+            start = 0
+
+    def __iter__(self):
+        return self.batches()
+
+def bucketed_batches(dataset, batch_size, buckets):
+    """Batches of at most batch_size jets of one bucket each, truncated to the bucket length, e.g. for prediction.
+    Yields (indices, X, y): the rows of the dataset in the batch, its arrays and labels (None for an eval set)."""
+    ids = bucket_ids(dataset.n_parts(), buckets)
+    for b, length in enumerate(buckets):
+        members = np.flatnonzero(ids == b)
+        for start in range(0, len(members), batch_size):
+            indices = members[start:start + batch_size]
+            X, y, _ = dataset.take(indices, length)
+            yield indices, X, y
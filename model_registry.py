@@ -0,0 +1,227 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+#
+# Index of the per-epoch checkpoints <root>/<year>/model_checkpoints/<model_type>_model.<epoch>.h5 written by
+# keras_train_multi.py, and an in-process LRU cache of the loaded Keras models.
+#
+# For every checkpoint the index holds its year, epoch, model type, input shapes, pad_len, feature_dict and SHA-1.
+# The input shapes are read from the model config stored in the .h5 file, without building the model. feature_dict
+# and pad_len come from the training_info.json that keras_train_multi.py writes next to the checkpoints (the
+# load_datasets defaults for older trainings). The index is kept in <root>/model_index.json, and a checkpoint is
+# read again only when its size or modification time changes.
+#
+# python model_registry.py [--year UL18] [--rebuild]
+
+import os
+import re
+import json
+import hashlib
+import optparse
+import threading
+import collections
+import logging
+
+_CHECKPOINT = re.compile(r'^(?P<model_type>.+)_model\.(?P<epoch>\d+)\.h5$')
+_INDEX_VERSION = 1
+
+def _sha1(filepath):
+    h = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _input_shapes(filepath):
+    """Input shapes (without the batch dimension) and number of classes from the model config of a Keras .h5 file"""
+    import h5py
+    with h5py.File(filepath, 'r') as f:
+        config = f.attrs['model_config']
+    config = json.loads(config.decode() if isinstance(config, bytes) else config)['config']
+    input_shapes = {}
+    for layer in config['layers']:
+        if layer['class_name'] == 'InputLayer':
+            shape = layer['config'].get('batch_input_shape') or layer['config'].get('batch_shape')
+            input_shapes[layer['config']['name']] = shape[1:]
+    output_layer = config['output_layers'][0][0]
+    num_classes = [layer for layer in config['layers'] if layer['name'] == output_layer][0]['config'].get('units')
+    return input_shapes, num_classes
+
+def _training_info(checkpoint_dir):
+    info_file = os.path.join(checkpoint_dir, 'training_info.json')
+    if os.path.exists(info_file):
+        with open(info_file) as f:
+            return json.load(f)
+    from load_datasets import set_default_features
+    return {'feature_dict': set_default_features({})}
+
+def rebuild(model, model_type='particle_net_lite'):
+    """model (loaded from a checkpoint) built again with get_particle_net(_lite) and its weights. The Keras graph
+    of a .h5 file keeps the ops of the tf_keras_model at training time, e.g. the tiled gather_nd of the kNN."""
+    from tf_keras_model import get_particle_net, get_particle_net_lite, copy_weights
+    get_model = get_particle_net_lite if model_type == 'particle_net_lite' else get_particle_net
+    input_shapes = {i.name.split(':')[0]:tuple(i.shape[1:]) for i in model.inputs}
+    try:
+        rebuilt = get_model(model.output_shape[-1], input_shapes, num_points=model.inputs[0].shape[1])
+        copy_weights(model, rebuilt)
+    except (ValueError, IndexError) as e:
+        # another architecture than the default settings of get_particle_net(_lite)
+        logging.warning('Cannot rebuild %s as %s, using the checkpoint graph: %s' % (model.name, model_type, e))
+        return model
+    return rebuilt
+
+class ModelRegistry(object):
+    """Checkpoints under root and the Keras models loaded from them.
+
+    cache_size: number of loaded models kept in memory. The models are cached by the SHA-1 of the checkpoint, so
+        the same file is deserialized only once per process. The cached model objects are shared between callers.
+    rebuild: build the loaded models again with tf_keras_model and copy the weights, so that they run the current
+        EdgeConv implementation instead of the graph serialized in the checkpoint.
+    """
+
+    def __init__(self, root='./modelfiles', cache_size=4, index_file=None, rebuild=True):
+        self.root = root
+        self.cache_size = cache_size
+        self.rebuild = rebuild
+        self.index_file = index_file or os.path.join(root, 'model_index.json')
+        self._entries = None
+        self._cache = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def index(self, rebuild=False):
+        """All checkpoints, as a list of dicts sorted by year, model type and epoch. Unchanged checkpoints are taken
+        from the index file unless rebuild."""
+        with self._lock:
+            if self._entries is not None and not rebuild:
+                return self._entries
+            previous = {}
+            if not rebuild and os.path.exists(self.index_file):
+                with open(self.index_file) as f:
+                    index = json.load(f)
+                if index.get('version') == _INDEX_VERSION:
+                    previous = {e['path']:e for e in index['checkpoints']}
+            entries = []
+            for year in sorted(os.listdir(self.root)) if os.path.isdir(self.root) else []:
+                checkpoint_dir = os.path.join(self.root, year, 'model_checkpoints')
+                if not os.path.isdir(checkpoint_dir):
+                    continue
+                info = None
+                for name in sorted(os.listdir(checkpoint_dir)):
+                    match = _CHECKPOINT.match(name)
+                    if not match:
+                        continue
+                    path = os.path.join(checkpoint_dir, name)
+                    st = os.stat(path)
+                    entry = previous.get(path)
+                    if entry is None or entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns:
+                        info = info or _training_info(checkpoint_dir)
+                        entry = self._describe(path, st, year, match.group('model_type'), int(match.group('epoch')), info)
+                    entries.append(entry)
+            entries.sort(key=lambda e: (e['year'], e['model_type'], e['epoch']))
+            self._entries = entries
+            try:
+                with open(self.index_file + '.%d' % os.getpid(), 'w') as f:
+                    json.dump({'version': _INDEX_VERSION, 'checkpoints': entries}, f, indent=1)
+                os.replace(self.index_file + '.%d' % os.getpid(), self.index_file)
+            except OSError as e:
+                logging.warning('Cannot write the model index %s: %s' % (self.index_file, e))
+            return entries
+
+    def _describe(self, path, st, year, model_type, epoch, info):
+        entry = {'path': path, 'year': year, 'model_type': model_type, 'epoch': epoch,
+                 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': _sha1(path),
+                 'input_shapes': None, 'num_classes': None, 'pad_len': info.get('pad_len'),
+                 'feature_dict': info.get('feature_dict'), 'error': None}
+        try:
+            entry['input_shapes'], entry['num_classes'] = _input_shapes(path)
+        except Exception as e:
+            # e.g. a Git LFS pointer that was never pulled
+            entry['error'] = '%s: %s' % (type(e).__name__, e)
+            logging.warning('Cannot read the model config of %s (%s)' % (path, entry['error']))
+        if entry['pad_len'] is None and entry['input_shapes'] and 'points' in entry['input_shapes']:
+            entry['pad_len'] = entry['input_shapes']['points'][0]
+        return entry
+
+    def years(self):
+        return sorted(set(e['year'] for e in self.index()))
+
+    def checkpoints(self, year, model_type='particle_net_lite'):
+        return [e for e in self.index() if e['year'] == year and e['model_type'] == model_type]
+
+    def resolve(self, year, epoch='best', model_type='particle_net_lite'):
+        """Index entry of the checkpoint of year for epoch: an epoch number, or 'best'. ModelCheckpoint
+        (save_best_only) writes a checkpoint only when val_accuracy improves, so the best one is the last epoch."""
+        entries = self.checkpoints(year, model_type)
+        if not entries:
+            raise ValueError('no %s checkpoint of %s in %s' % (model_type, year, self.root))
+        if epoch == 'best':
+            return entries[-1]
+        epoch = int(epoch)
+        for entry in entries:
+            if entry['epoch'] == epoch:
+                return entry
+        raise ValueError('no %s checkpoint of %s for epoch %d, the epochs are %s' % (model_type, year, epoch, [e['epoch'] for e in entries]))
+
+    def path(self, year, epoch='best', model_type='particle_net_lite'):
+        return self.resolve(year, epoch, model_type)['path']
+
+    def load(self, year, epoch='best', model_type='particle_net_lite'):
+        """The Keras model of the checkpoint resolved by resolve(), deserialized only if it is not in the cache"""
+        entry = self.resolve(year, epoch, model_type)
+        with self._lock:
+            if entry['sha1'] in self._cache:
+                self._cache.move_to_end(entry['sha1'])
+                self.hits += 1
+                return self._cache[entry['sha1']]
+            self.misses += 1
+            from tensorflow import keras
+            logging.info('Loading %s' % entry['path'])
+            model = keras.models.load_model(entry['path'])
+            if self.rebuild:
+                model = rebuild(model, model_type)
+            self._cache[entry['sha1']] = model
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return model
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache), 'max_size': self.cache_size}
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+_registries = {}
+
+def get_registry(root='./modelfiles'):
+    """The registry of root shared by the whole process"""
+    if root not in _registries:
+        _registries[root] = ModelRegistry(root)
+    return _registries[root]
+
+def load_model(year, epoch='best', model_type='particle_net_lite', root='./modelfiles'):
+    return get_registry(root).load(year, epoch, model_type)
+
+def checkpoint_path(year, epoch='best', model_type='particle_net_lite', root='./modelfiles'):
+    return get_registry(root).path(year, epoch, model_type)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--root", help = "Directory with the <year>/model_checkpoints directories", default= "./modelfiles")
+    parser.add_option("--year", help = "Only list the checkpoints of this year", default= None)
+    parser.add_option("--rebuild", action="store_true", help = "Read and hash all checkpoints again", default= False)
+    (options,args) = parser.parse_args()
+
+    registry = ModelRegistry(options.root)
+    entries = [e for e in registry.index(rebuild=options.rebuild) if options.year in (None, e['year'])]
+    print ("{:>12s} {:>18s} {:>6s} {:>8s} {:>8s} {:>10s}  {}".format("year", "model", "epoch", "pad_len", "classes", "sha1", "inputs"))
+    for e in entries:
+        best = registry.resolve(e['year'], 'best', e['model_type'])['path'] == e['path']
+        inputs = e['error'] or ", ".join("{}{}".format(k, tuple(v)) for k, v in (e['input_shapes'] or {}).items())
+        print ("{:>12s} {:>18s} {:>6s} {:>8s} {:>8s} {:>10s}  {}".format(e['year'], e['model_type'], "%d%s" % (e['epoch'], '*' if best else ''),
+               str(e['pad_len']), str(e['num_classes']), e['sha1'][:10], inputs))
+    print ("{} checkpoints, * = best. Index written to {}".format(len(entries), registry.index_file))
+
+if __name__ == "__main__":
+    main()
@@ -11,18 +11,51 @@ import sys
 import optparse
 #local imports
 from data_utils import *
-from prepare_tagger_inputs import convert
+from prepare_tagger_inputs import convert, convert_root, feature_columns
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from load_datasets import set_default_features
 
-def prepare_testsets(year, outdir, ifile, samples):
+valid_years = ["UL16preVFP", "UL16postVFP", "UL17", "UL18", "UL22", "UL22EE", "UL23", "UL23BPix"]
+
+def parse_columns(columns):
+    # "model,jet_pt" -> the inputs of the default model + jet_pt, None -> all columns
+    if columns is None:
+        return None
+    names = [c.strip() for c in columns.split(',') if c.strip()]
+    feature_dict = set_default_features({}) if 'model' in names else {}
+    return feature_columns(feature_dict, extra=[c for c in names if c != 'model'])
+
+def convert_file(ifile, opath, sample, name, step_size=None, direct=False, columns=None):
+    """Convert one ROOT file into .awkd files in opath/converted and return their paths"""
+    destdir = opath+'/converted'
+    if direct:
+        # ROOT -> .awkd without the pandas/.h5 intermediate, without step_size the same first 100 events as prepare_input_dataset
+        print ("***Converting {} file directly to awkd***".format(ifile))
+        if step_size is None:
+            return convert_root(ifile, destdir=destdir, basename=name, mode="ternary", columns=columns, entry_stop=100)
+        return convert_root(ifile, destdir=destdir, basename=name, mode="ternary", step=step_size, columns=columns)
+    if step_size is None:
+        print ("***Converting {} file to pandas dataframe***".format(ifile))
+        df = prepare_input_dataset(ifile, sample)
+        save_dataset(df, opath, name)
+        return convert(os.path.join(opath, name + '.h5'), destdir=destdir, basename=name, mode="ternary", columns=columns)
+    # Stream the tree in chunks of step_size events, one .h5/.awkd pair per chunk
+    outputs = []
+    for ichunk, df in enumerate(iterate_input_dataset(ifile, sample, step_size=step_size)):
+        print ("***Converting chunk {} of {} file to pandas dataframe***".format(ichunk, ifile))
+        chunkname = "{}_chunk{}".format(name, ichunk)
+        save_dataset(df, opath, chunkname)
+        del df
+        outputs += convert(os.path.join(opath, chunkname + '.h5'), destdir=destdir, basename=chunkname, mode="ternary", columns=columns)
+    return outputs
+
+def prepare_testsets(year, outdir, ifile, samples, step_size=None, direct=False, columns=None):
     opath = outdir + 'ternary_training/{}/Eval'.format(year) + '/'
     if not os.path.isdir(opath):
         os.makedirs(opath)
 
     for sample in samples:
-        print ("***Converting {} file to pandas dataframe***".format(ifile))
-        df = prepare_input_dataset(ifile, sample)
-        save_dataset(df, opath, "Eval_TTCR_{}_{}".format(sample, year))
-        convert(os.path.join(opath, 'Eval_TTCR_{}_{}.h5'.format(sample,year)), destdir=opath+'/converted', basename='Eval_TTCR_{}_{}'.format(sample,year), mode="ternary")
+        convert_file(ifile, opath, sample, "Eval_TTCR_{}_{}".format(sample, year), step_size=step_size, direct=direct, columns=columns)
         print ("****** Eval test files for \"{}\" are stored in \"{}\" *********".format(ifile,opath+'/converted'))
 
 
@@ -33,18 +66,20 @@ def main():
     parser = optparse.OptionParser()
     parser.add_option("--year", "--y", dest="year", help = "UL16preVFP, UL16postVFP, UL17, UL18", default= "UL18")
     parser.add_option("--filepath", "--ifile", dest="ifile", help = "Give the path to the input root file", default= "/ceph/ktauqeer/ULNtuples/UL18/TTCR/jetchargeDP_note/TTCR_TTToSemiLeptonic_test.root")
+    parser.add_option("--step_size", dest="step_size", type="int", help = "Stream the input tree in chunks of this many events (default: read only the first 100 events, also with --direct)", default= None)
+    parser.add_option("--direct", dest="direct", action="store_true", help = "Convert ROOT to .awkd directly, skipping the intermediate .h5 file", default= False)
+    parser.add_option("--columns", dest="columns", help = "Comma separated columns to compute and store, 'model' stands for the inputs of the default model (default: all)", default= None)
     (options,args) = parser.parse_args()
     
     year = options.year
     ifile = options.ifile
     print(ifile)
 
-    valid_years = ["UL16preVFP", "UL16postVFP", "UL17", "UL18", "UL22", "UL22EE", "UL23", "UL23BPix"]
     if year not in valid_years:
         raise ValueError(f"Invalid year: {year}. Must be one of {', '.join(valid_years)}.")
     
     outdir = './'
-    prepare_testsets(year, outdir, ifile, samples) #Adjust the input root file name accordingly using --ifile argument
+    prepare_testsets(year, outdir, ifile, samples, step_size=options.step_size, direct=options.direct, columns=parse_columns(options.columns)) #Adjust the input root file name accordingly using --ifile argument
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,169 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+
+# Purpose: run the conversion of convert_root_files.py over many ROOT files and years in a process pool.
+# Inputs are given as YEAR:GLOB pairs (--input, repeatable) and/or a file list with one "YEAR PATH_OR_GLOB" per line (--filelist).
+# Per-file status, timing and output paths are recorded in a JSON manifest; rerunning the same command skips the files
+# already marked as done, so a killed job resumes where it stopped.
+#
+# Example: python preprocessing/convert_root_files_parallel.py --input "UL18:/ceph/ULNtuples/UL18/*.root" --input "UL17:/ceph/ULNtuples/UL17/*.root" --jobs 16 --direct
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import optparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+#local imports
+from convert_root_files import convert_file, parse_columns, valid_years
+
+def output_name(sample, year, ifile):
+    # unique per input file, also for files with the same name in different directories
+    stem = os.path.splitext(os.path.basename(ifile))[0]
+    return "Eval_TTCR_{}_{}_{}_{}".format(sample, year, stem, hashlib.sha1(ifile.encode()).hexdigest()[:8])
+
+def collect_inputs(inputs, filelist):
+    pairs = list(inputs or [])
+    if filelist:
+        with open(filelist) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                year, pattern = line.split(None, 1)
+                pairs.append("{}:{}".format(year, pattern))
+
+    tasks = []
+    for pair in pairs:
+        year, pattern = pair.split(':', 1)
+        if year not in valid_years:
+            raise ValueError(f"Invalid year: {year}. Must be one of {', '.join(valid_years)}.")
+        files = sorted(glob.glob(pattern))
+        if not files:
+            print ("!!! No files match {} for {}".format(pattern, year))
+        for ifile in files:
+            tasks.append((year, os.path.abspath(ifile)))
+    return tasks
+
+def load_manifest(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+def save_manifest(manifest, path):
+    # write to a temporary file first so that a kill never leaves a truncated manifest
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def _clean_partial_outputs(opath, name):
+    # outputs of an interrupted conversion may be truncated, and convert skips files that already exist
+    for f in glob.glob(os.path.join(opath, name + '*.h5')) + glob.glob(os.path.join(opath, 'converted', name + '_*.awkd')):
+        os.remove(f)
+
+def _run_task(args):
+    year, ifile, sample, outdir, step_size, direct, columns = args
+    opath = outdir + 'ternary_training/{}/Eval'.format(year) + '/'
+    name = output_name(sample, year, ifile)
+    start = time.time()
+    result = {'year': year, 'input': ifile, 'sample': sample, 'start': start, 'pid': os.getpid()}
+    try:
+        os.makedirs(opath, exist_ok=True)
+        _clean_partial_outputs(opath, name)
+        result['outputs'] = convert_file(ifile, opath, sample, name, step_size=step_size, direct=direct, columns=columns)
+        result['status'] = 'done'
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['elapsed'] = time.time() - start
+    return result
+
+def run_tasks(func, tasks, jobs, record):
+    """Call record(func(task)) for every task in a pool of jobs processes. A task whose worker process dies (e.g.
+    killed by the OOM killer) is recorded as failed. That breaks the pool, so the other tasks running at that time
+    are recorded as failed too, and the remaining ones continue in a new pool."""
+    pending = list(tasks)
+    while pending:
+        # one task per child: ROOT/coffea do not release all memory between files
+        with ProcessPoolExecutor(max_workers=min(jobs, len(pending)), max_tasks_per_child=1) as executor:
+            running = {}
+            broken = False
+            while running or (pending and not broken):
+                # submit only up to jobs tasks, so that a broken pool takes down the running tasks only
+                while pending and not broken and len(running) < jobs:
+                    task = pending.pop(0)
+                    running[executor.submit(func, task)] = (task, time.time())
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, start = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool as e:
+                        broken = True
+                        year, ifile, sample = task[:3]
+                        result = {'year': year, 'input': ifile, 'sample': sample, 'start': start, 'status': 'failed',
+                                  'error': 'a worker process died while this file was converted, e.g. killed by the OOM killer ({})'.format(e),
+                                  'elapsed': time.time() - start}
+                    record(result)
+
+def main():
+
+    samples = ["Wto2Q"]
+
+    parser = optparse.OptionParser()
+    parser.add_option("--input", dest="inputs", action="append", help = "YEAR:GLOB of input root files, can be given several times", default= [])
+    parser.add_option("--filelist", dest="filelist", help = "Text file with one \"YEAR PATH_OR_GLOB\" per line", default= None)
+    parser.add_option("--jobs", "-j", dest="jobs", type="int", help = "Number of worker processes", default= os.cpu_count())
+    parser.add_option("--step_size", dest="step_size", type="int", help = "Stream each input tree in chunks of this many events, the full files are always converted", default= 100000)
+    parser.add_option("--direct", dest="direct", action="store_true", help = "Convert ROOT to .awkd directly, skipping the intermediate .h5 file", default= False)
+    parser.add_option("--columns", dest="columns", help = "Comma separated columns to compute and store, 'model' stands for the inputs of the default model (default: all)", default= None)
+    parser.add_option("--manifest", dest="manifest", help = "Path of the JSON manifest used to resume", default= "./ternary_training/conversion_manifest.json")
+    parser.add_option("--retry_failed", dest="retry_failed", action="store_true", help = "Also rerun files that failed in a previous run", default= False)
+    (options,args) = parser.parse_args()
+
+    outdir = './'
+    tasks = collect_inputs(options.inputs, options.filelist)
+    manifest_dir = os.path.dirname(options.manifest)
+    if manifest_dir and not os.path.isdir(manifest_dir):
+        os.makedirs(manifest_dir)
+    manifest = load_manifest(options.manifest)
+
+    todo = []
+    for year, ifile in tasks:
+        for sample in samples:
+            key = "{}:{}:{}".format(year, sample, ifile)
+            status = manifest.get(key, {}).get('status')
+            if status == 'done' or (status == 'failed' and not options.retry_failed):
+                continue
+            manifest[key] = {'year': year, 'input': ifile, 'sample': sample, 'status': 'pending'}
+            todo.append((year, ifile, sample, outdir, options.step_size, options.direct, parse_columns(options.columns)))
+    save_manifest(manifest, options.manifest)
+    print ("****** {} files to convert, {} already in the manifest *********".format(len(todo), len(tasks) * len(samples) - len(todo)))
+
+    if not todo:
+        return
+
+    results = []
+    def record(result):
+        key = "{}:{}:{}".format(result['year'], result['sample'], result['input'])
+        manifest[key] = result
+        save_manifest(manifest, options.manifest)
+        results.append(result)
+        print ("[{}/{}] {} {} ({:.1f} s)".format(len(results), len(todo), result['status'], result['input'], result['elapsed']))
+        if result['status'] == 'failed':
+            print (result['error'])
+    run_tasks(_run_task, todo, options.jobs, record)
+
+    nfailed = sum(1 for r in results if r['status'] == 'failed')
+    if nfailed:
+        print ("!!! {} of {} files failed in this run, see {} (rerun with --retry_failed)".format(nfailed, len(todo), options.manifest))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -34,16 +34,7 @@ def merge_df(first, second, index_ignore=True):
 def shuffle_df(dataset, random_state=42):
     return shuffle(dataset, random_state)
 
-# Jennet replaces what was originally here
-def prepare_input_dataset(sfile, samplename, treename="/Events"):
-
-    events = NanoEventsFactory.from_root(
-        {sfile:treename},
-        schemaclass=PFNanoAODSchema,
-        mode='eager',
-        entry_stop=100
-    ).events()
-
+def _jet_arrays(events, max_particles=115):
     jet0 = ak.firsts(events.FatJet)
 
     ak8_pf_candidates = events.FatJetPFCands
@@ -52,14 +43,7 @@ def prepare_input_dataset(sfile, samplename, treename="/Events"):
 
     pf_candidates = events.PFCands[jet0_constituents_indices]
 
-    first_115_pf = ak.pad_none(pf_candidates,115,clip=True)
-
-    df_px = pd.DataFrame((first_115_pf.px).to_list(),columns=["PF_Px_"+str(i) for i in range(0,115)])
-    df_py = pd.DataFrame((first_115_pf.py).to_list(),columns=["PF_Py_"+str(i) for i in range(0,115)])
-    df_pz = pd.DataFrame((first_115_pf.pz).to_list(),columns=["PF_Pz_"+str(i) for i in range(0,115)])
-    df_E  = pd.DataFrame((first_115_pf.E).to_list(),columns=["PF_E_"+str(i) for i in range(0,115)])
-    df_q  = pd.DataFrame((first_115_pf.charge).to_list(),columns=["PF_q_"+str(i) for i in range(0,115)])
-    df_w  = pd.DataFrame(events.Generator.weight,columns=["event_weight"])
+    first_pf = ak.pad_none(pf_candidates,max_particles,clip=True)
 
     # Now get the truth label
     def getWplusBosons(genparticles):
@@ -97,11 +81,63 @@ def prepare_input_dataset(sfile, samplename, treename="/Events"):
     best_match = ak.fill_none(ak.pad_none(best_match,1),3)
 
     label = ak.flatten(best_match - 1)
-    df_label = pd.DataFrame(label,columns=["truth_label"])
 
-    df = pd.concat([df_px,df_py,df_pz,df_E,df_q,df_w,df_label],axis=1)
-
-    return df
-
-    return dataset
+    return {
+        'PF_Px': first_pf.px,
+        'PF_Py': first_pf.py,
+        'PF_Pz': first_pf.pz,
+        'PF_E': first_pf.E,
+        'PF_q': first_pf.charge,
+        'event_weight': events.Generator.weight,
+        'truth_label': label,
+    }
+
+def _jet_arrays_to_df(arrays, max_particles=115):
+    frames = []
+    for prefix in ['PF_Px', 'PF_Py', 'PF_Pz', 'PF_E', 'PF_q']:
+        frames.append(pd.DataFrame((arrays[prefix]).to_list(),columns=[prefix+"_"+str(i) for i in range(0,max_particles)]))
+    frames.append(pd.DataFrame(arrays['event_weight'],columns=["event_weight"]))
+    frames.append(pd.DataFrame(arrays['truth_label'],columns=["truth_label"]))
+    return pd.concat(frames,axis=1)
+
+def _read_events(sfile, treename, entry_start=None, entry_stop=None):
+    return NanoEventsFactory.from_root(
+        {sfile:treename},
+        schemaclass=PFNanoAODSchema,
+        mode='eager',
+        entry_start=entry_start,
+        entry_stop=entry_stop
+    ).events()
 
+# Jennet replaces what was originally here
+def prepare_input_dataset(sfile, samplename, treename="/Events", entry_start=None, entry_stop=100):
+
+    events = _read_events(sfile, treename, entry_start=entry_start, entry_stop=entry_stop)
+
+    return _jet_arrays_to_df(_jet_arrays(events))
+
+def iterate_input_dataset(sfile, samplename, treename="/Events", step_size=100000, library="pd", entry_stop=None):
+    """Walk the tree (up to `entry_stop`, default: the full tree) in entry ranges of `step_size`
+    events, so that only one chunk of NanoEvents is held in memory at a time.
+
+    Yields one pandas DataFrame per chunk (library="pd"), with the same columns as
+    prepare_input_dataset, or the dict of awkward arrays it is built from (library="ak").
+    """
+    if library not in ("pd", "ak"):
+        raise ValueError(f"Invalid library: {library}. Must be one of pd, ak.")
+    if step_size < 1:
+        raise ValueError(f"Invalid step_size: {step_size}. Must be at least 1.")
+
+    with uproot.open(sfile) as f:
+        num_entries = f[treename.lstrip('/')].num_entries
+    if entry_stop is not None:
+        num_entries = min(num_entries, entry_stop)
+
+    for entry_start in range(0, num_entries, step_size):
+        entry_stop = min(entry_start + step_size, num_entries)
+        events = _read_events(sfile, treename, entry_start=entry_start, entry_stop=entry_stop)
+        arrays = _jet_arrays(events)
+        if library == "pd":
+            yield _jet_arrays_to_df(arrays)
+        else:
+            yield arrays
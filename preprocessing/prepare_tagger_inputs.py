@@ -11,12 +11,10 @@ import awkward
 from coffea.nanoevents.methods import vector
 from sklearn.preprocessing import MultiLabelBinarizer
 import logging
+from collections import OrderedDict
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
 
-def _transform(dataframe, mode, start=0, stop=-1, jet_size=0.8):
-    from collections import OrderedDict
-    v = OrderedDict()
-
+def _transform(dataframe, mode, start=0, stop=-1, jet_size=0.8, columns=None):
     df = dataframe.iloc[start:stop]
     #def _col_list(prefix, max_particles=77):
     def _col_list(prefix, max_particles=70):
@@ -31,30 +29,109 @@ def _transform(dataframe, mode, start=0, stop=-1, jet_size=0.8):
     mask = _e>0
     n_particles = np.sum(mask, axis=1)
 
-    px = awkward.Array(_px[mask])
-    py = awkward.Array(_py[mask])
-    pz = awkward.Array(_pz[mask])
-    energy = awkward.Array(_e[mask])
-    charge = awkward.Array(_q[mask])
+    px = awkward.unflatten(_px[mask], n_particles)
+    py = awkward.unflatten(_py[mask], n_particles)
+    pz = awkward.unflatten(_pz[mask], n_particles)
+    energy = awkward.unflatten(_e[mask], n_particles)
+    charge = awkward.unflatten(_q[mask], n_particles)
+
+    return _make_features(px, py, pz, energy, charge, n_particles, df['truth_label'], df['event_weight'].values, mode, columns=columns)
+
+def _transform_arrays(arrays, mode, start=0, stop=None, max_particles=70, columns=None):
+    """Same output as _transform, but starting from the per-jet PF-candidate jagged arrays
+    returned by data_utils.iterate_input_dataset(..., library="ak") instead of the wide
+    PF_Px_0..114 table, so no Python lists or DataFrames are built on the way."""
+    def _cands(prefix):
+        # padded (None) slots behave like the NaN columns of the table: dropped by the E>0 mask
+        return awkward.from_regular(awkward.fill_none(arrays[prefix][start:stop, :max_particles], 0), axis=1)
+
+    _e = _cands('PF_E')
+    mask = _e>0
+    n_particles = awkward.to_numpy(awkward.sum(mask, axis=1))
 
-    p4 = awkward.zip(
+    px = _cands('PF_Px')[mask]
+    py = _cands('PF_Py')[mask]
+    pz = _cands('PF_Pz')[mask]
+    energy = _e[mask]
+    charge = _cands('PF_q')[mask]
+
+    truth_label = awkward.to_numpy(arrays['truth_label'][start:stop])
+    event_weight = awkward.to_numpy(arrays['event_weight'][start:stop])
+
+    return _make_features(px, py, pz, energy, charge, n_particles, truth_label, event_weight, mode, columns=columns)
+
+# Derived columns: name -> (columns it needs, function computing it from the columns computed so far).
+# Names starting with '_' are intermediate results that are never written out.
+_derived = OrderedDict([
+    ('_p4', (('part_px', 'part_py', 'part_pz', 'part_energy'), lambda v: awkward.zip(
         {
-            "px": px,
-            "py": py,
-            "pz": pz,
-            "E": energy,
+            "px": v['part_px'],
+            "py": v['part_py'],
+            "pz": v['part_pz'],
+            "E": v['part_energy'],
         },
         with_name="PtEtaPhiMLorentzVector",
         behavior=vector.behavior,
-    )
-
+    ))),
 #    .TLorentzVectorArray.from_cartesian(px, py, pz, energy)
-    pt = p4.pt
+    ('_pt', (('_p4',), lambda v: v['_p4'].pt)),
+    ('_jet_p4', (('_p4',), lambda v: v['_p4'])),
+
+    ('jet_pt', (('_jet_p4',), lambda v: v['_jet_p4'].pt)),
+    ('jet_eta', (('_jet_p4',), lambda v: v['_jet_p4'].eta)),
+    ('jet_phi', (('_jet_p4',), lambda v: v['_jet_p4'].phi)),
+    ('jet_mass', (('_jet_p4',), lambda v: v['_jet_p4'].mass)),
 
-    jet_p4 = p4
+    ('part_pt_log', (('_pt',), lambda v: np.log(v['_pt']))),
+    ('part_ptrel', (('_pt', 'jet_pt'), lambda v: v['_pt']/v['jet_pt'])),
+    ('part_logptrel', (('part_ptrel',), lambda v: np.log(v['part_ptrel']))),
+
+    ('part_e_log', (('part_energy',), lambda v: np.log(v['part_energy']))),
+    ('part_erel', (('part_energy', '_jet_p4'), lambda v: v['part_energy']/v['_jet_p4'].energy)),
+    ('part_logerel', (('part_erel',), lambda v: np.log(v['part_erel']))),
+
+    ('part_raw_etarel', (('_p4', 'jet_eta'), lambda v: (v['_p4'].eta - v['jet_eta']))),
+    ('_jet_etasign', (('jet_eta',), lambda v: np.sign(v['jet_eta']))),
+#    _jet_etasign[_jet_etasign==0] = 1
+    ('part_etarel', (('part_raw_etarel', '_jet_etasign'), lambda v: v['part_raw_etarel'] * v['_jet_etasign'])),
+
+    ('part_phirel', (('_p4', '_jet_p4'), lambda v: v['_p4'].delta_phi(v['_jet_p4']))),
+    ('part_deltaR', (('part_etarel', 'part_phirel'), lambda v: np.hypot(v['part_etarel'], v['part_phirel']))),
+])
+
+# Every column that can be written, in output order. label and event_weight are always written.
+all_columns = ['jet_pt', 'jet_eta', 'jet_phi', 'jet_mass', 'n_parts',
+               'part_px', 'part_py', 'part_pz', 'part_energy', 'part_charge',
+               'part_pt_log', 'part_ptrel', 'part_logptrel',
+               'part_e_log', 'part_erel', 'part_logerel',
+               'part_raw_etarel', 'part_etarel',
+               'part_phirel', 'part_deltaR']
+
+def feature_columns(feature_dict, extra=()):
+    """The columns a model with this feature_dict (see load_datasets.Dataset) reads, plus `extra`"""
+    columns = [col for cols in feature_dict.values() for col in (cols if isinstance(cols, (list, tuple)) else [cols])]
+    unknown = [col for col in list(columns) + list(extra) if col not in all_columns]
+    if unknown:
+        raise ValueError('Unknown column(s) %s. Must be one of %s.' % (', '.join(unknown), ', '.join(all_columns)))
+    return [col for col in all_columns if col in set(columns) | set(extra)]
+
+def _compute(v, name):
+    if name in v:
+        return v[name]
+    if name not in _derived:
+        raise ValueError('Unknown column %s. Must be one of %s.' % (name, ', '.join(all_columns)))
+    deps, func = _derived[name]
+    for dep in deps:
+        _compute(v, dep)
+    v[name] = func(v)
+    return v[name]
+
+def _make_features(px, py, pz, energy, charge, n_particles, old_label, event_weight, mode, columns=None):
+    """Output columns for the jets: label, event_weight and `columns` (default: all_columns).
+    Only the derived quantities the requested columns depend on are computed."""
+    v = OrderedDict()
 
     # outputs
-    old_label = df['truth_label']
     #if mode == "binary":
     #    new_label = [[1,0] if i == -1 else [0,1] for i in old_label]
     #    new_label = np.array(new_label)
@@ -76,34 +153,18 @@ def _transform(dataframe, mode, start=0, stop=-1, jet_size=0.8):
     
     v['label'] = np.array(new_label)
 
-    v['event_weight'] = df['event_weight'].values
-    v['jet_pt'] = jet_p4.pt
-    v['jet_eta'] = jet_p4.eta
-    v['jet_phi'] = jet_p4.phi
-    v['jet_mass'] = jet_p4.mass
-    v['n_parts'] = n_particles
-
-    v['part_px'] = px
-    v['part_py'] = py
-    v['part_pz'] = pz
-    v['part_energy'] = energy
-    v['part_charge'] = charge
-
-    v['part_pt_log'] = np.log(pt)
-    v['part_ptrel'] = pt/v['jet_pt']
-    v['part_logptrel'] = np.log(v['part_ptrel'])
-
-    v['part_e_log'] = np.log(energy)
-    v['part_erel'] = energy/jet_p4.energy
-    v['part_logerel'] = np.log(v['part_erel'])
-
-    v['part_raw_etarel'] = (p4.eta - v['jet_eta'])
-    _jet_etasign = np.sign(v['jet_eta'])
-#    _jet_etasign[_jet_etasign==0] = 1
-    v['part_etarel'] = v['part_raw_etarel'] * _jet_etasign
+    v['event_weight'] = event_weight
 
-    v['part_phirel'] = p4.delta_phi(jet_p4)
-    v['part_deltaR'] = np.hypot(v['part_etarel'], v['part_phirel'])
+    computed = {
+        'n_parts': n_particles,
+        'part_px': px,
+        'part_py': py,
+        'part_pz': pz,
+        'part_energy': energy,
+        'part_charge': charge,
+    }
+    for name in (all_columns if columns is None else columns):
+        v[name] = _compute(computed, name)
 
     def _make_image(var_img, rec, n_pixels = 64, img_ranges = [[-0.8, 0.8], [-0.8, 0.8]]):
         wgt = rec[var_img]
@@ -119,7 +180,7 @@ def _transform(dataframe, mode, start=0, stop=-1, jet_size=0.8):
 
     return v
 
-def convert(source, destdir, basename, mode, step=None, limit=None):
+def convert(source, destdir, basename, mode, step=None, limit=None, columns=None):
     df = pd.read_hdf(source, key='table')
     logging.info('Total events: %s' % str(df.shape[0]))
     if limit is not None:
@@ -127,6 +188,7 @@ def convert(source, destdir, basename, mode, step=None, limit=None):
         logging.info('Restricting to the first %s events:' % str(df.shape[0]))
     if step is None:
         step = df.shape[0]
+    outputs = []
     idx=-1
     while True:
         idx+=1
@@ -136,10 +198,29 @@ def convert(source, destdir, basename, mode, step=None, limit=None):
             os.makedirs(destdir)
         output = os.path.join(destdir, '%s_%d.awkd'%(basename, idx))
         logging.info(output)
+        outputs.append(output)
         if os.path.exists(output):
             logging.warning('... file already exist: continue ...')
             continue
-        v=_transform(df, mode, start=start, stop=start+step)
+        v=_transform(df, mode, start=start, stop=start+step, columns=columns)
         awkward.to_parquet(v, output)
+    return outputs
 
+def convert_root(source, destdir, basename, mode, treename="/Events", step=100000, columns=None, entry_stop=None):
+    """Convert a PFNano ROOT file (up to `entry_stop` events) directly to .awkd parquet files, one per
+    chunk of `step` events, without the intermediate pandas DataFrame and .h5 file used by convert."""
+    from data_utils import iterate_input_dataset
 
+    if not os.path.exists(destdir):
+        os.makedirs(destdir)
+    outputs = []
+    for idx, arrays in enumerate(iterate_input_dataset(source, basename, treename=treename, step_size=step, library="ak", entry_stop=entry_stop)):
+        output = os.path.join(destdir, '%s_%d.awkd'%(basename, idx))
+        logging.info(output)
+        outputs.append(output)
+        if os.path.exists(output):
+            logging.warning('... file already exist: continue ...')
+            continue
+        v=_transform_arrays(arrays, mode, columns=columns)
+        awkward.to_parquet(v, output)
+    return outputs
@@ -0,0 +1,127 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+#
+# Post-training quantization of the exported ParticleNet-Lite (export_model.py --onnx) with onnxruntime, and a report
+# of the agreement with the float model, the ROC AUCs and the CPU throughput of each quantized model.
+#
+#   dynamic:   int8 weights, activations quantized on the fly
+#   int8:      int8 weights and activations, activation ranges calibrated on --calibration_jets jets
+#   int8_conv: as int8, but only the 1x1 convolutions and the Dense layers are quantized: the coordinates and distance
+#              matrices of the kNN stay in float, so that the neighbours of each particle are the same as in the float model
+#
+# python quantize_model.py --year UL18 --modes dynamic,int8,int8_conv
+
+import os
+import json
+import time
+import optparse
+import numpy as np
+from sklearn.metrics import roc_auc_score
+from load_datasets import Dataset
+from exported_model import ExportedModel
+
+class_names = ['Wp', 'Wn', 'Z']
+
+def quantize(model_path, output, mode, calibration_X=None, batch_size=256):
+    """Write the quantized version (mode: dynamic, int8 or int8_conv) of the float .onnx model_path to output"""
+    import onnx
+    from onnxruntime.quantization import quantize_dynamic, quantize_static, CalibrationDataReader, QuantFormat, QuantType
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    prepared = output + '.prepared'
+    quant_pre_process(model_path, prepared, skip_symbolic_shape=True)
+    try:
+        graph = onnx.load(prepared).graph
+        if mode == 'dynamic':
+            quantize_dynamic(prepared, output, weight_type=QuantType.QInt8)
+            return
+        onnx_names = [i.name for i in graph.input]
+
+        class Reader(CalibrationDataReader):
+            def __init__(self):
+                n = len(calibration_X[onnx_names[0].split(':')[0]])
+                self.batches = iter([{name:calibration_X[name.split(':')[0]][start:start + batch_size] for name in onnx_names} for start in range(0, n, batch_size)])
+            def get_next(self):
+                return next(self.batches, None)
+
+        kwargs = {}
+        if mode == 'int8_conv':
+            # the only MatMuls outside of the Dense layers are the distance matrices of the EdgeConvs
+            kwargs['op_types_to_quantize'] = ['Conv', 'MatMul']
+            kwargs['nodes_to_exclude'] = [node.name for node in graph.node if node.op_type == 'MatMul' and 'dense' not in node.name]
+        quantize_static(prepared, output, Reader(), quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, **kwargs)
+    finally:
+        os.remove(prepared)
+
+def evaluate(model, X, batch_size=256):
+    """Scores of X and jets/s of an ExportedModel"""
+    model.predict_on_batch({k:v[:batch_size] for k, v in X.items()})  # warm up
+    t0 = time.perf_counter()
+    scores = model.predict(X, batch_size=batch_size)
+    return scores, len(scores) / (time.perf_counter() - t0)
+
+def compare(reference, scores, y=None):
+    """Agreement of scores with the reference scores of the float model, and ROC AUCs if the labels y are known"""
+    diff = np.abs(scores - reference)
+    ref_class, cls = np.argmax(reference, axis=1), np.argmax(scores, axis=1)
+    result = {
+        'max_abs_diff': float(diff.max()),
+        'mean_abs_diff': float(diff.mean()),
+        'agreement': float(np.mean(ref_class == cls)),
+        'class_agreement': {name:float(np.mean(cls[ref_class == c] == c)) if np.any(ref_class == c) else None for c, name in enumerate(class_names)},
+        }
+    if y is not None:
+        truth = np.argmax(y, axis=1)
+        result['auc'] = {name:float(roc_auc_score(truth == c, scores[:, c])) for c, name in enumerate(class_names) if 0 < np.sum(truth == c) < len(truth)}
+        # charge separation: W+ against W- jets with p(W+) / (p(W+) + p(W-))
+        w = truth < 2
+        if 0 < np.sum(truth[w] == 0) < np.sum(w):
+            result['auc']['Wp_vs_Wn'] = float(roc_auc_score(truth[w] == 0, scores[w, 0] / np.maximum(scores[w, 0] + scores[w, 1], 1e-12)))
+    return result
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--year", help = "UL16preVFP, UL16postVFP, UL17, UL18", default= "UL18")
+    parser.add_option("--model", help = "Float .onnx model written by export_model.py --onnx", default= "./modelfiles/{year}/exported/model.onnx")
+    parser.add_option("--data", help = "Converted .awkd file with labels, for the calibration and the report", default= "preprocessing/ternary_training/{year}/converted/WpWnZ_val_{year}_0.awkd")
+    parser.add_option("--calibration_jets", type="int", help = "Number of jets to calibrate the activation ranges on", default= 2000)
+    parser.add_option("--eval_jets", type="int", help = "Number of jets for the report, after the calibration jets", default= 20000)
+    parser.add_option("--modes", help = "Comma separated: dynamic, int8, int8_conv", default= "dynamic,int8,int8_conv")
+    parser.add_option("--batch_size", type="int", default= 256)
+    parser.add_option("--threads", type="int", help = "Intra-op threads of onnxruntime (0: default)", default= 1)
+    parser.add_option("--report", help = "JSON report, default quantization_report.json next to --model", default= None)
+    (options,args) = parser.parse_args()
+
+    model_path = options.model.format(year=options.year)
+    if not os.path.exists(model_path):
+        parser.error('%s not found, run export_model.py --onnx first' % model_path)
+    dataset = Dataset(options.data.format(year=options.year), data_format='channel_last')
+    calibration_X = {k:v[:options.calibration_jets] for k, v in dataset.X.items()}
+    eval_slice = slice(options.calibration_jets, options.calibration_jets + options.eval_jets)
+    X = {k:v[eval_slice] for k, v in dataset.X.items()}
+    y = dataset.y[eval_slice] if dataset.y is not None else None
+    if len(X['points']) == 0:
+        parser.error('no jets left for the report after the %d calibration jets' % options.calibration_jets)
+
+    reference, reference_rate = evaluate(ExportedModel(model_path, threads=options.threads), X, options.batch_size)
+    report = {'model': os.path.abspath(model_path), 'data': os.path.abspath(dataset.filepath), 'jets': len(reference), 'threads': options.threads,
+              'float': dict(compare(reference, reference, y), jets_per_s=reference_rate, size=os.path.getsize(model_path))}
+    for mode in options.modes.split(','):
+        output = model_path.replace('.onnx', '.%s.onnx' % mode)
+        quantize(model_path, output, mode, calibration_X, options.batch_size)
+        scores, rate = evaluate(ExportedModel(output, threads=options.threads), X, options.batch_size)
+        report[mode] = dict(compare(reference, scores, y), jets_per_s=rate, speedup=rate / reference_rate, size=os.path.getsize(output), path=os.path.abspath(output))
+
+    print ("{:>10s} {:>10s} {:>8s} {:>12s} {:>10s} {:>30s}".format("model", "jets/s", "speedup", "max |diff|", "agreement", "AUC " + "/".join(class_names) + "/Wp_vs_Wn"))
+    for mode in ['float'] + options.modes.split(','):
+        r = report[mode]
+        auc = "/".join("{:.4f}".format(v) for v in r.get('auc', {}).values())
+        print ("{:>10s} {:>10.0f} {:>7.2f}x {:>12.2e} {:>9.2%} {:>30s}".format(mode, r['jets_per_s'], r.get('speedup', 1.), r['max_abs_diff'], r['agreement'], auc))
+    report_path = options.report or os.path.join(os.path.dirname(model_path), 'quantization_report.json')
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print ("Report written to {}".format(report_path))
+
+if __name__ == "__main__":
+    main()
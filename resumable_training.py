@@ -0,0 +1,199 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+#
+# Full training state of keras_train_multi.py, so that a run on a preemptible batch slot continues where it stopped
+# (keras_train_multi.py --checkpoint_steps N, --resume) instead of starting again from epoch 0.
+#
+# TrainingState is a Keras callback that writes, every save_steps training steps, at the end of every epoch and when
+# the process gets SIGTERM (the usual notice of a batch system before it kills a job):
+#   - a tf.train.Checkpoint of the model and the optimizer (weights, Adam moments and iteration count),
+#   - state.json with the position (epoch and step in the epoch), the RNG state of the training BatchSampler at the
+#     start of that epoch, the state of EarlyStopping and ModelCheckpoint, the history of the finished epochs and the
+#     state of the global numpy RNG.
+# The learning rate follows from the epoch (LearningRateScheduler). A resumed run regenerates the batches of the
+# interrupted epoch from the sampler RNG state and skips the ones already trained on, so it sees the same batches in
+# the same order as an uninterrupted run. Not restored are the dropout masks, which come from the op seeds of
+# TensorFlow, and the epoch metrics of the interrupted epoch, which cover its remaining steps only (Keras resets them
+# in every fit).
+#
+# The state directory keeps the last `keep` checkpoints, state.json is replaced atomically after the checkpoint it
+# points to is complete, so a kill during a save leaves the previous state usable.
+
+import os
+import json
+import glob
+import signal
+import logging
+import threading
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+STATE_FILE = 'state.json'
+
+# callback attributes that Keras resets in on_train_begin
+TRACKED_ATTRIBUTES = {'EarlyStopping': ['wait', 'stopped_epoch', 'best', 'best_epoch'],
+                      'ModelCheckpoint': ['best']}
+
+class Preempted(Exception):
+    """Raised out of model.fit after the state was saved on SIGTERM"""
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def read_state(state_dir):
+    """The saved state.json of state_dir as a dict, None if there is none"""
+    path = os.path.join(state_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+class TrainingState(keras.callbacks.Callback):
+    """Periodic full-state checkpoints of a model.fit in state_dir.
+
+    samplers: {name: BatchSampler} whose epochs are the epochs of the fit (iterated with len() batches per epoch),
+        e.g. {'train': train_batches}. Not the validation samplers: Keras starts a new iterator for every validation.
+    callbacks: the callbacks whose state is kept (EarlyStopping and ModelCheckpoint, see TRACKED_ATTRIBUTES).
+    save_steps: save every save_steps training steps of an epoch, 0 for the end of the epochs only.
+    handle_sigterm: on SIGTERM save at the end of the running step and raise Preempted.
+
+    Usage: state.restore(model) after compile (with --resume), then state.fit(model, ...) instead of model.fit.
+    """
+
+    def __init__(self, state_dir, samplers=None, callbacks=(), save_steps=0, handle_sigterm=True, keep=2):
+        super().__init__()
+        self.state_dir = state_dir
+        self.samplers = samplers or {}
+        self.tracked = [c for c in callbacks if type(c).__name__ in TRACKED_ATTRIBUTES]
+        self.save_steps = save_steps
+        self.handle_sigterm = handle_sigterm
+        self.keep = keep
+        self.epoch = 0
+        self.step = 0
+        self.history = {}
+        self.preempted = False
+        self._start_step = 0
+        self._callback_state = {}
+        self._checkpoint = None
+        self._written = []
+        self._previous_handler = None
+        os.makedirs(state_dir, exist_ok=True)
+
+    def _get_checkpoint(self, model):
+        if self._checkpoint is None:
+            # create the optimizer variables now, so that they are restored right away
+            model.optimizer.build(model.trainable_variables)
+            self._checkpoint = tf.train.Checkpoint(model=model, optimizer=model.optimizer)
+        return self._checkpoint
+
+    def restore(self, model, state_dir=None):
+        """Load the state saved in state_dir (default: the own one) into model, the samplers and the callbacks.
+        Returns the saved state (None if there is none, then nothing is changed)."""
+        state_dir = state_dir or self.state_dir
+        state = read_state(state_dir)
+        if state is None:
+            return None
+        self._get_checkpoint(model).read(os.path.join(state_dir, state['checkpoint'])).assert_existing_objects_matched()
+        for name, sampler in self.samplers.items():
+            sampler.restore(state['samplers'][name], state['epoch'])
+        np.random.set_state(tuple(np.array(v, dtype=np.uint32) if i == 1 else v for i, v in enumerate(state['numpy_random'])))
+        self.epoch, self.step, self._start_step = state['epoch'], state['step'], state['step']
+        self.history = state['history']
+        self._written = [state['checkpoint']]
+        self._callback_state = state['callbacks']
+        logging.info('Resuming from epoch %d, step %d (%s)' % (self.epoch + 1, self.step, state_dir))
+        return state
+
+    def fit(self, model, data, steps_per_epoch, epochs, **kwargs):
+        """model.fit from the restored position up to epochs. data(start) gives the training data from batch start of
+        the current epoch and the validation data. An interrupted epoch is finished by a fit of its remaining steps
+        first. Raises Preempted after a save on SIGTERM, returns False if EarlyStopping stopped the training."""
+        if self.step >= steps_per_epoch:
+            raise ValueError('the saved state is at step %d of an epoch of %d steps' % (self.step, steps_per_epoch))
+        try:
+            if self.step:
+                self._fit(model, data, self.step, steps_per_epoch - self.step, self.epoch + 1, **kwargs)
+            if self.epoch < epochs and not self.stopped():
+                self._fit(model, data, 0, steps_per_epoch, epochs, **kwargs)
+        finally:
+            self._restore_handler()
+        return not self.stopped()
+
+    def _fit(self, model, data, start, steps_per_epoch, epochs, **kwargs):
+        # the samplers may have run ahead into the next epoch for the previous fit
+        for sampler in self.samplers.values():
+            sampler.restore(sampler.state_at(self.epoch), self.epoch)
+        x, validation_data = data(start)
+        model.fit(x, steps_per_epoch=steps_per_epoch, initial_epoch=self.epoch, epochs=epochs, validation_data=validation_data, **kwargs)
+
+    def stopped(self):
+        return any(getattr(c, 'stopped_epoch', 0) > 0 for c in self.tracked)
+
+    def save(self):
+        """Write the checkpoint of the current position and point state.json to it"""
+        name = 'ckpt-%d-%d' % (self.epoch, self.step)
+        self._get_checkpoint(self.model).write(os.path.join(self.state_dir, name))
+        state = {'epoch': self.epoch,
+                 'step': self.step,
+                 'checkpoint': name,
+                 'samplers': {k: sampler.state_at(self.epoch) for k, sampler in self.samplers.items()},
+                 'callbacks': self._capture(),
+                 'history': self.history,
+                 'numpy_random': [v.tolist() if isinstance(v, np.ndarray) else v for v in np.random.get_state()]}
+        path = os.path.join(self.state_dir, STATE_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+        self._written = ([w for w in self._written if w != name] + [name])[-self.keep:]
+        for f in glob.glob(os.path.join(self.state_dir, 'ckpt-*')):
+            if os.path.basename(f).split('.')[0] not in self._written:
+                os.remove(f)
+
+    def _capture(self):
+        return {type(c).__name__: {a: _to_json(getattr(c, a)) for a in TRACKED_ATTRIBUTES[type(c).__name__]} for c in self.tracked}
+
+    def _on_sigterm(self, signum, frame):
+        logging.warning('SIGTERM, saving the training state after this step')
+        self.preempted = True
+
+    def on_train_begin(self, logs=None):
+        # after the tracked callbacks reset themselves
+        for c in self.tracked:
+            for a, value in self._callback_state.get(type(c).__name__, {}).items():
+                setattr(c, a, value)
+        if self.handle_sigterm and threading.current_thread() is threading.main_thread():
+            self._previous_handler = signal.signal(signal.SIGTERM, self._on_sigterm)
+
+    def on_train_end(self, logs=None):
+        self._callback_state = self._capture()
+        self._restore_handler()
+
+    def _restore_handler(self):
+        if self._previous_handler is not None:
+            signal.signal(signal.SIGTERM, self._previous_handler)
+            self._previous_handler = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch, self.step, self._start_step = epoch, self._start_step, 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step += 1
+        # after the last step the state is saved at the end of the epoch, a saved step is always < steps_per_epoch
+        if batch + 1 >= self.params['steps']:
+            return
+        if self.preempted:
+            self.save()
+            raise Preempted('training state saved at epoch %d, step %d' % (self.epoch + 1, self.step))
+        if self.save_steps and self.step % self.save_steps == 0:
+            self.save()
+
+    def on_epoch_end(self, epoch, logs=None):
+        for k, v in (logs or {}).items():
+            self.history.setdefault(k, []).append(float(v))
+        self.epoch, self.step = epoch + 1, 0
+        self.save()
+        if self.preempted:
+            raise Preempted('training state saved at the end of epoch %d' % (epoch + 1))
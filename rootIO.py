@@ -3,6 +3,7 @@
 
 # imports from standard python
 from __future__ import print_function
+import os
 import sys
 from array import array
 import glob
@@ -16,301 +17,160 @@ import ROOT
 from ROOT import TFile, TTree, TH1F
 
 # imports from pip packages
-from tqdm import tqdm
 import pandas as pd
 import numpy as np
 #from numpy.lib.recfunctions import stack_arrays
 #from root_pandas import read_root, to_root
 #from root_numpy import root2array, tree2array, array2tree, array2root, root2rec
 
-def add_branch(filename, treename, branchname, branchtype, data):
+# numpy dtype -> (ROOT leaf type code, C++ type). The C++ types are those cppyy maps the numpy buffers to
+# (int64 is `long` on 64-bit Linux, not Long64_t = `long long`), the leaf codes keep the ROOT widths.
+_root_types = {
+    'float64': ('D', 'double'),
+    'float32': ('F', 'float'),
+    'int64': ('L', 'long'),
+    'int32': ('I', 'int'),
+    'int16': ('S', 'short'),
+    'int8': ('B', 'signed char'),
+    'uint64': ('l', 'unsigned long'),
+    'uint32': ('i', 'unsigned int'),
+    'uint16': ('s', 'unsigned short'),
+    'uint8': ('b', 'unsigned char'),
+    'bool': ('O', 'bool'),
+}
+
+# cppyy does not convert int8 buffers to `const signed char*`, they are passed as the same bytes read as uint8
+_buffer_types = {'int8': ('uint8', 'unsigned char')}
+
+_fill_branch_declared = False
+
+def _declare_fill_branch():
+    # the entry loop runs in compiled code instead of one GetEntry/Fill round trip through Python per entry
+    global _fill_branch_declared
+    if _fill_branch_declared:
+        return
+    ROOT.gInterpreter.Declare("""
+    template <typename T, typename D>
+    void jetchargetagger_fill_branch(TTree* tree, const char* name, const char* leaflist, const D* data, Long64_t n)
+    {
+        T value;
+        TBranch* branch = tree->Branch(name, &value, leaflist);
+        for (Long64_t i = 0; i < n; ++i) {
+            value = data[i];
+            branch->Fill();
+        }
+        branch->ResetAddress();
+    }
+    """)
+    _fill_branch_declared = True
+
+def add_branches(filename, treename, branches, ofilename=None, suffix='_jetchargetaggerMulti', friend=False):
+    """Copy the tree `treename` of `filename` to a new file and add one branch per item of `branches`.
+
+    branches: dict of branch name -> 1D numpy array with one value per tree entry. The branch type
+        follows the array dtype (see _root_types), e.g. float64 -> /D, float32 -> /F, int32 -> /I.
+    ofilename: output file, by default `filename` with `suffix` (+ '_friend') inserted before '.root'.
+    friend: if True, do not copy the input tree. The output file only holds a tree with the same name
+        and number of entries containing the new branches, to be attached with add_friend.
+    Returns the name of the output file.
+    """
+    if ofilename is None:
+        ofilename = os.path.splitext(filename)[0] + suffix + ('_friend' if friend else '') + '.root'
+
+    columns = {}
+    for branchname, data in branches.items():
+        data = np.ascontiguousarray(data)
+        if data.dtype.name not in _root_types:
+            raise ValueError('unsupported dtype %s for branch %s' % (data.dtype, branchname))
+        columns[branchname] = data
+    _declare_fill_branch()
 
     # open input file and tree
     ifile = TFile(filename,'READ')
     itree = ifile.Get(treename)
 
-    ofilename = filename.rstrip('.root') + '_jetchargetagger_WpWn.root'
-    # create output file
-    ofile = TFile(ofilename,'RECREATE')
-
-    # clone tree, FIX: hardcoded
-    #ofile.mkdir('utm')
-    #ofile.cd('utm')
-
-    # set branch inactive in itree if it already exists
-    if itree.FindBranch(branchname):
-        itree.SetBranchStatus(branchname,0)
-
-    # clone itree
-    print('--- Cloning input file ...')
-    otree = itree.CloneTree()
-    otree.Write()
-
-    # make new variable and add it as a branch to the tree
-    y_helper = array(branchtype.lower(),[0])
-    branch = otree.Branch(branchname, y_helper, branchname + '/' + branchtype)
-
     # get number of entries and check if size matches the data
-    n_entries = otree.GetEntries()
-    if n_entries != data.size:
-        print('mismatch in input tree entries and new branch entries!')
+    n_entries = itree.GetEntries()
+    for branchname, data in columns.items():
+        if n_entries != data.size:
+            ifile.Close()
+            raise ValueError('mismatch in input tree entries (%d) and new branch %s entries (%d)!' % (n_entries, branchname, data.size))
 
-    # fill the branch
-    print('--- Adding branch %s in %s:%s ...' %(branchname, filename, treename))
-    for i in tqdm(range(n_entries)):
-        otree.GetEntry(i)
-        y_helper[0] = data[i]
-        branch.Fill()
-
-    # write new branch to the tree
-    ofile.Write("",TFile.kOverwrite)
-
-    # close input file
-    ifile.Close()
+    ofile = TFile(ofilename,'RECREATE')
+    if friend:
+        # only the new branches, aligned entry by entry with itree
+        otree = TTree(itree.GetName(), itree.GetTitle())
+    else:
+        # set branch inactive in itree if it already exists
+        for branchname in columns:
+            if itree.FindBranch(branchname):
+                itree.SetBranchStatus(branchname,0)
+
+        # clone itree, copying the compressed baskets without unzipping them
+        print('--- Cloning input file ...')
+        otree = itree.CloneTree(-1, 'fast')
+
+    # fill the branches
+    for branchname, data in columns.items():
+        print('--- Adding branch %s in %s:%s ...' %(branchname, filename, treename))
+        typecode, ctype = _root_types[data.dtype.name]
+        buffertype, buffer_ctype = _buffer_types.get(data.dtype.name, (data.dtype.name, ctype))
+        ROOT.jetchargetagger_fill_branch[ctype, buffer_ctype](otree, branchname, branchname + '/' + typecode, data.view(buffertype), n_entries)
+
+    if friend:
+        otree.SetEntries(n_entries)
+
+    # write the tree with the new branches
+    otree.Write("",TFile.kOverwrite)
 
     # close output file
     ofile.Close()
 
-    # overwrite old file
-    #print('--- Overwrite original file ...')
-    #shutil.move(filename + '.mist', filename)
-
-#def add_branches(filename, treename, branchname1, branchtype1, data1, branchname2, branchtype2, data2):
-#
-#    # open input file and tree
-#    ifile = TFile(filename,'READ')
-#    itree = ifile.Get(treename)
-#
-#    ofilename = filename.rstrip('.root') + '_jetchargetaggerMulti.root'
-#    # create output file
-#    ofile = TFile(ofilename,'RECREATE')
-#
-#    # clone tree, FIX: hardcoded
-#    #ofile.mkdir('utm')
-#    #ofile.cd('utm')
-#
-#    # set branch inactive in itree if it already exists
-#    if itree.FindBranch(branchname1):
-#        itree.SetBranchStatus(branchname1,0)
-#    if itree.FindBranch(branchname2):
-#        itree.SetBranchStatus(branchname2,0)
-#    # clone itree
-#    print('--- Cloning input file ...')
-#    otree = itree.CloneTree()
-#    otree.Write()
-#
-#    # make new variable and add it as a branch to the tree
-#    y_helper1 = array(branchtype1.lower(),[0])
-#    branch1 = otree.Branch(branchname1, y_helper1, branchname1 + '/' + branchtype1)
-#    y_helper2 = array(branchtype2.lower(),[0])
-#    branch2 = otree.Branch(branchname2, y_helper2, branchname2 + '/' + branchtype2)
-#
-#    # get number of entries and check if size matches the data
-#    n_entries = otree.GetEntries()
-#    print (n_entries)
-#    print (data1.size)
-#    print (data2.size)
-#    if n_entries != data1.size:
-#        print('mismatch in input tree entries and new branch1 entries!')
-#    if n_entries != data2.size:
-#        print('mismatch in input tree entries and new branch2 entries!')
-#
-#    # fill the branch
-#    print('--- Adding branch %s in %s:%s ...' %(branchname1, filename, treename))
-#    print('--- Adding branch %s in %s:%s ...' %(branchname2, filename, treename))
-#    for i in tqdm(range(n_entries)):
-#        otree.GetEntry(i)
-#        y_helper1[0] = data1[i]
-#        branch1.Fill()
-#        y_helper2[0] = data2[i]
-#        branch2.Fill()
-#
-#    # write new branch to the tree
-#    ofile.Write("",TFile.kOverwrite)
-#
-#    # close input file
-#    ifile.Close()
-#
-#    # close output file
-#    ofile.Close()
-
-    # overwrite old file
-    #print('--- Overwrite original file ...')
-    #shutil.move(filename + '.mist', filename)
-
-def add_fourbranches(filename, treename, branchname1, branchtype1, data1, branchname2, branchtype2, data2, branchname3, branchtype3, data3, branchname4, branchtype4, data4):
-
-    # open input file and tree
-    ifile = TFile(filename,'READ')
-    itree = ifile.Get(treename)
-
-    ofilename = filename.rstrip('.root') + '_jetchargetaggerMulti.root'
-    # create output file
-    ofile = TFile(ofilename,'RECREATE')
-
-    # clone tree, FIX: hardcoded
-    #ofile.mkdir('utm')
-    #ofile.cd('utm')
-
-    # set branch inactive in itree if it already exists
-    if itree.FindBranch(branchname1):
-        itree.SetBranchStatus(branchname1,0)
-    if itree.FindBranch(branchname2):
-        itree.SetBranchStatus(branchname2,0)
-    if itree.FindBranch(branchname3):
-        itree.SetBranchStatus(branchname3,0)
-    if itree.FindBranch(branchname4):
-        itree.SetBranchStatus(branchname4,0)
-    # clone itree
-    print('--- Cloning input file ...')
-    otree = itree.CloneTree()
-    otree.Write()
-
-    # make new variable and add it as a branch to the tree
-    y_helper1 = array(branchtype1.lower(),[0])
-    branch1 = otree.Branch(branchname1, y_helper1, branchname1 + '/' + branchtype1)
-    y_helper2 = array(branchtype2.lower(),[0])
-    branch2 = otree.Branch(branchname2, y_helper2, branchname2 + '/' + branchtype2)
-    y_helper3 = array(branchtype3.lower(),[0])
-    branch3 = otree.Branch(branchname3, y_helper3, branchname3 + '/' + branchtype3)
-    y_helper4 = array(branchtype4.lower(),[0])
-    branch4 = otree.Branch(branchname4, y_helper4, branchname4 + '/' + branchtype4)
-
-    # get number of entries and check if size matches the data
-    n_entries = otree.GetEntries()
-    print (n_entries)
-    print (data1.size)
-    print (data2.size)
-    print (data3.size)
-    print (data4.size)
-    if n_entries != data1.size:
-        print('mismatch in input tree entries and new branch1 entries!')
-    if n_entries != data2.size:
-        print('mismatch in input tree entries and new branch2 entries!')
-    if n_entries != data3.size:
-        print('mismatch in input tree entries and new branch3 entries!')
-    if n_entries != data4.size:
-        print('mismatch in input tree entries and new branch4 entries!')
-
-    # fill the branch
-    print('--- Adding branch %s in %s:%s ...' %(branchname1, filename, treename))
-    print('--- Adding branch %s in %s:%s ...' %(branchname2, filename, treename))
-    print('--- Adding branch %s in %s:%s ...' %(branchname3, filename, treename))
-    print('--- Adding branch %s in %s:%s ...' %(branchname4, filename, treename))
-    for i in tqdm(range(n_entries)):
-        otree.GetEntry(i)
-        y_helper1[0] = data1[i]
-        branch1.Fill()
-        y_helper2[0] = data2[i]
-        branch2.Fill()
-        y_helper3[0] = data3[i]
-        branch3.Fill()
-        y_helper4[0] = data4[i]
-        branch4.Fill()
-
-    # write new branch to the tree
-    ofile.Write("",TFile.kOverwrite)
-
     # close input file
     ifile.Close()
 
-    # close output file
-    ofile.Close()
-
-    # overwrite old file
-    #print('--- Overwrite original file ...')
-    #shutil.move(filename + '.mist', filename)
-
-def add_fivebranches(filename, treename, branchname1, branchtype1, data1, branchname2, branchtype2, data2, branchname3, branchtype3, data3, branchname4, branchtype4, data4, branchname5, branchtype5, data5):
-
-    # open input file and tree
-    ifile = TFile(filename,'READ')
-    itree = ifile.Get(treename)
-
-    ofilename = filename.rstrip('.root') + '_jetchargetaggerMulti5.root'
-    # create output file
-    ofile = TFile(ofilename,'RECREATE')
-
-    # clone tree, FIX: hardcoded
-    #ofile.mkdir('utm')
-    #ofile.cd('utm')
+    return ofilename
 
-    # set branch inactive in itree if it already exists
-    if itree.FindBranch(branchname1):
-        itree.SetBranchStatus(branchname1,0)
-    if itree.FindBranch(branchname2):
-        itree.SetBranchStatus(branchname2,0)
-    if itree.FindBranch(branchname3):
-        itree.SetBranchStatus(branchname3,0)
-    if itree.FindBranch(branchname4):
-        itree.SetBranchStatus(branchname4,0)
-    if itree.FindBranch(branchname5):
-        itree.SetBranchStatus(branchname5,0)
-    # clone itree
-    print('--- Cloning input file ...')
-    otree = itree.CloneTree()
-    otree.Write()
+def add_friend(tree, friendfilename, alias='jetchargetagger'):
+    """Attach the branches written by add_branches(..., friend=True) to `tree` (a TTree or TChain).
 
-    # make new variable and add it as a branch to the tree
-    y_helper1 = array(branchtype1.lower(),[0])
-    branch1 = otree.Branch(branchname1, y_helper1, branchname1 + '/' + branchtype1)
-    y_helper2 = array(branchtype2.lower(),[0])
-    branch2 = otree.Branch(branchname2, y_helper2, branchname2 + '/' + branchtype2)
-    y_helper3 = array(branchtype3.lower(),[0])
-    branch3 = otree.Branch(branchname3, y_helper3, branchname3 + '/' + branchtype3)
-    y_helper4 = array(branchtype4.lower(),[0])
-    branch4 = otree.Branch(branchname4, y_helper4, branchname4 + '/' + branchtype4)
-    y_helper5 = array(branchtype5.lower(),[0])
-    branch5 = otree.Branch(branchname5, y_helper5, branchname5 + '/' + branchtype5)
+    The new branches can then be read as `<alias>.<branchname>`, or by their plain name if it is unique.
+    Returns the TFriendElement.
+    """
+    fe = tree.AddFriend('%s=%s' % (alias, tree.GetName()), friendfilename)
+    ffile = fe.GetFile()
+    ftree = ffile.Get(tree.GetName()) if ffile else None
+    if not ftree:
+        tree.GetListOfFriends().Remove(fe)
+        raise IOError('cannot read tree %s from %s' % (tree.GetName(), friendfilename))
+    if ftree.GetEntries() != tree.GetEntries():
+        tree.GetListOfFriends().Remove(fe)
+        raise ValueError('mismatch in tree entries (%d) and friend tree entries (%d)!' % (tree.GetEntries(), ftree.GetEntries()))
+    return fe
 
-    # get number of entries and check if size matches the data
-    n_entries = otree.GetEntries()
-    print (n_entries)
-    print (data1.size)
-    print (data2.size)
-    print (data3.size)
-    print (data4.size)
-    print (data5.size)
-    if n_entries != data1.size:
-        print('mismatch in input tree entries and new branch1 entries!')
-    if n_entries != data2.size:
-        print('mismatch in input tree entries and new branch2 entries!')
-    if n_entries != data3.size:
-        print('mismatch in input tree entries and new branch3 entries!')
-    if n_entries != data4.size:
-        print('mismatch in input tree entries and new branch4 entries!')
-    if n_entries != data5.size:
-        print('mismatch in input tree entries and new branch4 entries!')
+_numpy_types = {typecode: dtype for dtype, (typecode, ctype) in _root_types.items()}
 
-    # fill the branch
-    print('--- Adding branch %s in %s:%s ...' %(branchname1, filename, treename))
-    print('--- Adding branch %s in %s:%s ...' %(branchname2, filename, treename))
-    print('--- Adding branch %s in %s:%s ...' %(branchname3, filename, treename))
-    print('--- Adding branch %s in %s:%s ...' %(branchname4, filename, treename))
-    print('--- Adding branch %s in %s:%s ...' %(branchname5, filename, treename))
-    for i in tqdm(range(n_entries)):
-        otree.GetEntry(i)
-        y_helper1[0] = data1[i]
-        branch1.Fill()
-        y_helper2[0] = data2[i]
-        branch2.Fill()
-        y_helper3[0] = data3[i]
-        branch3.Fill()
-        y_helper4[0] = data4[i]
-        branch4.Fill()
-        y_helper5[0] = data5[i]
-        branch5.Fill()
+def _typed(branchtype, data):
+    return np.asarray(data, dtype=_numpy_types[branchtype])
 
-    # write new branch to the tree
-    ofile.Write("",TFile.kOverwrite)
-
-    # close input file
-    ifile.Close()
-
-    # close output file
-    ofile.Close()
+def add_branch(filename, treename, branchname, branchtype, data):
+    return add_branches(filename, treename, {branchname: _typed(branchtype, data)}, suffix='_jetchargetagger_WpWn')
 
-    # overwrite old file
-    #print('--- Overwrite original file ...')
-    #shutil.move(filename + '.mist', filename)
+def add_fourbranches(filename, treename, branchname1, branchtype1, data1, branchname2, branchtype2, data2, branchname3, branchtype3, data3, branchname4, branchtype4, data4):
+    branches = {
+        branchname1: _typed(branchtype1, data1),
+        branchname2: _typed(branchtype2, data2),
+        branchname3: _typed(branchtype3, data3),
+        branchname4: _typed(branchtype4, data4),
+    }
+    return add_branches(filename, treename, branches, suffix='_jetchargetaggerMulti')
 
+def add_fivebranches(filename, treename, branchname1, branchtype1, data1, branchname2, branchtype2, data2, branchname3, branchtype3, data3, branchname4, branchtype4, data4, branchname5, branchtype5, data5):
+    branches = {
+        branchname1: _typed(branchtype1, data1),
+        branchname2: _typed(branchtype2, data2),
+        branchname3: _typed(branchtype3, data3),
+        branchname4: _typed(branchtype4, data4),
+        branchname5: _typed(branchtype5, data5),
+    }
+    return add_branches(filename, treename, branches, suffix='_jetchargetaggerMulti5')
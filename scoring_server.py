@@ -0,0 +1,414 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+#
+# Long-running local scoring service: the year models are loaded once (model_registry.py) and kept warm, and
+# concurrent requests to the same year are merged into micro-batches of up to --max_batch jets, waiting at most
+# --max_latency_ms for more requests to arrive.
+#
+#   POST /score?year=UL18   padded inputs: an .npz body (Content-Type application/x-npz) with the points, features
+#                           and mask arrays (channel_last, any number of particles up to pad_len), or the JSON
+#                           {"inputs": {"points": [...], "features": [...], "mask": [...]}}.
+#                           Raw constituents: the JSON {"jets": [{"px": [...], "py": [...], "pz": [...],
+#                           "energy": [...], "charge": [...]}, ...]}, with the features computed as in the conversion.
+#                           The scores (W+, W-, Z) are returned as JSON {"scores": [[...], ...]}, or as an .npz with
+#                           a scores array for an .npz request.
+#   GET /metrics            queue depth, request and batch counts, latency percentiles per year
+#   GET /health             the years that are served
+#
+# python scoring_server.py --years UL17,UL18 [--port 8765 | --socket /tmp/jetcharge.sock]
+#
+# Clients do not need TensorFlow: ScoringClient('http://127.0.0.1:8765').score(X, year='UL18')
+
+import io
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'preprocessing'))
+import json
+import time
+import queue
+import signal
+import socket
+import optparse
+import threading
+import collections
+import http.client
+import http.server
+import socketserver
+import urllib.parse
+import numpy as np
+import logging
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
+
+def raw_inputs(jets, feature_dict, pad_len, max_particles=70):
+    """Padded model inputs (channel_last) of jets given as dicts of per-particle px, py, pz, energy and charge.
+    The features are computed by prepare_tagger_inputs._make_features, as for the converted training files:
+    at most max_particles candidates per jet, and only those with a positive energy."""
+    import awkward
+    from prepare_tagger_inputs import _make_features, feature_columns
+    from load_datasets import pad_arrays
+    names = ['px', 'py', 'pz', 'energy', 'charge']
+    jets = [{k:np.asarray(jet[k], dtype='float32')[:max_particles] for k in names} for jet in jets]
+    keep = [jet['energy'] > 0 for jet in jets]
+    n_particles = np.array([np.sum(k) for k in keep])
+    arrays = [awkward.unflatten(np.concatenate([jet[k][m] for jet, m in zip(jets, keep)]), n_particles) for k in names]
+    v = _make_features(*arrays, n_particles, [], None, None, columns=feature_columns(feature_dict))
+    return {k:pad_arrays([v[col] for col in cols], pad_len, data_format='channel_last') for k, cols in feature_dict.items()}
+
+class _Request(object):
+    def __init__(self, X, n):
+        self.X = X
+        self.n = n
+        self.t_submit = time.perf_counter()
+        self.t_start = None
+        self.done = threading.Event()
+        self.scores = None
+        self.error = None
+
+class MicroBatcher(object):
+    """Runs predict (a function of a dict of padded arrays) in a worker thread on batches merged from the
+    submitted requests. A batch is closed when it has max_batch jets or when its first request has waited
+    max_latency seconds. A request larger than max_batch is run as one batch."""
+
+    def __init__(self, predict, max_batch=256, max_latency=0.005, window=10000):
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self._queue = queue.Queue()
+        self._held = None
+        self._lock = threading.Lock()
+        self.requests = self.jets = self.batches = self.errors = 0
+        self._latency = collections.deque(maxlen=window)
+        self._wait = collections.deque(maxlen=window)
+        self._batch_jets = collections.deque(maxlen=window)
+        self._batch_time = collections.deque(maxlen=window)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, X):
+        """Scores of the jets of X, blocks until the batch with them has been run"""
+        request = _Request(X, len(next(iter(X.values()))))
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    def queue_depth(self):
+        return self._queue.qsize() + (self._held is not None)
+
+    def _next_batch(self):
+        first = self._held or self._queue.get()
+        self._held = None
+        batch, n = [first], first.n
+        deadline = first.t_submit + self.max_latency
+        while n < self.max_batch:
+            try:
+                request = self._queue.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if n + request.n > self.max_batch:
+                self._held = request
+                break
+            batch.append(request)
+            n += request.n
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            t0 = time.perf_counter()
+            for request in batch:
+                request.t_start = t0
+            try:
+                X = {k:np.concatenate([r.X[k] for r in batch]) if len(batch) > 1 else batch[0].X[k] for k in batch[0].X}
+                scores = self.predict(X)
+                start = 0
+                for request in batch:
+                    request.scores = scores[start:start + request.n]
+                    start += request.n
+            except Exception as e:
+                logging.exception('Scoring a batch of %d requests failed' % len(batch))
+                for request in batch:
+                    request.error = e
+            t1 = time.perf_counter()
+            with self._lock:
+                self.batches += 1
+                self.requests += len(batch)
+                self.jets += sum(r.n for r in batch)
+                self.errors += len(batch) if batch[0].error is not None else 0
+                self._batch_jets.append(sum(r.n for r in batch))
+                self._batch_time.append(t1 - t0)
+                for request in batch:
+                    self._latency.append(t1 - request.t_submit)
+                    self._wait.append(request.t_start - request.t_submit)
+            for request in batch:
+                request.done.set()
+
+    def metrics(self):
+        def _ms(values):
+            if not values:
+                return None
+            p = np.percentile(np.array(values) * 1e3, [50, 90, 99])
+            return {'p50': float(p[0]), 'p90': float(p[1]), 'p99': float(p[2]), 'mean': float(np.mean(values) * 1e3)}
+        with self._lock:
+            return {
+                'queue_depth': self.queue_depth(),
+                'requests': self.requests,
+                'jets': self.jets,
+                'batches': self.batches,
+                'errors': self.errors,
+                'mean_batch_jets': float(np.mean(self._batch_jets)) if self._batch_jets else None,
+                'latency_ms': _ms(list(self._latency)),
+                'queue_wait_ms': _ms(list(self._wait)),
+                'batch_time_ms': _ms(list(self._batch_time)),
+                }
+
+class ScoringService(object):
+    """The models (dict year -> Keras model) behind one MicroBatcher each. feature_dicts (dict year -> feature_dict)
+    are needed to score raw constituents, the load_datasets defaults otherwise."""
+
+    def __init__(self, models, feature_dicts=None, max_batch=256, max_latency=0.005, xla=False):
+        import tensorflow as tf
+        self.t_start = time.time()
+        self.feature_dicts = feature_dicts or {}
+        self.input_shapes = {}
+        self.num_classes = {}
+        self.batchers = {}
+        for year, model in models.items():
+            names = [i.name.split(':')[0] for i in model.inputs]
+            self.input_shapes[year] = {name:tuple(i.shape[1:]) for name, i in zip(names, model.inputs)}
+            self.num_classes[year] = model.output_shape[-1]
+            signature = [{name:tf.TensorSpec((None,) + tuple(i.shape[1:]), tf.float32, name=name) for name, i in zip(names, model.inputs)}]
+            predict = tf.function(lambda X, model=model: model(X, training=False), input_signature=signature, jit_compile=xla)
+            # trace (and compile) before the first request
+            predict({name:tf.zeros((1,) + shape) for name, shape in self.input_shapes[year].items()})
+            self.batchers[year] = MicroBatcher(lambda X, predict=predict: predict(X).numpy(), max_batch=max_batch, max_latency=max_latency)
+        self.default_year = next(iter(models))
+
+    def _year(self, year):
+        year = year or self.default_year
+        if year not in self.batchers:
+            raise ValueError('year %s is not served, the years are %s' % (year, ', '.join(self.batchers)))
+        return year
+
+    def pad(self, year, X):
+        """X as float32 arrays of the input shapes of the model of year, the particles zero-padded to pad_len"""
+        shapes = self.input_shapes[year]
+        missing = set(shapes) - set(X)
+        if missing:
+            raise ValueError('missing inputs %s' % ', '.join(sorted(missing)))
+        padded = {}
+        for name, shape in shapes.items():
+            x = np.asarray(X[name], dtype='float32')
+            if x.ndim != len(shape) + 1 or x.shape[2:] != shape[1:] or x.shape[1] > shape[0]:
+                raise ValueError('%s has shape %s, expected (jets, <= %d, %s)' % (name, x.shape, shape[0], ', '.join(map(str, shape[1:]))))
+            if x.shape[1] < shape[0]:
+                x = np.concatenate([x, np.zeros((len(x), shape[0] - x.shape[1]) + shape[1:], dtype='float32')], axis=1)
+            padded[name] = x
+        if len(set(len(x) for x in padded.values())) > 1:
+            raise ValueError('the inputs have different numbers of jets')
+        return padded
+
+    def score(self, X=None, jets=None, year=None):
+        year = self._year(year)
+        if jets is not None:
+            from load_datasets import set_default_features
+            feature_dict = self.feature_dicts.get(year) or set_default_features({})
+            X = raw_inputs(jets, feature_dict, next(iter(self.input_shapes[year].values()))[0])
+        X = self.pad(year, X)
+        if len(next(iter(X.values()))) == 0:
+            return np.zeros((0, self.num_classes[year]), dtype='float32'), year
+        return self.batchers[year].submit(X), year
+
+    def metrics(self):
+        return {'uptime_s': time.time() - self.t_start, 'years': {year:b.metrics() for year, b in self.batchers.items()}}
+
+def load_service(years=None, epoch='best', root='./modelfiles', ragged=False, **kwargs):
+    """ScoringService with the checkpoints of years (default: all years) from the model registry"""
+    from model_registry import get_registry
+    registry = get_registry(root)
+    models, feature_dicts = {}, {}
+    for year in years or registry.years():
+        entry = registry.resolve(year, epoch)
+        model = registry.load(year, epoch)
+        if ragged:
+            from tf_keras_model import get_particle_net_lite, copy_weights
+            input_shapes = {i.name.split(':')[0]:tuple(i.shape[1:]) for i in model.inputs}
+            rebuilt = get_particle_net_lite(model.output_shape[-1], input_shapes, num_points=model.inputs[0].shape[1], ragged=True)
+            copy_weights(model, rebuilt)
+            model = rebuilt
+        logging.info('Serving %s epoch %d (%s)' % (year, entry['epoch'], entry['path']))
+        models[year], feature_dicts[year] = model, entry['feature_dict']
+    # coffea and the feature definitions of raw_inputs, before the first request with raw constituents
+    import prepare_tagger_inputs
+    return ScoringService(models, feature_dicts, **kwargs)
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            logging.info(format % args)
+
+    def _send(self, code, body, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path == '/metrics':
+            self._send(200, self.server.service.metrics())
+        elif path == '/health':
+            self._send(200, {'status': 'ok', 'years': list(self.server.service.batchers)})
+        else:
+            self._send(404, {'error': 'unknown path %s' % path})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/score':
+            self._send(404, {'error': 'unknown path %s' % url.path})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        npz = self.headers.get('Content-Type') == 'application/x-npz'
+        try:
+            year = urllib.parse.parse_qs(url.query).get('year', [None])[0]
+            if npz:
+                with np.load(io.BytesIO(body)) as f:
+                    scores, year = self.server.service.score(X={k:f[k] for k in f.files}, year=year)
+            else:
+                request = json.loads(body)
+                scores, year = self.server.service.score(X=request.get('inputs'), jets=request.get('jets'), year=request.get('year', year))
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self._send(500, {'error': '%s: %s' % (type(e).__name__, e)})
+            return
+        if npz:
+            out = io.BytesIO()
+            np.savez(out, scores=scores)
+            self._send(200, out.getvalue(), content_type='application/x-npz')
+        else:
+            self._send(200, {'year': year, 'scores': scores.tolist()})
+
+class _HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('local', 0)
+
+def make_server(service, host='127.0.0.1', port=8765, unix_socket=None, verbose=False):
+    """HTTP server of service on host:port, or on the Unix socket unix_socket. Run it with serve_forever()."""
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = _UnixServer(unix_socket, _Handler)
+    else:
+        server = _HTTPServer((host, port), _Handler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+class ScoringClient(object):
+    """Client of a scoring server at address: 'http://host:port' or 'unix:/path/to/socket'. Only needs numpy."""
+
+    def __init__(self, address='http://127.0.0.1:8765', timeout=60):
+        self.address = address
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        # one keep-alive connection per thread
+        if getattr(self._local, 'connection', None) is None:
+            if self.address.startswith('unix:'):
+                self._local.connection = _UnixConnection(self.address[len('unix:'):], self.timeout)
+            else:
+                url = urllib.parse.urlparse(self.address)
+                self._local.connection = http.client.HTTPConnection(url.hostname, url.port, timeout=self.timeout)
+        return self._local.connection
+
+    def _request(self, method, path, body=None, headers={}):
+        try:
+            connection = self._connection()
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self._local.connection = None
+            raise
+        if response.status != 200:
+            raise RuntimeError('scoring server: %s' % json.loads(data).get('error'))
+        return data, response.getheader('Content-Type')
+
+    def score(self, X=None, jets=None, year=None):
+        """Scores of the padded inputs X (dict of arrays as Dataset.X) or of the raw constituents jets"""
+        path = '/score' + ('?year=%s' % year if year else '')
+        if X is not None:
+            body = io.BytesIO()
+            np.savez(body, **{k:np.asarray(v, dtype='float32') for k, v in X.items()})
+            data, _ = self._request('POST', path, body.getvalue(), {'Content-Type': 'application/x-npz'})
+            with np.load(io.BytesIO(data)) as f:
+                return f['scores']
+        jets = [{k:np.asarray(v).tolist() for k, v in jet.items()} for jet in jets]
+        data, _ = self._request('POST', path, json.dumps({'jets': jets}), {'Content-Type': 'application/json'})
+        return np.array(json.loads(data)['scores'], dtype='float32')
+
+    def metrics(self):
+        return json.loads(self._request('GET', '/metrics')[0])
+
+    def health(self):
+        return json.loads(self._request('GET', '/health')[0])
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--years", help = "Comma separated years to serve (default: all years of the model registry)", default= None)
+    parser.add_option("--epoch", help = "Checkpoint epoch of the models, or best", default= "best")
+    parser.add_option("--host", default= "127.0.0.1")
+    parser.add_option("--port", type="int", default= 8765)
+    parser.add_option("--socket", help = "Listen on this Unix socket instead of --host:--port", default= None)
+    parser.add_option("--max_batch", type="int", help = "Maximum number of jets per micro-batch", default= 256)
+    parser.add_option("--max_latency_ms", type="float", help = "Maximum time a request waits for other requests to batch with", default= 5.)
+    parser.add_option("--ragged", action="store_true", help = "Run the EdgeConvs on the real particles only, skipping the padding", default = False)
+    parser.add_option("--xla", action="store_true", help = "Compile the models with XLA", default = False)
+    parser.add_option("--verbose", action="store_true", help = "Log every request", default = False)
+    (options,args) = parser.parse_args()
+
+    service = load_service(options.years.split(',') if options.years else None, options.epoch, ragged=options.ragged,
+                           max_batch=options.max_batch, max_latency=options.max_latency_ms * 1e-3, xla=options.xla)
+    server = make_server(service, options.host, options.port, options.socket, options.verbose)
+    # stop on SIGTERM as on Ctrl-C, removing the socket file
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.info('Scoring %s on %s' % (', '.join(service.batchers), 'unix:' + options.socket if options.socket else 'http://%s:%d' % (options.host, options.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if options.socket and os.path.exists(options.socket):
+            os.remove(options.socket)
+
+if __name__ == "__main__":
+    main()
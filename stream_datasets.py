@@ -0,0 +1,71 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+#
+# tf.data input pipeline that streams converted .awkd (parquet) shards instead of loading a whole sample in memory like
+# load_datasets.Dataset. Shards are read in parallel, one row group at a time (files written by prepare_tagger_inputs.convert
+# hold a single row, so there a row group is the whole shard: use --step_size / convert(step=...) to keep shards small),
+# padded on the fly with pad_arrays, shuffled through a bounded buffer, batched and prefetched.
+
+import numpy as np
+import awkward
+import tensorflow as tf
+import logging
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
+from load_datasets import pad_arrays, set_default_features
+
+def _num_row_groups(filepath):
+    return awkward.metadata_from_parquet(filepath)['num_row_groups']
+
+class StreamingDataset(object):
+
+    def __init__(self, filepaths, feature_dict = {}, label='label', pad_len=100):
+        if isinstance(filepaths, str):
+            filepaths = [filepaths]
+        if len(filepaths)==0:
+            raise ValueError('no input files given')
+        self.filepaths = list(filepaths)
+        self.feature_dict = feature_dict
+        if len(feature_dict)==0:
+            set_default_features(feature_dict)
+        self.label = label
+        self.pad_len = pad_len
+        # columns are padded along the last axis, as Dataset(..., data_format='channel_last')
+        self.input_shapes = {k:(pad_len, len(cols)) for k, cols in self.feature_dict.items()}
+        first = awkward.from_parquet(self.filepaths[0], columns=[self.label], row_groups=[0])
+        self.num_classes = len(first[self.label][0])
+
+    def _read(self, filepath):
+        if isinstance(filepath, bytes):
+            # from_generator passes its args as numpy bytes
+            filepath = filepath.decode()
+        columns = [self.label] + sorted(set(col for cols in self.feature_dict.values() for col in cols))
+        for rg in range(_num_row_groups(filepath)):
+            a = awkward.from_parquet(filepath, columns=columns, row_groups=[rg])
+            X = tuple(pad_arrays([a[col] for col in self.feature_dict[k]], self.pad_len, data_format='channel_last') for k in self.feature_dict)
+            y = awkward.to_numpy(a[self.label]).astype('float32')
+            yield X, y
+
+    def tf_dataset(self, batch_size, shuffle=True, shuffle_buffer=100000, num_parallel_reads=4, seed=None):
+        """tf.data.Dataset of ({name: (batch, pad_len, C)}, label) batches for model.fit/predict.
+
+        shuffle: shuffle the shard order every epoch, and the jets through a buffer of shuffle_buffer jets.
+        num_parallel_reads: number of shards read and padded concurrently.
+        """
+        keys = list(self.feature_dict)
+        signature = (tuple(tf.TensorSpec(shape=(None,) + self.input_shapes[k], dtype=tf.float32) for k in keys),
+                     tf.TensorSpec(shape=(None, self.num_classes), dtype=tf.float32))
+
+        def _shard(filepath):
+            return tf.data.Dataset.from_generator(self._read, output_signature=signature, args=(filepath,))
+
+        files = tf.data.Dataset.from_tensor_slices(self.filepaths)
+        if shuffle:
+            files = files.shuffle(len(self.filepaths), seed=seed, reshuffle_each_iteration=True)
+        ds = files.interleave(_shard, cycle_length=min(num_parallel_reads, len(self.filepaths)),
+                              num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+        ds = ds.unbatch()
+        if shuffle:
+            ds = ds.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+        ds = ds.batch(batch_size)
+        ds = ds.map(lambda X, y: (dict(zip(keys, X)), y), num_parallel_calls=tf.data.AUTOTUNE)
+        return ds.prefetch(tf.data.AUTOTUNE)
@@ -1,13 +1,13 @@
-from tensorflow import keras
+from model_registry import load_model
 
 def main():
 
-#    modelpath = "./modelfiles/UL18/model_checkpoints/particle_net_lite_model.029.h5"
-#    modelpath = "./modelfiles/UL17/model_checkpoints/particle_net_lite_model.030.h5"
-    modelpath = "./modelfiles/UL16postVFP/model_checkpoints/particle_net_lite_model.030.h5"
-#    modelpath = "./modelfiles/UL16preVFP/model_checkpoints/particle_net_lite_model.030.h5"
+#    year = "UL18"
+#    year = "UL17"
+    year = "UL16postVFP"
+#    year = "UL16preVFP"
     
-    model = keras.models.load_model(modelpath)
+    model = load_model(year, epoch='best')
 
 if __name__ == '__main__':
     main()
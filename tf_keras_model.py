@@ -1,6 +1,8 @@
 # Copyright (c) 2019 Huilin Qu
 # Licensed under the MIT License. See LICENSE_old file for details.
 
+import re
+import numpy as np
 import tensorflow as tf
 from tensorflow import keras
 
@@ -20,11 +22,7 @@ def knn(num_points, k, topk_indices, features):
     # topk_indices: (N, P, K)
     # features: (N, P, C)
     with tf.name_scope('knn'):
-        queries_shape = tf.shape(features)
-        batch_size = queries_shape[0]
-        batch_indices = tf.tile(tf.reshape(tf.range(batch_size), (-1, 1, 1, 1)), (1, num_points, k, 1))
-        indices = tf.concat([batch_indices, tf.expand_dims(topk_indices, axis=3)], axis=3)  # (N, P, K, 2)
-        return tf.gather_nd(features, indices)
+        return tf.gather(features, topk_indices, batch_dims=1)  # (N, P, K, C)
 
 
 def edge_conv(points, features, num_points, K, channels, with_bn=True, activation='relu', pooling='average', name='edgeconv'):
@@ -49,14 +47,20 @@ def edge_conv(points, features, num_points, K, channels, with_bn=True, activatio
         indices = indices[:, :, 1:]  # (N, P, K)
 
         fts = features
-        knn_fts = knn(num_points, K, indices, fts)  # (N, P, K, C)
-        knn_fts_center = tf.tile(tf.expand_dims(fts, axis=2), (1, 1, K, 1))  # (N, P, K, C)
-        knn_fts = tf.concat([knn_fts_center, tf.subtract(knn_fts, knn_fts_center)], axis=-1)  # (N, P, K, 2*C)
+        # The first 1x1 conv acts on the edge features [x_i, x_j - x_i] and is linear: W.[x_i, x_j - x_i] = (W_a - W_b).x_i + W_b.x_j.
+        # Apply it once per point to [x_i, 0] and [0, x_i] and gather the W_b.x_j term of the neighbours, instead of tiling x_i
+        # and gathering x_j into a (N, P, K, 2*C) tensor. Same layer and weights, so existing checkpoints still apply.
+        zeros = tf.zeros_like(fts)
+        center = tf.stack([tf.concat([fts, zeros], axis=-1), tf.concat([zeros, fts], axis=-1)], axis=2)  # (N, P, 2, 2*C)
 
-        x = knn_fts
         for idx, channel in enumerate(channels):
-            x = keras.layers.Conv2D(channel, kernel_size=(1, 1), strides=1, data_format='channels_last',
-                                    use_bias=False if with_bn else True, kernel_initializer='glorot_normal', name='%s_conv%d' % (name, idx))(x)
+            conv = keras.layers.Conv2D(channel, kernel_size=(1, 1), strides=1, data_format='channels_last',
+                                       use_bias=False if with_bn else True, kernel_initializer='glorot_normal', name='%s_conv%d' % (name, idx))
+            if idx == 0:
+                y = conv(center)  # (N, P, 2, C1)
+                x = knn(num_points, K, indices, y[:, :, 1, :]) + (y[:, :, :1, :] - y[:, :, 1:, :])  # (N, P, K, C1)
+            else:
+                x = conv(x)
             if with_bn:
                 x = keras.layers.BatchNormalization(name='%s_bn%d' % (name, idx))(x)
             if activation:
@@ -80,6 +84,88 @@ def edge_conv(points, features, num_points, K, channels, with_bn=True, activatio
             return sc + fts
 
 
+def ragged_edge_conv(coords, features, lengths, K, channels, with_bn=True, activation='relu', pooling='average', name='edgeconv'):
+    """EdgeConv on the real particles only, with the layers (and weights) of edge_conv
+    Inputs:
+        coords: (M+1, C_p), coordinates of the M particles of all jets, one jet after the other, and of the padding
+        features: (M+1, C_0), their features, the last row is the padding
+        lengths: (N,), number of particles of each jet
+    Returns:
+        transformed features: (M+1, C_out), C_out = channels[-1]
+
+    The neighbours are searched among the particles of each jet, padded to the longest jet of the batch (at least
+    2*(K+1)) with the coordinates of the padding shifted by 999, as in _particle_net_base. Jets with at most K
+    particles thus have the padding as neighbour, as with fixed padding. The convolutions only see the M+1 rows.
+    """
+
+    with tf.name_scope('edgeconv'):
+
+        padding = tf.shape(features)[0] - 1
+        num_points = tf.maximum(tf.reduce_max(lengths), 2 * (K + 1))
+        positions = tf.range(num_points)
+        real = tf.less(tf.expand_dims(positions, 0), tf.expand_dims(lengths, 1))  # (N, P)
+        starts = tf.cumsum(lengths, exclusive=True)
+        rows = tf.where(real, tf.expand_dims(starts, 1) + tf.expand_dims(positions, 0), padding)  # (N, P), row of each position
+        pts = tf.gather(coords, rows) + 999. * tf.expand_dims(tf.cast(tf.logical_not(real), coords.dtype), 2)  # (N, P, C_p)
+
+        # distance
+        D = batch_distance_matrix_general(pts, pts)  # (N, P, P)
+        _, indices = tf.nn.top_k(-D, k=K + 1)  # (N, P, K+1)
+        neighbours = tf.gather(rows, indices[:, :, 1:], batch_dims=1)  # (N, P, K)
+        # the neighbours of the padding are all padding
+        neighbours = tf.concat([tf.boolean_mask(neighbours, real), tf.fill([1, K], padding)], axis=0)  # (M+1, K)
+
+        fts = features
+        # first 1x1 conv applied once per particle, see edge_conv
+        zeros = tf.zeros_like(fts)
+        center = tf.expand_dims(tf.stack([tf.concat([fts, zeros], axis=-1), tf.concat([zeros, fts], axis=-1)], axis=1), 0)  # (1, M+1, 2, 2*C)
+
+        for idx, channel in enumerate(channels):
+            conv = keras.layers.Conv2D(channel, kernel_size=(1, 1), strides=1, data_format='channels_last',
+                                       use_bias=False if with_bn else True, kernel_initializer='glorot_normal', name='%s_conv%d' % (name, idx))
+            if idx == 0:
+                y = tf.squeeze(conv(center), axis=0)  # (M+1, 2, C1)
+                x = tf.expand_dims(tf.gather(y[:, 1, :], neighbours) + (y[:, :1, :] - y[:, 1:, :]), 0)  # (1, M+1, K, C1)
+            else:
+                x = conv(x)
+            if with_bn:
+                x = keras.layers.BatchNormalization(name='%s_bn%d' % (name, idx))(x)
+            if activation:
+                x = keras.layers.Activation(activation, name='%s_act%d' % (name, idx))(x)
+
+        if pooling == 'max':
+            fts = tf.reduce_max(x[0], axis=1)  # (M+1, C')
+        else:
+            fts = tf.reduce_mean(x[0], axis=1)  # (M+1, C')
+
+        # shortcut
+        sc = keras.layers.Conv2D(channels[-1], kernel_size=(1, 1), strides=1, data_format='channels_last',
+                                 use_bias=False if with_bn else True, kernel_initializer='glorot_normal', name='%s_sc_conv' % name)(tf.expand_dims(tf.expand_dims(features, axis=1), 0))
+        if with_bn:
+            sc = keras.layers.BatchNormalization(name='%s_sc_bn' % name)(sc)
+        sc = tf.squeeze(sc, axis=(0, 2))
+
+        if activation:
+            return keras.layers.Activation(activation, name='%s_sc_act' % name)(sc + fts)  # (M+1, C')
+        else:
+            return sc + fts
+
+
+def _head(pool, setting):
+    if setting.fc_params is not None:
+        x = pool
+        for layer_idx, layer_param in enumerate(setting.fc_params):
+            units, drop_rate = layer_param
+            x = keras.layers.Dense(units, activation='relu')(x)
+            if drop_rate is not None and drop_rate > 0 and not setting.inference:
+                x = keras.layers.Dropout(drop_rate)(x)
+        out = keras.layers.Dense(setting.num_class, activation='softmax', dtype='float32')(x)  # float32 softmax also with mixed precision
+        print (tf.shape(out))
+        return out  # (N, num_classes)
+    else:
+        return pool
+
+
 def _particle_net_base(points, features=None, mask=None, setting=None, name='particle_net'):
     # points : (N, P, C_coord)
     # features:  (N, P, C_features), optional
@@ -96,36 +182,114 @@ def _particle_net_base(points, features=None, mask=None, setting=None, name='par
         fts = tf.squeeze(keras.layers.BatchNormalization(name='%s_fts_bn' % name)(tf.expand_dims(features, axis=2)), axis=2)
         for layer_idx, layer_param in enumerate(setting.conv_params):
             K, channels = layer_param
-            pts = tf.add(coord_shift, points) if layer_idx == 0 else tf.add(coord_shift, fts)
-            fts = edge_conv(pts, fts, setting.num_points, K, channels, with_bn=True, activation='relu',
+            # with a mixed precision policy the features are float16/bfloat16, the neighbours are still searched in float32
+            pts = tf.add(coord_shift, points) if layer_idx == 0 else tf.add(coord_shift, fts if fts.dtype == points.dtype else tf.cast(fts, points.dtype))
+            fts = edge_conv(pts, fts, setting.num_points, K, channels, with_bn=not setting.inference, activation='relu',
                             pooling=setting.conv_pooling, name='%s_%s%d' % (name, 'EdgeConv', layer_idx))
 
         if mask is not None:
-            fts = tf.multiply(fts, mask)
+            fts = tf.multiply(fts, mask if mask.dtype == fts.dtype else tf.cast(mask, fts.dtype))
 
-        pool = tf.reduce_mean(fts, axis=1)  # (N, C)
+        if points.shape[1] is None:
+            # variable number of particles (e.g. length-bucketed batches): average over the pad length of the training,
+            # so that the output does not depend on how much a batch is padded
+            pool = tf.reduce_sum(fts, axis=1) / setting.num_points  # (N, C)
+        else:
+            pool = tf.reduce_mean(fts, axis=1)  # (N, C)
         print (type(pool))
         print (tf.shape(pool))
 
-        if setting.fc_params is not None:
-            x = pool
-            for layer_idx, layer_param in enumerate(setting.fc_params):
-                units, drop_rate = layer_param
-                x = keras.layers.Dense(units, activation='relu')(x)
-                if drop_rate is not None and drop_rate > 0:
-                    x = keras.layers.Dropout(drop_rate)(x)
-            out = keras.layers.Dense(setting.num_class, activation='softmax')(x)
-            print (tf.shape(out))
-            return out  # (N, num_classes)
-        else:
-            return pool
+        return _head(pool, setting)
+
+
+def _particle_net_ragged_base(points, features=None, mask=None, setting=None, name='particle_net'):
+    # as _particle_net_base, but only the particles with mask != 0 go through the EdgeConvs
+    # points : (N, P, C_coord)
+    # features:  (N, P, C_features), optional
+    # mask: (N, P, 1)
+
+    with tf.name_scope(name):
+        if features is None:
+            features = points
+        if mask is None:
+            raise ValueError('the ragged model needs the mask to find the particles of each jet')
+
+        valid = tf.not_equal(mask[:, :, 0], 0)  # (N, P)
+        lengths = tf.reduce_sum(tf.cast(valid, 'int32'), axis=1)  # (N,)
+        # particles of all jets, one jet after the other, and one padding particle with zero coordinates and features
+        coords = tf.concat([tf.boolean_mask(points, valid), tf.zeros_like(points[:1, 0, :])], axis=0)  # (M+1, C_coord)
+        fts = tf.concat([tf.boolean_mask(features, valid), tf.zeros_like(features[:1, 0, :])], axis=0)  # (M+1, C_features)
+
+        fts = keras.layers.BatchNormalization(name='%s_fts_bn' % name)(fts)
+        for layer_idx, layer_param in enumerate(setting.conv_params):
+            K, channels = layer_param
+            # with a mixed precision policy the features are float16/bfloat16, the neighbours are still searched in float32
+            pts = coords if layer_idx == 0 else (fts if fts.dtype == points.dtype else tf.cast(fts, points.dtype))
+            fts = ragged_edge_conv(pts, fts, lengths, K, channels, with_bn=not setting.inference, activation='relu',
+                                   pooling=setting.conv_pooling, name='%s_%s%d' % (name, 'EdgeConv', layer_idx))
+
+        # sum over the particles of each jet, averaged over the pad length of the training as in _particle_net_base
+        jets = tf.repeat(tf.range(tf.shape(lengths)[0]), lengths)
+        pool = tf.math.unsorted_segment_sum(fts[:-1], jets, tf.shape(lengths)[0]) / setting.num_points  # (N, C)
+
+        return _head(pool, setting)
 
 
 class _DotDict:
     pass
 
 
-def get_particle_net(num_classes, input_shapes):
+def _pair_layers(src, dst, source, target):
+    # match layers by name, the remaining ones (automatically named, e.g. Dense) by their order
+    src_names = set(layer.name for layer in src)
+    dst_names = set(layer.name for layer in dst)
+    by_name = {layer.name: layer for layer in src}
+    pairs = [(by_name[layer.name], layer) for layer in dst if layer.name in src_names]
+    pairs += list(zip([layer for layer in src if layer.name not in dst_names], [layer for layer in dst if layer.name not in src_names]))
+    if len(pairs) != len(src) or len(pairs) != len(dst):
+        raise ValueError('cannot match the %d layers with weights of %s to the %d of %s' % (len(src), source.name, len(dst), target.name))
+    for s, t in pairs:
+        if type(s) is not type(t):
+            raise ValueError('cannot copy the weights of %s (%s) to %s (%s)' % (s.name, type(s).__name__, t.name, type(t).__name__))
+    return pairs
+
+
+def copy_weights(source, target):
+    """Copy the weights of `source` into `target`, e.g. from a checkpoint loaded with keras.models.load_model into
+    the same architecture built with get_particle_net_lite. Layers are matched by name, the remaining ones
+    (automatically named, e.g. Dense) by their order.
+    """
+    src = [layer for layer in source.layers if layer.weights]
+    dst = [layer for layer in target.layers if layer.weights]
+    for s, t in _pair_layers(src, dst, source, target):
+        t.set_weights(s.get_weights())
+
+
+def fold_batchnorm(source, target):
+    """Copy the weights of a trained model into its inference version (built with inference=True): the
+    BatchNormalization following each 1x1 convolution is folded into the kernel and bias of the convolution.
+    """
+    layers = {layer.name: layer for layer in source.layers}
+    folded = {}
+    for layer in source.layers:
+        bn = layers.get(re.sub(r'conv(\d*)$', r'bn\1', layer.name))
+        if isinstance(layer, keras.layers.Conv2D) and isinstance(bn, keras.layers.BatchNormalization):
+            folded[layer.name] = bn
+    src = [layer for layer in source.layers if layer.weights and layer not in folded.values()]
+    dst = [layer for layer in target.layers if layer.weights]
+    for s, t in _pair_layers(src, dst, source, target):
+        if s.name not in folded:
+            t.set_weights(s.get_weights())
+            continue
+        bn = folded[s.name]
+        gamma, beta, mean, var = [w.astype('float64') for w in bn.get_weights()]
+        scale = gamma / np.sqrt(var + bn.epsilon)
+        weights = s.get_weights()
+        bias = weights[1] * scale if len(weights) > 1 else 0.
+        t.set_weights([(weights[0] * scale).astype('float32'), (bias + beta - mean * scale).astype('float32')])
+
+
+def get_particle_net(num_classes, input_shapes, num_points=None, inference=False, ragged=False, conv_params=None, conv_pooling=None, fc_params=None):
     r"""ParticleNet model from `"ParticleNet: Jet Tagging via Particle Clouds"
     <https://arxiv.org/abs/1902.08570>`_ paper.
     Parameters
@@ -133,31 +297,45 @@ def get_particle_net(num_classes, input_shapes):
     num_classes : int
         Number of output classes.
     input_shapes : dict
-        The shapes of each input (`points`, `features`, `mask`).
+        The shapes of each input (`points`, `features`, `mask`). The number of particles may be None
+        for inputs of variable length, e.g. length-bucketed batches.
+    num_points : int, optional
+        Pad length the model is trained with, required if the number of particles in `input_shapes` is None.
+    inference : bool, optional
+        Build the version for inference only, without dropout and without the BatchNormalization after the
+        1x1 convolutions (see fold_batchnorm).
+    ragged : bool, optional
+        Run the EdgeConvs on the particles with mask != 0 only, instead of on all padded positions. The layers
+        and weights are the same as without, see copy_weights.
+    conv_params, conv_pooling, fc_params : optional
+        Architecture settings instead of the defaults below, e.g. for hyperparameter_sweep.py.
     """
     setting = _DotDict()
     setting.num_class = num_classes
     # conv_params: list of tuple in the format (K, (C1, C2, C3))
-    setting.conv_params = [
+    setting.conv_params = conv_params or [
         (16, (64, 64, 64)),
         (16, (128, 128, 128)),
         (16, (256, 256, 256)),
         ]
     # conv_pooling: 'average' or 'max'
-    setting.conv_pooling = 'average'
+    setting.conv_pooling = conv_pooling or 'average'
     # fc_params: list of tuples in the format (C, drop_rate)
-    setting.fc_params = [(256, 0.1)]
-    setting.num_points = input_shapes['points'][0]
+    setting.fc_params = fc_params or [(256, 0.1)]
+    setting.num_points = input_shapes['points'][0] or num_points
+    setting.inference = inference
+    if setting.num_points is None:
+        raise ValueError('num_points is needed for inputs of variable length')
 
     points = keras.Input(name='points', shape=input_shapes['points'])
     features = keras.Input(name='features', shape=input_shapes['features']) if 'features' in input_shapes else None
     mask = keras.Input(name='mask', shape=input_shapes['mask']) if 'mask' in input_shapes else None
-    outputs = _particle_net_base(points, features, mask, setting, name='ParticleNet')
+    outputs = (_particle_net_ragged_base if ragged else _particle_net_base)(points, features, mask, setting, name='ParticleNet')
 
     return keras.Model(inputs=[points, features, mask], outputs=outputs, name='ParticleNet')
 
 
-def get_particle_net_lite(num_classes, input_shapes):
+def get_particle_net_lite(num_classes, input_shapes, num_points=None, inference=False, ragged=False, conv_params=None, conv_pooling=None, fc_params=None):
     r"""ParticleNet-Lite model from `"ParticleNet: Jet Tagging via Particle Clouds"
     <https://arxiv.org/abs/1902.08570>`_ paper.
     Parameters
@@ -165,25 +343,39 @@ def get_particle_net_lite(num_classes, input_shapes):
     num_classes : int
         Number of output classes.
     input_shapes : dict
-        The shapes of each input (`points`, `features`, `mask`).
+        The shapes of each input (`points`, `features`, `mask`). The number of particles may be None
+        for inputs of variable length, e.g. length-bucketed batches.
+    num_points : int, optional
+        Pad length the model is trained with, required if the number of particles in `input_shapes` is None.
+    inference : bool, optional
+        Build the version for inference only, without dropout and without the BatchNormalization after the
+        1x1 convolutions (see fold_batchnorm).
+    ragged : bool, optional
+        Run the EdgeConvs on the particles with mask != 0 only, instead of on all padded positions. The layers
+        and weights are the same as without, see copy_weights.
+    conv_params, conv_pooling, fc_params : optional
+        Architecture settings instead of the defaults below, e.g. for hyperparameter_sweep.py.
     """
     setting = _DotDict()
     setting.num_class = num_classes
     # conv_params: list of tuple in the format (K, (C1, C2, C3))
-    setting.conv_params = [
+    setting.conv_params = conv_params or [
         (7, (32, 32, 32)),
         (7, (64, 64, 64)),
         ]
     # conv_pooling: 'average' or 'max'
-    setting.conv_pooling = 'average'
+    setting.conv_pooling = conv_pooling or 'average'
     # fc_params: list of tuples in the format (C, drop_rate)
-    setting.fc_params = [(128, 0.1)]
-    setting.num_points = input_shapes['points'][0]
+    setting.fc_params = fc_params or [(128, 0.1)]
+    setting.num_points = input_shapes['points'][0] or num_points
+    setting.inference = inference
+    if setting.num_points is None:
+        raise ValueError('num_points is needed for inputs of variable length')
 
     points = keras.Input(name='points', shape=input_shapes['points'])
     features = keras.Input(name='features', shape=input_shapes['features']) if 'features' in input_shapes else None
     mask = keras.Input(name='mask', shape=input_shapes['mask']) if 'mask' in input_shapes else None
-    outputs = _particle_net_base(points, features, mask, setting, name='ParticleNet')
+    outputs = (_particle_net_ragged_base if ragged else _particle_net_base)(points, features, mask, setting, name='ParticleNet')
 
     return keras.Model(inputs=[points, features, mask], outputs=outputs, name='ParticleNet')
 
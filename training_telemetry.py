@@ -0,0 +1,158 @@
+# Copyright (c) 2025 Komal Tauqeer
+# Licensed under the MIT License. See LICENSE file for details.
+#
+# Lightweight training telemetry (keras_train_multi.py --telemetry): wall time, jets/s, input wait and compute time of
+# every training step, peak RSS, and the time of the validation of every epoch. Written to log_dir/steps.csv (one row
+# per step) and log_dir/telemetry.json (per epoch summaries), optionally with a TensorFlow profiler trace of a step
+# window for TensorBoard.
+#
+# The input wait is measured on the tf.data input of the training: TrainingTelemetry.wrap adds a last, sequential map
+# that stamps the time at which the training step receives its batch. The time from the start of the step to that
+# stamp is spent waiting for the input pipeline, the rest of the step is compute. Without wrap (in-memory arrays,
+# distributed datasets) only the step time is recorded.
+
+import os
+import csv
+import json
+import time
+import resource
+import logging
+import collections
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+def _peak_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) else None
+
+class TrainingTelemetry(keras.callbacks.Callback):
+    """Per-step timing of model.fit, see the module docstring.
+
+    log_dir: directory of steps.csv, telemetry.json and the profiler trace.
+    batch_size: jets per step for inputs that are not wrapped (the last batch of an epoch may be smaller).
+    profile_steps: (first, last) global training steps (counted from 1) to trace with the TensorFlow profiler, or None.
+    """
+
+    COLUMNS = ['epoch', 'step', 'global_step', 'jets', 'step_time', 'input_wait', 'compute', 'jets_per_s', 'peak_rss_mb']
+
+    def __init__(self, log_dir, batch_size=None, profile_steps=None):
+        super().__init__()
+        self.log_dir = log_dir
+        self.batch_size = batch_size
+        self.profile_steps = profile_steps
+        self.epochs = []
+        self.global_step = 0
+        self._stamps = collections.deque(maxlen=16)
+        self._profiling = False
+        self._csv = None
+        os.makedirs(log_dir, exist_ok=True)
+
+    def wrap(self, dataset):
+        """dataset (a tf.data.Dataset of batches) with the time stamps of the input wait"""
+        def stamp(*batch):
+            jets = tf.shape(tf.nest.flatten(batch)[0])[0]
+            done = tf.py_function(self._stamp, [jets], tf.int64)
+            with tf.control_dependencies([done]):
+                return tf.nest.map_structure(tf.identity, batch)
+        options = tf.data.Options()
+        # a prefetch after the stamps would hide the wait
+        options.experimental_optimization.inject_prefetch = False
+        return dataset.map(stamp).with_options(options)
+
+    def _stamp(self, jets):
+        self._stamps.append((time.perf_counter(), int(jets)))
+        return np.int64(0)
+
+    def on_train_begin(self, logs=None):
+        path = os.path.join(self.log_dir, 'steps.csv')
+        new = not os.path.exists(path)
+        self._csv_file = open(path, 'a', newline='')
+        self._csv = csv.writer(self._csv_file)
+        if new:
+            self._csv.writerow(self.COLUMNS)
+
+    def on_train_end(self, logs=None):
+        self._stop_profiler()
+        self._csv_file.close()
+        self._write_summary()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch = {'epoch': epoch + 1, 'steps': [], 'start': time.perf_counter(), 'val_time': 0., 'val_steps': 0}
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.global_step += 1
+        if self.profile_steps and self.global_step == self.profile_steps[0]:
+            logging.info('Profiling steps %d to %d into %s' % (self.profile_steps + (self.log_dir,)))
+            tf.profiler.experimental.start(self.log_dir)
+            self._profiling = True
+        self._step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        # the logs of a step are ready once it has finished
+        if logs and 'loss' in logs:
+            float(logs['loss'])
+        end = time.perf_counter()
+        step_time = end - self._step_start
+        stamp = next((s for s in reversed(self._stamps) if self._step_start <= s[0] <= end), None)
+        self._stamps.clear()
+        jets = stamp[1] if stamp is not None else self.batch_size
+        input_wait = stamp[0] - self._step_start if stamp is not None else None
+        row = [self._epoch['epoch'], batch + 1, self.global_step, jets, step_time, input_wait,
+               step_time - input_wait if input_wait is not None else None, jets / step_time if jets else None, _peak_rss_mb()]
+        self._csv.writerow(['%.6g' % v if isinstance(v, float) else '' if v is None else v for v in row])
+        self._epoch['steps'].append(row)
+        if self._profiling and self.global_step >= self.profile_steps[1]:
+            self._stop_profiler()
+
+    def _stop_profiler(self):
+        if self._profiling:
+            tf.profiler.experimental.stop()
+            self._profiling = False
+            logging.info('Profiler trace in %s, open with TensorBoard' % self.log_dir)
+
+    def on_test_begin(self, logs=None):
+        self._val_start = time.perf_counter()
+
+    def on_test_batch_end(self, batch, logs=None):
+        if hasattr(self, '_epoch'):
+            self._epoch['val_steps'] += 1
+
+    def on_test_end(self, logs=None):
+        # validation inside fit, not model.evaluate after it
+        if hasattr(self, '_epoch'):
+            self._epoch['val_time'] += time.perf_counter() - self._val_start
+
+    def on_epoch_end(self, epoch, logs=None):
+        steps = self._epoch.pop('steps')
+        start = self._epoch.pop('start')
+        step_times = [r[4] for r in steps]
+        waits = [r[5] for r in steps if r[5] is not None]
+        jets = sum(r[3] for r in steps if r[3])
+        train_time = float(np.sum(step_times))
+        self._epoch.update({'train_steps': len(steps),
+                            'epoch_time': time.perf_counter() - start,
+                            'train_time': train_time,
+                            'jets_per_s': jets / train_time if jets and train_time else None,
+                            'step_time_p50': _percentile(step_times, 50),
+                            'step_time_p90': _percentile(step_times, 90),
+                            'step_time_max': max(step_times) if step_times else None,
+                            'input_wait_fraction': float(np.sum(waits)) / train_time if waits and len(waits) == len(steps) else None,
+                            'peak_rss_mb': _peak_rss_mb()})
+        self.epochs.append(self._epoch)
+        del self._epoch
+        self._csv_file.flush()
+        self._write_summary()
+        e = self.epochs[-1]
+        logging.info('Epoch %d: %s jets/s, step p50 %.3f s, input wait %s, validation %.1f s, peak RSS %.0f MB' % (
+            e['epoch'], '%.0f' % e['jets_per_s'] if e['jets_per_s'] else '?', e['step_time_p50'] or 0,
+            '%.1f%%' % (100 * e['input_wait_fraction']) if e['input_wait_fraction'] is not None else '?', e['val_time'], e['peak_rss_mb']))
+
+    def _write_summary(self):
+        path = os.path.join(self.log_dir, 'telemetry.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'epochs': self.epochs, 'steps': self.global_step, 'peak_rss_mb': _peak_rss_mb()}, f, indent=1)
+        os.replace(path + '.tmp', path)